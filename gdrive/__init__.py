@@ -11,41 +11,152 @@
 # credit to t.me/kAiF_00z (github.com/kaif-00z)
 
 import base64
+import functools
 import json
 import mimetypes
 import os
 import pickle
-import random
 import time
 import re
+from collections import deque
+from contextlib import aclosing
 from glob import glob
+from typing import AsyncIterator, Awaitable, Callable
 from logging import WARNING, getLogger
 
 import aiofiles
 import aiohttp
-import jwt
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 
+from libs.archive import ARCHIVE_FORMATS, make_writer, parse_time
+from libs.bandwidth import BandwidthShaper
+from libs.cache_backends import make_cache_backend
+from libs.metadata_index import FOLDER_MIME_TYPE, MetadataIndex
+from libs.metrics import TOKEN_LATENCY, cache_hook, metered, observe_drive
 from libs.time_cache import timed_cache
 
 from .config import Var
+from .chunk_cache import ChunkCache
 from .errors import *
-from .utils import asyncio, run_async
+from .indexer import Indexer
+from .prefetch import Prefetcher
+from .scheduler import AccountScheduler
+from .sync import ChangesSync, DriveChangesFeed
+from .streaming import ChunkSizer, peak_rss, read_chunk
+from .tokens import TokenBroker
+from .utils import asyncio, run_in_executor, sign_jwt
 
 LOGGER = getLogger(__name__)
 
+PICKLE_ACCOUNT = "token.pickle"
+
+# how long drive payloads are cached, also what clients / cdns are told (Cache-Control)
+INFO_TTL = 3600  # 1hr is good for this as well
+LIST_TTL = 300  # 5 mins
+SEARCH_TTL = 300  # 5mins
+
+# drive payloads (info, listings, searches) can be shared between workers, see CACHE_BACKEND
+METADATA_CACHE = make_cache_backend(
+    Var.CACHE_BACKEND, db_path=Var.CACHE_DB_PATH, url=Var.CACHE_REDIS_URL
+)
+
 
 class AsyncGoogleDriver:
     def __init__(self):
-        self._requests_sessions = aiohttp.ClientSession()
+        # json api calls (metadata, listing, search, tokens)
+        self._requests_sessions = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=Var.API_MAX_CONNECTIONS,
+                ttl_dns_cache=300,
+                keepalive_timeout=Var.UPSTREAM_KEEPALIVE,
+            ),
+        )
+        # media downloads, kept separate so long running streams can't starve api calls
+        # and vice versa. no total timeout as a single stream can last for hours.
+        self._stream_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=Var.STREAM_MAX_CONNECTIONS,
+                limit_per_host=Var.STREAM_MAX_CONNECTIONS_PER_HOST,
+                ttl_dns_cache=300,
+                keepalive_timeout=Var.UPSTREAM_KEEPALIVE,
+                enable_cleanup_closed=True,
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120),
+            # aiohttp stops reading the socket once 2x this is buffered, bounding
+            # what a slow client can pile up per stream
+            read_bufsize=Var.STREAM_READ_BUFFER * 1024,
+        )
 
         # for service accounts
         self.__service_accounts_data = {}
-        self.__service_accounts_identifiers = []
+        self._scheduler = AccountScheduler()
         # for normal account
         self.__credentials = None
 
+        # accelerated downloads, big ranges are fetched as parallel segments
+        self.segments = Var.PARALLEL_SEGMENTS
+        self.segment_size = Var.SEGMENT_SIZE * 1024 * 1024
+
+        # folders are sent as archives, `archive_parallel` files ahead of the one being
+        # written get their first `archive_read_ahead` bytes fetched meanwhile
+        self.archive_parallel = Var.ARCHIVE_PARALLEL
+        self.archive_read_ahead = Var.ARCHIVE_READ_AHEAD * 1024 * 1024
+
+        # passthrough streams adapt their chunk size between 64 KiB and this and drop
+        # the upstream of clients that stopped reading for pause_timeout seconds
+        self.max_chunk_size = Var.STREAM_MAX_CHUNK * 1024
+        self.pause_timeout = Var.STREAM_PAUSE_TIMEOUT
+        self._streams = 0
+        self._peak_streams = 0
+
+        # local copy of the drive tree, filled by the background indexer
+        self.index = MetadataIndex(Var.INDEX_DB_PATH)
+        self.indexer = Indexer(
+            self.index,
+            self._get_file_info,
+            self._list_folder,
+            Var.ROOT_FOLDER_ID,
+            interval=Var.INDEX_INTERVAL * 60,
+            concurrency=Var.INDEX_CONCURRENCY,
+            popularity_weight=Var.SEARCH_POPULARITY_WEIGHT,
+        )
+        self._index_complete = False
+
+        self.sync = ChangesSync(
+            self.index,
+            DriveChangesFeed(self._drive_api),
+            self.indexer.is_leader,
+            on_change=self._invalidate,
+            interval=Var.SYNC_INTERVAL,
+        )
+
+        # egress caps, SERVER_SIDE_SPEED per download
+        self.shaper = BandwidthShaper(
+            total=Var.SERVER_MAX_SPEED * 1024 * 1024,
+            per_stream=Var.SERVER_SIDE_SPEED * 1024 * 1024,
+            per_ip=Var.PER_IP_SPEED * 1024 * 1024,
+        )
+
+        # hot file chunks kept on local disk
+        self.chunk_cache = ChunkCache(
+            root=Var.CHUNK_CACHE_DIR,
+            max_bytes=Var.CHUNK_CACHE_SIZE * 1024 * 1024,
+            chunk_size=Var.CHUNK_CACHE_CHUNK_SIZE * 1024 * 1024,
+            hot_files=Var.CHUNK_CACHE_HOT_FILES,
+        )
+
+        # background warming of what a served folder page most likely leads to
+        self.prefetcher = Prefetcher(
+            concurrency=Var.PREFETCH_CONCURRENCY,
+            rate=Var.PREFETCH_RATE,
+            is_busy=self._scheduler.throttled,
+        )
+        self.prefetch_subfolders = Var.PREFETCH_SUBFOLDERS
+
+        # access tokens shared by every worker on the host
+        self._tokens = TokenBroker(self._mint_token, cache_path=Var.TOKEN_CACHE_PATH)
+
     async def _async_searcher(
         self,
         url: str,
@@ -80,8 +191,15 @@ class AsyncGoogleDriver:
         if Var.IS_SERVICE_ACCOUNT:
             procs = [self._lazy_load_sa(sa) for sa in glob("accounts/*.json")]
             await asyncio.gather(*procs)
+            accounts = list(self.__service_accounts_data.keys())
         elif os.path.exists("token.pickle"):
             await self._lazy_load_pickle()
+            accounts = [PICKLE_ACCOUNT]
+        else:
+            return
+
+        self._scheduler.set_accounts(accounts)
+        await self._tokens.start(accounts)
 
     async def _lazy_load_pickle(self) -> None:
         async with aiofiles.open("token.pickle", "rb") as t:
@@ -104,86 +222,164 @@ class AsyncGoogleDriver:
             ).decode()
             return
 
-    @run_async
-    def _generate_gcp_jwt(self, sa_json) -> str:
+    async def _generate_gcp_jwt(self, sa_json) -> str:
         now = int(time.time())
-        private_key = sa_json["private_key"]
-        client_email = sa_json["client_email"]
         payload = {
-            "iss": client_email,
+            "iss": sa_json["client_email"],
             "scope": "https://www.googleapis.com/auth/drive",
             "aud": "https://www.googleapis.com/oauth2/v4/token",
             "exp": now + 3600,
             "iat": now,
         }
-        return jwt.encode(payload, private_key, algorithm="RS256")
-
-    # actually both sa's access token and pickle's refresh token expire after 1hr or 3600s
-    # so caching it for 58mins :)
-    @timed_cache(seconds=3500)
-    async def _fetch_token(
-        self, credentials: str = None, is_service_account: bool = False
-    ) -> str:
+        # RS256 signing is cpu bound, JWT_PROCESS_POOL moves it out of the worker process
+        return await run_in_executor(
+            sign_jwt, payload, sa_json["private_key"], process=Var.JWT_PROCESS_POOL
+        )
 
-        if is_service_account and credentials:
-            credentials = json.loads(base64.b64decode(credentials).decode())
+    async def _mint_token(self, account: str) -> tuple[str, float]:
+        # called by the token broker, which shares the result with every worker
+        # and refreshes it in the background before the 3600s expiry
+        if account == PICKLE_ACCOUNT:
+            payload = await self._lazy_load_pickle()
+        else:
+            credentials = json.loads(
+                base64.b64decode(self.__service_accounts_data[account]).decode()
+            )
             _jwt_payload = await self._generate_gcp_jwt(credentials)
             payload = {
                 "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
                 "assertion": _jwt_payload,
             }
-        else:
-            payload = await self._lazy_load_pickle()
 
-        for i in range(3):
-            res = await self._async_searcher(
-                url="https://www.googleapis.com/oauth2/v4/token",
-                post=True,
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-                data=payload,
-            )
-            if at := (res or {}).get("access_token"):
-                return at
+        started = time.perf_counter()
+        try:
+            for i in range(3):
+                res = await self._async_searcher(
+                    url="https://www.googleapis.com/oauth2/v4/token",
+                    post=True,
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    data=payload,
+                )
+                if at := (res or {}).get("access_token"):
+                    return at, time.time() + int(res.get("expires_in", 3600))
+        finally:
+            TOKEN_LATENCY.labels(account).observe(time.perf_counter() - started)
 
         raise FailedToFetchToken(details=res)
 
-    async def _get_token(self, retry: int = 0) -> str:
+    async def _fetch_token(self, account: str = PICKLE_ACCOUNT) -> str:
+        return await self._tokens.get(account)
+
+    async def _get_account_token(
+        self, exclude: tuple = (), retry: int = 0
+    ) -> tuple[str, str]:
         if self.__credentials:
-            return await self._fetch_token()
+            return PICKLE_ACCOUNT, await self._fetch_token()
 
         if Var.IS_SERVICE_ACCOUNT and self.__service_accounts_data:
-            if not self.__service_accounts_identifiers:
-                self.__service_accounts_identifiers = list(
-                    self.__service_accounts_data.keys()
-                )
-            service_account_data = self.__service_accounts_data[
-                random.choice(self.__service_accounts_identifiers)
-            ]
+            # least loaded account which isn't rate limited right now
+            account = self._scheduler.pick(exclude)
             try:
-                return await self._fetch_token(
-                    service_account_data, is_service_account=True
-                )
+                return account, await self._fetch_token(account)
             except FailedToFetchToken as err:
                 if retry >= 5:
                     raise err
-                return await self._get_token(retry + 1)
+                return await self._get_account_token(exclude + (account,), retry + 1)
 
         raise RuntimeError(
             "Neither a service account nor a token.pickle file is available. Please configure authentication first!"
         )
 
-    async def stream_file(
-        self, file_id: str, file: dict, range_header: int = 0
-    ) -> StreamingResponse:
-        url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&acknowledgeAbuse=true"
+    async def _get_token(self) -> str:
+        return (await self._get_account_token())[1]
 
-        file_name = file["name"]
-        file_size = int(file.get("size", 0))
-        mime_type = (
-            file.get("mimeType")
-            or mimetypes.guess_type(file["name"])[0]
-            or "application/octet-stream"
-        )
+    def _report(self, account: str, status: int, details: str = "") -> None:
+        self._scheduler.report(account, status, details)
+        if status == 401:
+            self._tokens.invalidate(account)
+
+    async def _drive_api(
+        self, url: str, params: dict, exclude: tuple = (), call: str = "api"
+    ) -> tuple[str, dict]:
+        # `call` names the public method this is made for in the metrics
+        account, token = await self._get_account_token(exclude)
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json",
+        }
+
+        self._scheduler.acquire(account)
+        started = time.perf_counter()
+        try:
+            res = await self._async_searcher(url=url, headers=headers, params=params)
+        except BaseException:
+            observe_drive(call, started, "error")
+            raise
+        finally:
+            self._scheduler.release(account)
+
+        error = (res or {}).get("error")
+        if isinstance(error, dict):
+            status = int(error.get("code") or 0)
+            self._report(account, status, json.dumps(error))
+        elif not error:
+            status = 200
+            self._report(account, status)
+        else:
+            status = "invalid"  # not json
+        observe_drive(call, started, status)
+        return account, res
+
+    @property
+    def index_enabled(self) -> bool:
+        return self.indexer.interval > 0
+
+    async def start_indexer(
+        self, popularity: Callable[[int], Awaitable[dict[str, int]]] = None
+    ) -> None:
+        if self.index_enabled:
+            self.indexer.popularity = popularity
+            await self.index.open()
+            try:
+                await self.sync.prime()
+            except Exception as err:
+                LOGGER.warning(f"Unable to get a changes start token: {err}")
+            await self.indexer.start()
+            await self.sync.start()
+
+    async def _index_ready(self) -> bool:
+        # search needs the whole tree, so only once a full crawl went through
+        if not self._index_complete and self.index_enabled:
+            self._index_complete = bool(
+                await self.index.get_state(Indexer.CRAWLED_KEY)
+            )
+        return self._index_complete
+
+    async def _invalidate(self, changes: list[tuple]) -> None:
+        # drops what the synced changes made stale in this worker's caches
+        renamed = False
+        for file_id, parents, changed_name in changes:
+            AsyncGoogleDriver._get_file_info.cache_delete(self, file_id)
+            for folder_id in (file_id, *parents):
+                AsyncGoogleDriver._list_all.cache_clear(tag=folder_id)
+            renamed = renamed or changed_name
+        if renamed:
+            AsyncGoogleDriver._search_drive.cache_clear()
+
+    async def close(self) -> None:
+        await self.prefetcher.stop()
+        await self.sync.stop()
+        await self.indexer.stop()
+        await self.index.close()
+        await self.chunk_cache.stop()
+        await self._tokens.stop()
+        await self._requests_sessions.close()
+        await self._stream_session.close()
+
+    async def _open_stream(
+        self, file_id: str, range_header: str = None
+    ) -> tuple[str, aiohttp.ClientResponse]:
+        url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&acknowledgeAbuse=true"
 
         headers = {}
 
@@ -191,42 +387,367 @@ class AsyncGoogleDriver:
             headers["Range"] = str(range_header)
 
         res = None
-        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+        account = None
+        tried = ()
         for i in range(3): # will use recursion in future rather than this ugly for loop
+            if res is not None:
+                res.release()
+                self._scheduler.release(account)
+                res = None
             try:
-                headers["Authorization"] = f"Bearer {await self._get_token()}"
-                res = await session.get(url, headers=headers)
+                account, token = await self._get_account_token(exclude=tried)
+                tried += (account,)
+                headers["Authorization"] = f"Bearer {token}"
+                self._scheduler.acquire(account)
+                started = time.perf_counter()
+                try:
+                    res = await self._stream_session.get(url, headers=headers)
+                except BaseException:  # cancelled included
+                    self._scheduler.release(account)
+                    observe_drive("stream_file", started, "error")
+                    raise
+                observe_drive("stream_file", started, res.status)
                 if res.status in (200, 206):
-                    break
+                    self._report(account, res.status)
+                    return account, res
+                self._report(account, res.status, await res.text())
             except Exception as err:
                 LOGGER.error(str(err))
 
-            if i >= 2:
-                if res is None:
-                    raise HTTPException(500, "Unknown error while contacting Google Drive")
+        if res is None:
+            raise HTTPException(500, "Unknown error while contacting Google Drive")
+
+        try:
+            if res.status == 404:
+                raise HTTPException(404, "File Not Found")
+
+            if res.status == 401:
+                raise HTTPException(401, "Token is expired!! Please check your authentications.")
+
+            if res.status == 429:
+                raise HTTPException(429, "Rate limit exceeded! use service accounts or add more to avoid this.")
+
+            details = await res.text()
+
+            if res.status == 403:
+                raise HTTPException(403, details)
+
+            raise HTTPException(res.status, details)
+        finally:
+            res.release()
+            self._scheduler.release(account)
+
+    @staticmethod
+    def _parse_range(range_header: str, file_size: int) -> tuple[int, int]:
+        # single "bytes=start-end" ranges only, anything else is left to google
+        if not range_header:
+            return 0, file_size - 1
+        match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", str(range_header))
+        if not match or not any(match.groups()):
+            return None
+        start, end = match.groups()
+        if not start:
+            start, end = max(0, file_size - int(end)), file_size - 1
+        else:
+            start, end = int(start), min(int(end), file_size - 1) if end else file_size - 1
+        if start > end or start >= file_size:
+            return None
+        return start, end
+
+    async def _cached_stream(
+        self, file_id: str, version: str, start: int, end: int, file_size: int
+    ):
+        # serves every chunk already on disk from there and fetches each run of
+        # missing chunks with one upstream request, storing them on the way if the
+        # file is hot enough
+        cache = self.chunk_cache
+        size = cache.chunk_size
+        index, last = start // size, end // size
+
+        while index <= last:
+            chunk_start = index * size
+            lo = max(start, chunk_start) - chunk_start
+            hi = min(end, chunk_start + size - 1) - chunk_start
+
+            if cache.has(file_id, version, index):
+                served = 0
+                try:
+                    async for data in cache.read(
+                        cache.path(file_id, version, index),
+                        lo,
+                        hi - lo + 1,
+                        min(size, file_size - chunk_start),
+                    ):
+                        served += len(data)
+                        yield data
+                    index += 1
+                    continue
+                except FileNotFoundError:
+                    # gone or cut short, the rest of it comes from drive
+                    start = chunk_start + lo + served
+
+            run_end = index
+            while run_end < last and not cache.has(file_id, version, run_end + 1):
+                run_end += 1
+
+            fetch_start = chunk_start
+            fetch_end = min((run_end + 1) * size, file_size) - 1
+            account, res = await self._open_stream(
+                file_id, f"bytes={fetch_start}-{fetch_end}"
+            )
+            sent = 0
+            writer = None
+            position = fetch_start
+            try:
+                async for data in res.content.iter_chunked(1024 * 1024):
+                    while data:
+                        index = position // size
+                        if writer is None:
+                            writer = cache.writer(file_id, version, index) or False
+                        take = min(len(data), (index + 1) * size - position)
+                        piece, data = data[:take], data[take:]
+                        if writer:
+                            await writer.write(piece)
+
+                        # the part the client asked for
+                        lo = max(start, position) - position
+                        hi = min(end + 1, position + take) - position
+                        if lo < hi:
+                            sent += hi - lo
+                            yield piece[lo:hi]
+
+                        position += take
+                        if position % size == 0 or position > fetch_end:
+                            if writer:
+                                await writer.commit()
+                            writer = None
+            finally:
+                if writer:
+                    writer.abort()
+                res.release()
+                self._scheduler.release(account, sent)
+
+            if position <= fetch_end:
+                raise RuntimeError(f"Upstream ended early while streaming {file_id}")
+            index = run_end + 1
 
-                if res.status == 404:
-                    raise HTTPException(404, "File Not Found")
-                
-                if res.status == 401:
-                    raise HTTPException(401, "Token is expired!! Please check your authentications.")
-                
-                if res.status == 429:
-                    raise HTTPException(429, "Rate limit exceeded! use service accounts or add more to avoid this.")
+    async def _fetch_segment(
+        self, file_id: str, start: int, end: int, out: asyncio.Queue
+    ) -> None:
+        # pushes the segment into `out` piece by piece, resumes from where it broke off
+        # if the connection drops midway
+        position, failures = start, 0
+        while position <= end:
+            account, res = await self._open_stream(file_id, f"bytes={position}-{end}")
+            sent, error = 0, None
+            try:
+                if res.status != 206:
+                    raise RuntimeError(f"Upstream ignored the range of {file_id}")
+                async for data in res.content.iter_chunked(256 * 1024):
+                    data = data[: end - position + 1]
+                    position += len(data)
+                    sent += len(data)
+                    out.put_nowait(data)
+                    if position > end:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = err
+            finally:
+                res.release()
+                self._scheduler.release(account, sent)
+            # one failure per attempt that didn't get to the end, broken off or cut short
+            if position <= end:
+                failures += 1
+                if failures > 2:
+                    if error:
+                        raise error
+                    raise RuntimeError(f"Upstream ended early while streaming {file_id}")
+                LOGGER.warning(
+                    f"Segment {start}-{end} of {file_id} broke off at {position}: "
+                    f"{error or 'connection closed'}"
+                )
+        out.put_nowait(None)
+
+    async def _parallel_stream(self, file_id: str, start: int, end: int):
+        # splits the range into segments fetched concurrently (each one picks its own
+        # account), at most `segments` of them are fetched / buffered at a time, so
+        # memory stays under segments * segment_size whatever the file size
+        size = self.segment_size
+        bounds = [(a, min(a + size - 1, end)) for a in range(start, end + 1, size)]
+        window = []  # (queue, task) in file order, the head is streamed as it arrives
+
+        def launch():
+            a, b = bounds.pop(0)
+            queue = asyncio.Queue()
+            task = asyncio.create_task(self._fetch_segment(file_id, a, b, queue))
+            # wakes the reader up if the fetch dies
+            task.add_done_callback(
+                lambda t: t.cancelled() or t.exception() is None or queue.put_nowait(None)
+            )
+            window.append((queue, task))
+
+        try:
+            while bounds and len(window) < max(1, self.segments):
+                launch()
+            while window:
+                queue, task = window[0]
+                while (data := await queue.get()) is not None:
+                    yield data
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception()
+                await task
+                window.pop(0)
+                if bounds:
+                    launch()
+        finally:
+            for _, task in window:
+                task.cancel()
+            for _, task in window:
+                try:
+                    await task
+                except BaseException:
+                    pass
+
+    def _stream_started(self) -> None:
+        self._streams += 1
+        if self._streams > self._peak_streams:
+            self._peak_streams = self._streams
+            stats = self.stream_stats()
+            LOGGER.info(
+                f"New peak of {stats['peakStreams']} concurrent streams, peak rss "
+                f"{stats['peakRss'] / 1048576:.1f} MiB "
+                f"({stats['peakRssPerStream'] / 1048576:.2f} MiB per stream)"
+            )
+
+    def _stream_finished(self) -> None:
+        self._streams -= 1
+
+    async def _counted(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        # every download counts towards the stream stats, cached, segmented or passed through
+        self._stream_started()
+        try:
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            self._stream_finished()
+
+    def stream_stats(self) -> dict:
+        rss = peak_rss()
+        return {
+            "activeStreams": self._streams,
+            "peakStreams": self._peak_streams,
+            "peakRss": rss,
+            "peakRssPerStream": rss // max(1, self._peak_streams),
+        }
+
+    async def stream_file(
+        self,
+        file_id: str,
+        file: dict,
+        range_header: int = 0,
+        client_ip: str = None,
+        on_sent: Callable[[int], None] = None,
+    ) -> StreamingResponse:
+        file_name = file["name"]
+        file_size = int(file.get("size", 0))
+        mime_type = (
+            file.get("mimeType")
+            or mimetypes.guess_type(file["name"])[0]
+            or "application/octet-stream"
+        )
+        version = file.get("modifiedTime")
 
-                details = await res.text()
+        byte_range = self._parse_range(range_header, file_size) if file_size else None
 
-                if res.status == 403:
-                    raise HTTPException(403, details)
+        content = None
+        if (
+            byte_range
+            and self.chunk_cache.enabled
+            and version
+            and (
+                self.chunk_cache.admits(file_id)
+                or self.chunk_cache.has_any(
+                    file_id,
+                    version,
+                    byte_range[0] // self.chunk_cache.chunk_size,
+                    byte_range[1] // self.chunk_cache.chunk_size,
+                )
+            )
+        ):
+            content = self._cached_stream(file_id, version, *byte_range, file_size)
+        elif (
+            byte_range
+            and self.segments > 1
+            and byte_range[1] - byte_range[0] + 1 >= 2 * self.segment_size
+        ):
+            content = self._parallel_stream(file_id, *byte_range)
 
-                if res.status not in (200, 206):
-                    raise HTTPException(res.status, details)
+        if content:
+            start, end = byte_range
+            response = StreamingResponse(
+                content=metered(
+                    self.shaper.shape(self._counted(content), client_ip), "file", on_sent
+                ),
+                media_type=mime_type,
+            )
+            response.headers["Content-Disposition"] = f'attachment; filename="{file_name}"'
+            response.headers["Content-Length"] = str(end - start + 1)
+            response.headers["Accept-Ranges"] = "bytes"
+            if range_header:
+                response.status_code = 206
+                response.headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            return response
+
+        account, res = await self._open_stream(file_id, range_header)
+        # the upstream can only be dropped and reopened later when we know the range
+        resumable = bool(byte_range) and self.pause_timeout > 0
 
         async def stream():
+            nonlocal account, res
+            loop = asyncio.get_running_loop()
+            sizer = ChunkSizer(max_size=self.max_chunk_size)
+            position, end = byte_range or (0, 0)
+            sent = 0  # over the current upstream connection
+            upstream = res
+            timer = None
+
+            def pause():
+                # the client stopped reading, don't keep a drive socket (and its
+                # buffers) open for it, we reopen from `position` once it's back
+                nonlocal upstream, sent
+                if upstream is not None:
+                    upstream.close()
+                    self._scheduler.release(account, sent)
+                    upstream, sent = None, 0
+
             try:
-                async for chunk in res.content.iter_chunked(1024 * 1024):
-                    if chunk:
-                        yield chunk
+                while True:
+                    if upstream is None:
+                        if position > end:
+                            break
+                        account, res = await self._open_stream(
+                            file_id, f"bytes={position}-{end}"
+                        )
+                        upstream = res
+                        if res.status != 206:
+                            raise RuntimeError(f"Upstream ignored the range of {file_id}")
+
+                    started = loop.time()
+                    chunk = await read_chunk(upstream.content, sizer.size)
+                    if not chunk:
+                        break
+                    sizer.upstream(len(chunk), loop.time() - started)
+                    sent += len(chunk)
+                    position += len(chunk)
+
+                    if resumable:
+                        timer = loop.call_later(self.pause_timeout, pause)
+                    handed = loop.time()
+                    yield chunk
+                    sizer.client(len(chunk), loop.time() - handed)
+                    if timer:
+                        timer.cancel()
             except Exception as e:
                 if isinstance(e, asyncio.CancelledError):
                     LOGGER.warning(
@@ -236,9 +757,19 @@ class AsyncGoogleDriver:
                     LOGGER.error(f"Stream error: {e}")
                 raise
             finally:
-                await session.close()
+                if timer:
+                    timer.cancel()
+                # hands the connection back to the pool (or drops it if the body wasn't fully read)
+                if upstream is not None:
+                    upstream.release()
+                    self._scheduler.release(account, sent)
 
-        response = StreamingResponse(content=stream(), media_type=mime_type)
+        response = StreamingResponse(
+            content=metered(
+                self.shaper.shape(self._counted(stream()), client_ip), "file", on_sent
+            ),
+            media_type=mime_type,
+        )
 
         response.headers["Content-Disposition"] = f'attachment; filename="{file_name}"'
 
@@ -255,38 +786,248 @@ class AsyncGoogleDriver:
 
         return response
 
-    @timed_cache(seconds=3600)  # 1hr is good for this as well
+    async def _list_children(self, folder_id: str, page_token: str = None) -> dict:
+        # big pages straight from the index / drive, the page caches are for browsing
+        if self.index_enabled and (not page_token or self.index.is_token(page_token)):
+            if page := await self.index.list_folder(folder_id, page_token, 1000):
+                return page
+            if page_token:
+                raise RuntimeError(f"{folder_id} left the index while being walked")
+        return await self._list_folder(folder_id, page_token, 1000)
+
+    async def _walk(self, folder_id: str, path: str) -> AsyncIterator[tuple[str, dict]]:
+        # depth first, only the current page of every level is held
+        page_token = None
+        while True:
+            page = await self._list_children(folder_id, page_token)
+            for item in page.get("files", []):
+                name = item.get("name", "").replace("/", "_")
+                if name in ("", ".", "..", ".password"):
+                    continue
+                mime_type = item.get("mimeType", "")
+                if mime_type == FOLDER_MIME_TYPE:
+                    yield f"{path}/{name}", item
+                    async for entry in self._walk(item["id"], f"{path}/{name}"):
+                        yield entry
+                # google docs have no content to download
+                elif not mime_type.startswith("application/vnd.google-apps."):
+                    yield f"{path}/{name}", item
+            if not (page_token := page.get("nextPageToken")):
+                return
+
+    async def stream_folder(
+        self,
+        folder_id: str,
+        folder: dict,
+        archive_format: str = "zip",
+        client_ip: str = None,
+        on_sent: Callable[[int], None] = None,
+    ) -> StreamingResponse:
+        """
+        The whole tree under the folder as a zip (zip64) or tar archive without
+        compression, built while it is sent. The walk runs ahead in the background and
+        the next `archive_parallel` files have their heads fetched while the current
+        one is written, memory stays the same whatever the size of the folder.
+        """
+        root = folder.get("name", "").replace("/", "_") or folder_id
+        writer = make_writer(archive_format)
+        read_ahead = self.archive_read_ahead
+
+        async def walk(entries: asyncio.Queue) -> None:
+            async for entry in self._walk(folder_id, root):
+                await entries.put(entry)
+            await entries.put(None)
+
+        def fetch_head(path: str, item: dict) -> tuple:
+            size = int(item.get("size") or 0)
+            queue, task = asyncio.Queue(), None
+            if item.get("mimeType") != FOLDER_MIME_TYPE and size:
+                task = asyncio.create_task(
+                    self._fetch_segment(item["id"], 0, min(size, read_ahead) - 1, queue)
+                )
+                # wakes the writer up if the fetch dies
+                task.add_done_callback(
+                    lambda t: t.cancelled() or t.exception() is None or queue.put_nowait(None)
+                )
+            return path, item, size, queue, task
+
+        async def write(path: str, item: dict, size: int, queue, task):
+            mtime = parse_time(item.get("modifiedTime"))
+            if item.get("mimeType") == FOLDER_MIME_TYPE:
+                yield writer.add_dir(path, mtime)
+                return
+            yield writer.start_file(path, size, mtime)
+            if task:
+                position = 0
+                while (data := await queue.get()) is not None:
+                    position += len(data)
+                    yield writer.write(data)
+                await task
+                if position < size:
+                    async with aclosing(
+                        self._parallel_stream(item["id"], position, size - 1)
+                    ) as rest:
+                        async for data in rest:
+                            yield writer.write(data)
+            try:
+                yield writer.end_file()
+            except ValueError as e:
+                # the tar header promised more, nothing sane can follow
+                raise RuntimeError(f"File {item['id']} at {e}") from e
+
+        async def stream():
+            entries = asyncio.Queue(256)
+            walker = asyncio.create_task(walk(entries))
+            window = deque()
+            try:
+                while True:
+                    entry = await entries.get()
+                    if entry is None:
+                        await walker  # raises what broke the walk
+                        break
+                    window.append(fetch_head(*entry))
+                    if len(window) <= self.archive_parallel:
+                        continue
+                    # kept in the window while written, so it's cancelled on disconnects
+                    async with aclosing(write(*window[0])) as chunks:
+                        async for data in chunks:
+                            yield data
+                    window.popleft()
+                while window:
+                    async with aclosing(write(*window[0])) as chunks:
+                        async for data in chunks:
+                            yield data
+                    window.popleft()
+                for data in writer.finish():
+                    yield data
+            except Exception as e:
+                if isinstance(e, asyncio.CancelledError):
+                    LOGGER.warning(f"Client disconnected while archiving {folder_id}")
+                else:
+                    LOGGER.error(f"Archive error for {folder_id}: {e}")
+                raise
+            finally:
+                tasks = [walker, *(entry[-1] for entry in window if entry[-1])]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        response = StreamingResponse(
+            content=metered(
+                self.shaper.shape(self._counted(stream()), client_ip), "archive", on_sent
+            ),
+            media_type=ARCHIVE_FORMATS[archive_format],
+        )
+        response.headers["Content-Disposition"] = (
+            f'attachment; filename="{root}.{archive_format}"'
+        )
+        return response
+
     async def get_file_info(self, file_id) -> dict:
+        if self.index_enabled and (file := await self.index.get(file_id)):
+            return file
+        return await self._get_file_info(file_id)
+
+    @timed_cache(
+        seconds=INFO_TTL,
+        maxsize=20000,
+        backend=METADATA_CACHE,
+        stale_while_revalidate=Var.CACHE_STALE_WHILE_REVALIDATE,
+        stale_if_error=Var.CACHE_STALE_IF_ERROR,
+        on_event=cache_hook("get_file_info"),
+    )
+    async def _get_file_info(self, file_id) -> dict:
 
         params = {
             "supportsAllDrives": "true",
             "fields": "id,name,mimeType,size,createdTime,modifiedTime,thumbnailLink,fileExtension",
         }
 
-        headers = {
-            "Authorization": f"Bearer {await self._get_token()}",
-            "Accept": "application/json",
-        }
-
+        tried = ()
         for i in range(3):
-            res = await self._async_searcher(
-                url=f"https://www.googleapis.com/drive/v3/files/{file_id}/",
-                headers=headers,
-                params=params,
+            account, res = await self._drive_api(
+                f"https://www.googleapis.com/drive/v3/files/{file_id}/",
+                params,
+                exclude=tried,
+                call="get_file_info",
             )
 
             if (res or {}).get("id"):
                 return res
+            tried += (account,)
 
         raise FailedToFetchFileInfo(details=res)
 
-    @timed_cache(seconds=300)  # 5 mins
     async def list_all(
         self,
         folder_id: str = Var.ROOT_FOLDER_ID,
         page_token: str = None,
         page_size: int = 50,
     ) -> dict:
+        if self.index_enabled and (not page_token or self.index.is_token(page_token)):
+            if (page := await self.index.list_folder(folder_id, page_token, page_size)):
+                return page
+            if page_token:
+                # the folder left the store since this token was handed out
+                page_token = None
+        page = await self._list_all(folder_id, page_token, page_size)
+        self._prefetch(folder_id, page_token, page, page_size)
+        return page
+
+    def _prefetch(
+        self, folder_id: str, page_token: str, page: dict, page_size: int
+    ) -> None:
+        # what browsing this page asks drive for next: /info + /dl of its files, the
+        # next page and the first page of its subfolders
+        if not self.prefetcher.enabled:
+            return
+        files = page.get("files", [])
+        self.prefetcher.schedule(
+            ("info", folder_id, page_token, page_size),
+            functools.partial(self._seed_file_info, files),
+            cost=0,
+        )
+        if next_token := page.get("nextPageToken"):
+            self.prefetcher.schedule(
+                ("list", folder_id, next_token, page_size),
+                functools.partial(self._warm_folder, folder_id, next_token, page_size),
+            )
+        subfolders = [f["id"] for f in files if f.get("mimeType") == FOLDER_MIME_TYPE]
+        for subfolder in subfolders[: self.prefetch_subfolders]:
+            self.prefetcher.schedule(
+                ("list", subfolder, None, page_size),
+                functools.partial(self._warm_folder, subfolder, None, page_size),
+            )
+
+    async def _warm_folder(
+        self, folder_id: str, page_token: str, page_size: int
+    ) -> None:
+        page = await self._list_all(folder_id, page_token, page_size)
+        await self._seed_file_info(page.get("files", []))
+
+    async def _seed_file_info(self, files: list[dict]) -> None:
+        # listings carry the same fields get_file_info asks drive for
+        for file in files:
+            await AsyncGoogleDriver._get_file_info.cache_set(file, self, file["id"])
+
+    @timed_cache(
+        seconds=LIST_TTL,
+        maxsize=4096,
+        max_memory=64 * 1024 * 1024,
+        backend=METADATA_CACHE,
+        tag_arg="folder_id",
+        stale_while_revalidate=Var.CACHE_STALE_WHILE_REVALIDATE,
+        stale_if_error=Var.CACHE_STALE_IF_ERROR,
+        on_event=cache_hook("list_all"),
+    )
+    async def _list_all(
+        self, folder_id: str, page_token: str = None, page_size: int = 50
+    ) -> dict:
+        return await self._list_folder(folder_id, page_token, page_size)
+
+    async def _list_folder(
+        self, folder_id: str, page_token: str = None, page_size: int = 50
+    ) -> dict:
 
         params = {
             "supportsAllDrives": "true",
@@ -304,20 +1045,18 @@ class AsyncGoogleDriver:
         if page_token:
             params["pageToken"] = page_token
 
-        headers = {
-            "Authorization": f"Bearer {await self._get_token()}",
-            "Accept": "application/json",
-        }
-
+        tried = ()
         for i in range(3):
-            res = await self._async_searcher(
-                url=f"https://www.googleapis.com/drive/v3/files/",
-                headers=headers,
-                params=params,
+            account, res = await self._drive_api(
+                "https://www.googleapis.com/drive/v3/files/",
+                params,
+                exclude=tried,
+                call="list_all",
             )
 
             if "files" in (res or {}):
                 return res
+            tried += (account,)
 
         raise FailedToFetchFilesTree(details=res)
 
@@ -329,9 +1068,25 @@ class AsyncGoogleDriver:
         result = re.sub(r'[,，|(){}]', ' ', result)
         return result.strip()
 
-    @timed_cache(seconds=300)  # 5mins
     async def search_files_in_drive(
         self, query: str, page_token=None, page_size=50
+    ) -> dict:
+        if (
+            (not page_token or self.index.is_token(page_token))
+            and await self._index_ready()
+        ):
+            return await self.index.search(query, page_token, page_size)
+        return await self._search_drive(query, page_token, page_size)
+
+    @timed_cache(
+        seconds=SEARCH_TTL,
+        maxsize=4096,
+        max_memory=64 * 1024 * 1024,
+        backend=METADATA_CACHE,
+        on_event=cache_hook("search_files_in_drive"),
+    )
+    async def _search_drive(
+        self, query: str, page_token=None, page_size=50
     ) -> dict:
         query = self._format_search_keyword(query)
         words = query.split()
@@ -356,22 +1111,20 @@ class AsyncGoogleDriver:
             "corpora": "allDrives",
         }
 
-        headers = {
-            "Authorization": f"Bearer {await self._get_token()}",
-            "Accept": "application/json",
-        }
-
         if page_token:
             params["pageToken"] = page_token
 
+        tried = ()
         for i in range(3):
-            res = await self._async_searcher(
-                url=f"https://www.googleapis.com/drive/v3/files/",
-                headers=headers,
-                params=params,
+            account, res = await self._drive_api(
+                "https://www.googleapis.com/drive/v3/files/",
+                params,
+                exclude=tried,
+                call="search_files_in_drive",
             )
 
             if "files" in (res or {}):
                 return res
+            tried += (account,)
 
         raise FailedToFetchSearchResult(details=res)
@@ -0,0 +1,247 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from libs.metrics import cache_hook
+
+from .utils import run_in_executor
+
+LOGGER = getLogger(__name__)
+
+
+class ChunkWriter:
+    # fills one chunk into a temp file, only visible to readers once committed
+
+    def __init__(self, cache: "ChunkCache", path: str):
+        self.cache = cache
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.{id(self)}.tmp"
+        self.size = 0
+        self._fd = None
+
+    async def write(self, data: bytes) -> None:
+        if self._fd is None:
+            self._fd = await run_in_executor(self._open)
+        await run_in_executor(os.write, self._fd, data)
+        self.size += len(data)
+
+    def _open(self) -> int:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return os.open(self.tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    async def commit(self) -> None:
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        self._fd = None
+        # atomic, so other workers either see the whole chunk or nothing
+        await run_in_executor(os.replace, self.tmp, self.path)
+        self.cache._add(self.path, self.size)
+
+    def abort(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class ChunkCache:
+    """
+    On-disk cache of fixed size file chunks keyed by (file_id, modifiedTime, chunk index).
+
+    Only files in the hot set (the top files by hotness from the download tracker) are
+    admitted, chunks of other files are evicted first and the rest goes least recently
+    used first once the cache grows past `max_bytes`. Every worker keeps its own view of
+    the directory and rescans it periodically, chunks removed by another worker simply
+    turn into misses.
+    """
+
+    def __init__(
+        self,
+        root: str = "cache/chunks",
+        max_bytes: int = 0,
+        chunk_size: int = 8 * 1024 * 1024,
+        hot_files: int = 100,
+        refresh_interval: int = 300,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.hot_files = hot_files
+        self.refresh_interval = refresh_interval
+
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._hot: set[str] = set()
+        self._task: asyncio.Task = None
+        self._record = cache_hook("chunks")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def start(
+        self, hot_source: Callable[[int], Awaitable[list[str]]] = None
+    ) -> None:
+        if not self.enabled or self._task:
+            return
+        await self._rescan()
+        self._task = asyncio.create_task(self._refresh_loop(hot_source))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self, hot_source) -> None:
+        while True:
+            if hot_source:
+                try:
+                    self._hot = set(await hot_source(self.hot_files))
+                except Exception as err:
+                    LOGGER.warning(f"Unable to refresh hot files: {err}")
+            await asyncio.sleep(self.refresh_interval)
+            await self._rescan()
+
+    async def _rescan(self) -> None:
+        entries = await run_in_executor(self._scan)
+        self._entries = OrderedDict((path, size) for _, path, size in entries)
+        self._size = sum(self._entries.values())
+        self._evict()
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        found = []
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".tmp"):
+                    # leftovers of a crashed worker
+                    if st.st_mtime < time.time() - 3600:
+                        os.remove(path)
+                    continue
+                found.append((st.st_atime, path, st.st_size))
+        return sorted(found)
+
+    def admits(self, file_id: str) -> bool:
+        return self.enabled and file_id in self._hot
+
+    def path(self, file_id: str, version: str, index: int) -> str:
+        version = hashlib.sha1(str(version).encode()).hexdigest()[:16]
+        return os.path.join(self.root, file_id, version, str(index))
+
+    def has(self, file_id: str, version: str, index: int) -> bool:
+        return self.path(file_id, version, index) in self._entries
+
+    def has_any(self, file_id: str, version: str, first: int, last: int) -> bool:
+        return any(self.has(file_id, version, i) for i in range(first, last + 1))
+
+    @staticmethod
+    def _open(path: str) -> tuple[int, int]:
+        fd = os.open(path, os.O_RDONLY)
+        return fd, os.fstat(fd).st_size
+
+    async def read(
+        self,
+        path: str,
+        offset: int,
+        length: int,
+        size: int = None,
+        piece: int = 1024 * 1024,
+    ) -> AsyncIterator[bytes]:
+        """
+        Yields `length` bytes of a chunk (`size` bytes long when given). A chunk that is
+        gone or turns out short (a worker killed mid-write, a full disk) is dropped and
+        raises FileNotFoundError, whatever was yielded before that is good.
+        """
+        try:
+            fd, actual = await run_in_executor(self._open, path)
+        except FileNotFoundError:
+            self._discard(path)
+            raise
+
+        try:
+            if actual < (size or offset + length):
+                raise FileNotFoundError(f"Chunk {path} is {actual} bytes long")
+            self._record("hits")
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            end = offset + length
+            while offset < end:
+                data = await run_in_executor(os.pread, fd, min(piece, end - offset), offset)
+                if not data:
+                    raise FileNotFoundError(f"Chunk {path} ended at {offset}")
+                offset += len(data)
+                yield data
+        except FileNotFoundError as err:
+            LOGGER.warning(f"Dropping a broken cache entry: {err}")
+            self._drop(path)
+            raise
+        finally:
+            os.close(fd)
+
+    def writer(self, file_id: str, version: str, index: int) -> Optional[ChunkWriter]:
+        self._record("misses")
+        if not self.admits(file_id):
+            return None
+        return ChunkWriter(self, self.path(file_id, version, index))
+
+    def _add(self, path: str, size: int) -> None:
+        self._discard(path)
+        self._entries[path] = size
+        self._size += size
+        self._evict()
+
+    def _discard(self, path: str) -> None:
+        if (size := self._entries.pop(path, None)) is not None:
+            self._size -= size
+
+    def _drop(self, path: str) -> None:
+        self._discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        if self._size <= self.max_bytes:
+            return
+        # chunks of files which fell out of the hot set go first, then plain lru
+        victims = [p for p in self._entries if self._file_id(p) not in self._hot]
+        victims += [p for p in self._entries if self._file_id(p) in self._hot]
+        for path in victims:
+            if self._size <= self.max_bytes:
+                break
+            self._record("evictions")
+            self._drop(path)
+
+    def _file_id(self, path: str) -> str:
+        return os.path.relpath(path, self.root).split(os.sep, 1)[0]
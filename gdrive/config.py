@@ -12,3 +12,91 @@ from decouple import config
 class Var:
     IS_SERVICE_ACCOUNT = config("IS_SERVICE_ACCOUNT", default=False, cast=bool)
     ROOT_FOLDER_ID = config("ROOT_FOLDER_ID")
+
+    # egress caps in MB/s, 0 disables a cap
+    SERVER_SIDE_SPEED = config("SERVER_SIDE_SPEED", default=25, cast=float)  # per download
+    SERVER_MAX_SPEED = config("SERVER_MAX_SPEED", default=0, cast=float)  # per worker
+    PER_IP_SPEED = config("PER_IP_SPEED", default=0, cast=float)  # per client ip
+
+    # upstream connection pools (per worker)
+    API_MAX_CONNECTIONS = config("API_MAX_CONNECTIONS", default=100, cast=int)
+    STREAM_MAX_CONNECTIONS = config("STREAM_MAX_CONNECTIONS", default=0, cast=int)
+    STREAM_MAX_CONNECTIONS_PER_HOST = config(
+        "STREAM_MAX_CONNECTIONS_PER_HOST", default=0, cast=int
+    )
+    UPSTREAM_KEEPALIVE = config("UPSTREAM_KEEPALIVE", default=75, cast=int)
+
+    # per stream buffering (KiB) and how long a stalled client may hold its drive socket
+    STREAM_READ_BUFFER = config("STREAM_READ_BUFFER", default=256, cast=int)
+    STREAM_MAX_CHUNK = config("STREAM_MAX_CHUNK", default=2048, cast=int)
+    STREAM_PAUSE_TIMEOUT = config("STREAM_PAUSE_TIMEOUT", default=20, cast=float)
+
+    # metadata cache shared between workers: memory (per worker), sqlite (per host) or redis
+    CACHE_BACKEND = config("CACHE_BACKEND", default="memory")
+    CACHE_DB_PATH = config("CACHE_DB_PATH", default="cache.db")
+    CACHE_REDIS_URL = config("CACHE_REDIS_URL", default="redis://127.0.0.1:6379/0")
+    # seconds an expired file info / folder page is still served while it's refreshed
+    # in the background, and while drive keeps failing to refresh it
+    CACHE_STALE_WHILE_REVALIDATE = config("CACHE_STALE_WHILE_REVALIDATE", default=300, cast=int)
+    CACHE_STALE_IF_ERROR = config("CACHE_STALE_IF_ERROR", default=3600, cast=int)
+
+    # access tokens shared by all workers on the host
+    TOKEN_CACHE_PATH = config("TOKEN_CACHE_PATH", default=".tokens.json")
+
+    # sign service account jwts in a small process pool instead of threads
+    JWT_PROCESS_POOL = config("JWT_PROCESS_POOL", default=False, cast=bool)
+
+    # local chunk cache for hot files, disabled while CHUNK_CACHE_SIZE is 0
+    CHUNK_CACHE_DIR = config("CHUNK_CACHE_DIR", default="cache/chunks")
+    CHUNK_CACHE_SIZE = config("CHUNK_CACHE_SIZE", default=0, cast=int)  # MiB
+    CHUNK_CACHE_CHUNK_SIZE = config("CHUNK_CACHE_CHUNK_SIZE", default=8, cast=int)  # MiB
+    CHUNK_CACHE_HOT_FILES = config("CHUNK_CACHE_HOT_FILES", default=100, cast=int)
+
+    # accelerated downloads, ranges of 2+ segments are fetched with this many parallel
+    # upstream requests (spread over the accounts), 0 or 1 keeps a single request
+    PARALLEL_SEGMENTS = config("PARALLEL_SEGMENTS", default=0, cast=int)
+    SEGMENT_SIZE = config("SEGMENT_SIZE", default=8, cast=int)  # MiB
+
+    # background indexer, mirrors the whole tree into a local store every
+    # INDEX_INTERVAL minutes (0 disables it)
+    INDEX_INTERVAL = config("INDEX_INTERVAL", default=0, cast=float)
+    INDEX_CONCURRENCY = config("INDEX_CONCURRENCY", default=4, cast=int)
+    INDEX_DB_PATH = config("INDEX_DB_PATH", default="index.db")
+    # seconds between polls of drive's changes feed while indexing, 0 disables it
+    SYNC_INTERVAL = config("SYNC_INTERVAL", default=10, cast=float)
+    # how much download counts lift local search results, 0 disables the boost
+    SEARCH_POPULARITY_WEIGHT = config("SEARCH_POPULARITY_WEIGHT", default=0.5, cast=float)
+
+    # background warming after a folder page was served from drive: file info of its
+    # items, its next page and the first page of PREFETCH_SUBFOLDERS subfolders.
+    # at most PREFETCH_CONCURRENCY jobs at once (0 disables it), PREFETCH_RATE drive calls/s
+    PREFETCH_CONCURRENCY = config("PREFETCH_CONCURRENCY", default=2, cast=int)
+    PREFETCH_RATE = config("PREFETCH_RATE", default=5, cast=float)
+    PREFETCH_SUBFOLDERS = config("PREFETCH_SUBFOLDERS", default=5, cast=int)
+
+    # folder downloads (/dl/<folder>?format=zip|tar): files fetched ahead of the one
+    # being written and how much of each (MiB), memory per download is about the product
+    ARCHIVE_PARALLEL = config("ARCHIVE_PARALLEL", default=4, cast=int)
+    ARCHIVE_READ_AHEAD = config("ARCHIVE_READ_AHEAD", default=4, cast=int)
+
+    # download / activity history: raw events older than TRACKER_RAW_RETENTION days are
+    # rolled up into hourly totals, those older than TRACKER_HOURLY_RETENTION into daily ones
+    TRACKER_RAW_RETENTION = config("TRACKER_RAW_RETENTION", default=7, cast=float)
+    TRACKER_HOURLY_RETENTION = config("TRACKER_HOURLY_RETENTION", default=90, cast=float)
+
+    # requests per minute a client ip may make to /dl, /search and /folders/list (0, the
+    # default, disables it), RATE_LIMIT_BURST of them at once. counted per worker (memory),
+    # per host (shared) or across hosts (redis, at CACHE_REDIS_URL). seeking / resuming
+    # range requests on /dl are counted per client and file
+    RATE_LIMIT = config("RATE_LIMIT", default=0, cast=float)
+    RATE_LIMIT_BURST = config("RATE_LIMIT_BURST", default=20, cast=int)
+    RATE_LIMIT_BACKEND = config("RATE_LIMIT_BACKEND", default="shared")
+    RATE_LIMIT_PATH = config("RATE_LIMIT_PATH", default=".ratelimit")
+    # proxies whose X-Forwarded-For names the client (comma separated ips / cidrs, "*" for
+    # the one in front whatever its address, as on heroku), otherwise every client has the
+    # proxy's ip for the rate limit, quotas and activity
+    TRUSTED_PROXIES = config("TRUSTED_PROXIES", default="")
+
+    # MiB a client ip may download over the last 24 hours, 0 disables it. checked when a
+    # download starts, so the one that crosses it still finishes
+    USER_DAILY_QUOTA = config("USER_DAILY_QUOTA", default=0, cast=float)
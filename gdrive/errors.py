@@ -18,3 +18,7 @@ class FailedToFetchFilesTree(DetailedException):
 
 class FailedToFetchSearchResult(DetailedException):
     pass
+
+
+class FailedToFetchChanges(DetailedException):
+    pass
@@ -0,0 +1,171 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import os
+import time
+from logging import getLogger
+from typing import Awaitable, Callable
+
+from libs.metadata_index import FOLDER_MIME_TYPE, MetadataIndex
+from libs.metrics import INDEX_CRAWLS, INDEX_ITEMS, INDEX_LAST_CRAWL
+
+from .tokens import _RecordLock
+
+LOGGER = getLogger(__name__)
+
+
+class Indexer:
+    """
+    Walks the whole tree under `root_id` every `interval` seconds and mirrors it into
+    the metadata index. Folders are listed by `concurrency` workers at a time, each one
+    written in its own transaction as soon as all of its pages are in.
+
+    Only one process on the host crawls (whoever holds the lock on `<db>.lock`),
+    the other workers just read the shared database.
+    """
+
+    # set once a crawl went through without failures
+    CRAWLED_KEY = "last_full_crawl"
+
+    def __init__(
+        self,
+        index: MetadataIndex,
+        get_info: Callable[[str], Awaitable[dict]],
+        list_page: Callable[..., Awaitable[dict]],
+        root_id: str,
+        interval: float = 3600,
+        concurrency: int = 4,
+        page_size: int = 1000,
+        popularity: Callable[[int], Awaitable[dict[str, int]]] = None,
+        popularity_weight: float = 0.5,
+        popularity_interval: float = 300,
+    ):
+        self.index = index
+        self._get_info = get_info
+        self._list_page = list_page
+        self.root_id = root_id
+        self.interval = interval
+        self.concurrency = concurrency
+        self.page_size = page_size
+        # download counts boosting search results
+        self.popularity = popularity
+        self.popularity_weight = popularity_weight
+        self.popularity_interval = popularity_interval
+
+        self._tasks: list[asyncio.Task] = []
+        self._lock_fd = None
+
+    async def start(self) -> None:
+        if self.interval <= 0 or self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._loop())]
+        if self.popularity and self.popularity_weight > 0:
+            self._tasks.append(asyncio.create_task(self._popularity_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def is_leader(self) -> bool:
+        if self._lock_fd is None:
+            self._lock_fd = os.open(
+                f"{self.index.db_path}.lock", os.O_RDWR | os.O_CREAT, 0o600
+            )
+        # kept for the life of the process once taken
+        return _RecordLock(self._lock_fd, 0, blocking=False).acquire()
+
+    async def _loop(self) -> None:
+        while True:
+            if self.is_leader():
+                try:
+                    await self.crawl()
+                except Exception as err:
+                    LOGGER.error(f"Indexing {self.root_id} failed: {err}")
+            await asyncio.sleep(self.interval)
+
+    async def _popularity_loop(self) -> None:
+        while True:
+            if self.is_leader():
+                try:
+                    await self.index.set_popularity(
+                        await self.popularity(10000), self.popularity_weight
+                    )
+                except Exception as err:
+                    LOGGER.warning(f"Unable to refresh search popularity: {err}")
+            await asyncio.sleep(self.popularity_interval)
+
+    async def _list_folder(self, folder_id: str) -> list[dict]:
+        children, page_token = [], None
+        while True:
+            page = await self._list_page(folder_id, page_token, self.page_size)
+            children += page.get("files", [])
+            if not (page_token := page.get("nextPageToken")):
+                return children
+
+    async def crawl(self) -> None:
+        started = time.time()
+        queue = asyncio.Queue()
+        failed = []
+        folders = files = 0
+
+        root = await self._get_info(self.root_id)
+        await self.index.put_file(root, None, "", started)
+        queue.put_nowait((self.root_id, ""))
+
+        async def worker():
+            nonlocal folders, files
+            while True:
+                folder_id, path = await queue.get()
+                try:
+                    children = await self._list_folder(folder_id)
+                    await self.index.put_folder(folder_id, children, path, started)
+                    folders += 1
+                    files += len(children)
+                    for child in children:
+                        if child.get("mimeType") == FOLDER_MIME_TYPE:
+                            queue.put_nowait((child["id"], f"{path}/{child['name']}"))
+                except Exception as err:
+                    failed.append(folder_id)
+                    LOGGER.warning(f"Unable to index folder {folder_id}: {err}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        # a partial crawl can't tell removed subtrees from unreached ones
+        removed = 0
+        if not failed:
+            removed = await self.index.prune(started)
+            await self.index.set_state(self.CRAWLED_KEY, str(started))
+
+        INDEX_CRAWLS.labels("partial" if failed else "complete").inc()
+        INDEX_ITEMS.labels("folders").set(folders)
+        INDEX_ITEMS.labels("files").set(files)
+        INDEX_LAST_CRAWL.set(started)
+        LOGGER.info(
+            f"Indexed {files} items in {folders} folders in {time.time() - started:.1f}s"
+            f" ({len(failed)} failed, {removed} removed)"
+        )
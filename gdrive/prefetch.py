@@ -0,0 +1,114 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import Awaitable, Callable, Hashable
+
+from libs.bandwidth import TokenBucket
+from libs.metrics import PREFETCH_JOBS
+
+LOGGER = getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Runs cache warming jobs in the background, strictly second to real requests.
+
+    At most `concurrency` jobs run at once, so they never hold more than that many of
+    the api connections, and the drive calls they make are paid for from a token
+    bucket refilled at `rate` calls per second. Whatever can't be run soon is dropped
+    rather than queued up: a full queue, throttled accounts (`is_busy`) or a job seen
+    in the last `dedupe_ttl` seconds all skip it.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 2,
+        rate: float = 5,
+        burst: float = None,
+        max_pending: int = 256,
+        dedupe_ttl: float = 60,
+        is_busy: Callable[[], bool] = None,
+    ):
+        self.concurrency = concurrency
+        self.dedupe_ttl = dedupe_ttl
+        self._is_busy = is_busy or (lambda: False)
+        self._budget = TokenBucket(rate, burst if burst is not None else max(rate, 1))
+        self._queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self._recent: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def start(self) -> None:
+        if self.enabled and not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+            ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _seen(self, key: Hashable, now: float) -> bool:
+        while self._recent:
+            oldest, at = next(iter(self._recent.items()))
+            if now - at < self.dedupe_ttl:
+                break
+            del self._recent[oldest]
+        if key in self._recent:
+            return True
+        self._recent[key] = now
+        return False
+
+    def schedule(
+        self, key: Hashable, job: Callable[[], Awaitable], cost: int = 1
+    ) -> bool:
+        """
+        Queues `job` (making about `cost` drive calls) unless it ran recently or there
+        is no room for it, returns whether it was queued.
+        """
+        if not self._tasks or self._seen(key, time.monotonic()):
+            return False
+        try:
+            self._queue.put_nowait((job, cost))
+        except asyncio.QueueFull:
+            self._recent.pop(key, None)
+            PREFETCH_JOBS.labels("dropped").inc()
+            return False
+        PREFETCH_JOBS.labels("scheduled").inc()
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            job, cost = await self._queue.get()
+            try:
+                if cost:
+                    await self._budget.consume(cost)
+                    # checked once its turn came, the budget wait can be long
+                    if self._is_busy():
+                        PREFETCH_JOBS.labels("dropped").inc()
+                        continue
+                await job()
+                PREFETCH_JOBS.labels("done").inc()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                PREFETCH_JOBS.labels("failed").inc()
+                LOGGER.debug(f"Prefetch failed: {err}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,166 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import math
+import random
+import time
+from logging import getLogger
+
+from libs.metrics import (
+    ACCOUNT_BYTES,
+    ACCOUNT_COOLDOWN,
+    ACCOUNT_INFLIGHT,
+    ACCOUNT_RATE_LIMITS,
+    ACCOUNT_REQUESTS,
+)
+
+LOGGER = getLogger(__name__)
+
+# reasons google uses for per account quota/rate limits (403 or 429)
+RATE_LIMIT_REASONS = (
+    "ratelimitexceeded",
+    "userratelimitexceeded",
+    "quotaexceeded",
+    "downloadquotaexceeded",
+    "dailylimitexceeded",
+    "sharingratelimitexceeded",
+)
+
+
+def is_rate_limited(status: int, details: str = "") -> bool:
+    if status == 429:
+        return True
+    if status == 403 and details:
+        details = details.lower()
+        return any(reason in details for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+class AccountState:
+    __slots__ = (
+        "name",
+        "inflight",
+        "strikes",
+        "cooldown_until",
+        "_load",
+        "_updated",
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.inflight = 0
+        self.strikes = 0
+        self.cooldown_until = 0.0
+        # exponentially decayed recent work (requests + MiBs served)
+        self._load = 0.0
+        self._updated = time.monotonic()
+
+    def recent_load(self, now: float, half_life: float) -> float:
+        self._load *= math.pow(0.5, (now - self._updated) / half_life)
+        self._updated = now
+        return self._load
+
+
+class AccountScheduler:
+    """
+    Routes each api call / stream to the least loaded healthy account.
+
+    Load is what the account is doing right now (in flight requests and streams) plus a
+    decayed history of requests and bytes served. Accounts that hit rate limits are
+    benched with an exponential backoff (base_cooldown, doubled per consecutive strike
+    up to max_cooldown) and come back automatically once it runs out.
+    """
+
+    def __init__(
+        self,
+        base_cooldown: float = 30,
+        max_cooldown: float = 1800,
+        half_life: float = 60,
+        inflight_weight: float = 10,
+    ):
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.half_life = half_life
+        self.inflight_weight = inflight_weight
+        self._accounts: dict[str, AccountState] = {}
+
+    def set_accounts(self, accounts: list[str]) -> None:
+        self._accounts = {
+            name: self._accounts.get(name) or AccountState(name) for name in accounts
+        }
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    def _score(self, state: AccountState, now: float) -> float:
+        return state.inflight * self.inflight_weight + state.recent_load(
+            now, self.half_life
+        )
+
+    def pick(self, exclude: tuple = ()) -> str:
+        if not self._accounts:
+            raise RuntimeError("No accounts to schedule")
+
+        now = time.monotonic()
+        candidates = [s for n, s in self._accounts.items() if n not in exclude] or list(
+            self._accounts.values()
+        )
+        healthy = [s for s in candidates if s.cooldown_until <= now]
+        if not healthy:
+            # everyone is throttled, the one which recovers first is the best bet
+            return min(candidates, key=lambda s: s.cooldown_until).name
+
+        best = min(self._score(s, now) for s in healthy)
+        return random.choice(
+            [s for s in healthy if self._score(s, now) <= best + 1e-9]
+        ).name
+
+    def acquire(self, account: str) -> None:
+        if state := self._accounts.get(account):
+            state.inflight += 1
+            ACCOUNT_INFLIGHT.labels(account).inc()
+            ACCOUNT_REQUESTS.labels(account).inc()
+            state.recent_load(time.monotonic(), self.half_life)
+            state._load += 1
+
+    def release(self, account: str, bytes_served: int = 0) -> None:
+        if state := self._accounts.get(account):
+            if state.inflight:
+                state.inflight -= 1
+                ACCOUNT_INFLIGHT.labels(account).dec()
+            self.add_bytes(account, bytes_served)
+
+    def add_bytes(self, account: str, bytes_served: int) -> None:
+        if bytes_served and (state := self._accounts.get(account)):
+            ACCOUNT_BYTES.labels(account).inc(bytes_served)
+            state.recent_load(time.monotonic(), self.half_life)
+            state._load += bytes_served / (1024 * 1024)
+
+    def report(self, account: str, status: int, details: str = "") -> None:
+        if not (state := self._accounts.get(account)):
+            return
+        if is_rate_limited(status, details):
+            ACCOUNT_RATE_LIMITS.labels(account).inc()
+            state.strikes += 1
+            cooldown = min(
+                self.max_cooldown, self.base_cooldown * 2 ** (state.strikes - 1)
+            )
+            state.cooldown_until = time.monotonic() + cooldown
+            ACCOUNT_COOLDOWN.labels(account).set(time.time() + cooldown)
+            LOGGER.warning(
+                f"{account} is rate limited ({status}), benched for {int(cooldown)}s"
+            )
+        elif status < 400:
+            state.strikes = 0
+
+    def throttled(self) -> bool:
+        """Whether any account is benched, i.e. quota is getting tight."""
+        now = time.monotonic()
+        return any(s.cooldown_until > now for s in self._accounts.values())
@@ -0,0 +1,87 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+from logging import getLogger
+
+import aiohttp
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+LOGGER = getLogger(__name__)
+
+
+class ChunkSizer:
+    """
+    Picks the chunk size of a stream from what the slower side can move in `target`
+    seconds: the client's drain rate (how long a yielded chunk takes to be taken) or the
+    upstream's throughput. Fast lan clients end up with big chunks and few iterations,
+    slow mobile ones with small chunks so little data sits around waiting for them.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 64 * 1024,
+        max_size: int = 2 * 1024 * 1024,
+        initial: int = 256 * 1024,
+        target: float = 0.05,
+        smoothing: float = 0.3,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target = target
+        self.smoothing = smoothing
+        self.size = initial
+        self._client = None
+        self._upstream = None
+
+    def _average(self, current: float, rate: float) -> float:
+        if current is None:
+            return rate
+        return current + self.smoothing * (rate - current)
+
+    def _resize(self) -> None:
+        rates = [r for r in (self._client, self._upstream) if r]
+        if not rates:
+            return
+        size = int(min(rates) * self.target) // self.min_size * self.min_size
+        self.size = max(self.min_size, min(self.max_size, size))
+
+    def upstream(self, nbytes: int, seconds: float) -> None:
+        if nbytes:
+            self._upstream = self._average(self._upstream, nbytes / max(seconds, 1e-4))
+            self._resize()
+
+    def client(self, nbytes: int, seconds: float) -> None:
+        if nbytes:
+            self._client = self._average(self._client, nbytes / max(seconds, 1e-4))
+            self._resize()
+
+
+async def read_chunk(content: aiohttp.StreamReader, size: int) -> bytes:
+    # fills up to `size` bytes, aiohttp hands out whatever arrived so far otherwise
+    parts, got = [], 0
+    while got < size:
+        data = await content.read(size - got)
+        if not data:
+            break
+        parts.append(data)
+        got += len(data)
+    return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes, 0 where unknown."""
+    if not resource:
+        return 0
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
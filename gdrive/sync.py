@@ -0,0 +1,218 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import json
+import time
+from logging import getLogger
+from typing import Awaitable, Callable
+
+from libs.metadata_index import FIELDS, MetadataIndex
+from libs.metrics import CHANGES_APPLIED, CHANGES_LAST_POLL, CHANGES_POLLS
+
+from .errors import FailedToFetchChanges
+
+LOGGER = getLogger(__name__)
+
+
+class ChangesFeed:
+    """Source of drive's changes feed, `DriveChangesFeed` in production."""
+
+    async def start_token(self) -> str:
+        raise NotImplementedError
+
+    async def page(self, page_token: str) -> dict:
+        """One page of changes.list, with `nextPageToken` or `newStartPageToken`."""
+        raise NotImplementedError
+
+
+class DriveChangesFeed(ChangesFeed):
+    def __init__(self, drive_api: Callable[..., Awaitable[tuple[str, dict]]]):
+        self._drive_api = drive_api
+
+    async def _call(self, url: str, params: dict, key: str) -> dict:
+        tried = ()
+        for i in range(3):
+            account, res = await self._drive_api(
+                url, params, exclude=tried, call="changes"
+            )
+            if key in (res or {}):
+                return res
+            tried += (account,)
+        raise FailedToFetchChanges(details=res)
+
+    async def start_token(self) -> str:
+        res = await self._call(
+            "https://www.googleapis.com/drive/v3/changes/startPageToken",
+            {"supportsAllDrives": "true"},
+            "startPageToken",
+        )
+        return res["startPageToken"]
+
+    async def page(self, page_token: str) -> dict:
+        params = {
+            "pageToken": page_token,
+            "pageSize": 1000,
+            "includeRemoved": "true",
+            "includeItemsFromAllDrives": "true",
+            "supportsAllDrives": "true",
+            "spaces": "drive",
+            "fields": (
+                "nextPageToken, newStartPageToken, changes(fileId, removed, "
+                f"file({','.join(FIELDS)},parents,trashed))"
+            ),
+        }
+        return await self._call(
+            "https://www.googleapis.com/drive/v3/changes", params, "changes"
+        )
+
+
+class ReplayFeed(ChangesFeed):
+    """
+    Replays recorded changes.list pages, for tests and local runs without drive.
+    Tokens are just page numbers, `push` appends what a later poll should see.
+    """
+
+    def __init__(self, pages: list[list[dict]] = None):
+        self.pages = [list(changes) for changes in pages or []]
+        self.requests = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> "ReplayFeed":
+        # one json list of changes per line
+        with open(path, "r", encoding="utf-8") as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def push(self, *changes: dict) -> None:
+        self.pages.append(list(changes))
+
+    async def start_token(self) -> str:
+        return str(len(self.pages))
+
+    async def page(self, page_token: str) -> dict:
+        self.requests += 1
+        index = int(page_token)
+        if index >= len(self.pages):
+            return {"changes": [], "newStartPageToken": str(index)}
+        res = {"changes": self.pages[index]}
+        if index + 1 < len(self.pages):
+            res["nextPageToken"] = str(index + 1)
+        else:
+            res["newStartPageToken"] = str(index + 1)
+        return res
+
+
+class ChangesSync:
+    """
+    Keeps the metadata index fresh from drive's changes feed instead of full crawls.
+
+    The worker holding the indexer lock polls the feed every `interval` seconds, from a
+    page token stored in the index so restarts resume where they stopped, and applies
+    the changes to the index in one transaction per page. Every worker (the poller
+    included) tails the change log in the index every `tail_interval` seconds and hands
+    the affected file / parent ids to `on_change`, to drop its own cached entries.
+    """
+
+    TOKEN_KEY = "changes_page_token"
+
+    def __init__(
+        self,
+        index: MetadataIndex,
+        feed: ChangesFeed,
+        is_leader: Callable[[], bool],
+        on_change: Callable[[list[tuple]], Awaitable[None]] = None,
+        interval: float = 10,
+        tail_interval: float = 2,
+    ):
+        self.index = index
+        self.feed = feed
+        self._is_leader = is_leader
+        self._on_change = on_change
+        self.interval = interval
+        self.tail_interval = tail_interval
+
+        self._seq = 0
+        self._tasks: list[asyncio.Task] = []
+
+    async def prime(self) -> None:
+        """Takes a start token before the first crawl, so nothing done meanwhile is missed."""
+        if self._is_leader() and not await self.index.get_state(self.TOKEN_KEY):
+            await self.index.set_state(self.TOKEN_KEY, await self.feed.start_token())
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._seq = await self.index.last_change()
+        self._tasks = [asyncio.create_task(self._tail_loop())]
+        if self.interval > 0:
+            self._tasks.append(asyncio.create_task(self._poll_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    async def poll(self) -> int:
+        """Applies everything the feed has since the stored token, returns the count."""
+        token = await self.index.get_state(self.TOKEN_KEY)
+        if not token:
+            await self.prime()
+            return 0
+
+        applied = 0
+        while token:
+            page = await self.feed.page(token)
+            if "changes" not in page:
+                raise RuntimeError(f"Bad changes page: {page}")
+            if page["changes"]:
+                applied += len(
+                    await self.index.apply_changes(page["changes"], time.time())
+                )
+            token = page.get("nextPageToken")
+            # stored after every page, so a crash replays at most one page
+            await self.index.set_state(
+                self.TOKEN_KEY, token or page.get("newStartPageToken")
+            )
+
+        CHANGES_POLLS.inc()
+        CHANGES_APPLIED.inc(applied)
+        CHANGES_LAST_POLL.set(time.time())
+        return applied
+
+    async def tail(self) -> int:
+        changes = await self.index.changes_since(self._seq)
+        if changes:
+            self._seq = changes[-1][0]
+            if self._on_change:
+                await self._on_change([change[1:] for change in changes])
+        return len(changes)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            if self._is_leader():
+                try:
+                    await self.poll()
+                except Exception as err:
+                    LOGGER.warning(f"Polling drive changes failed: {err}")
+            await asyncio.sleep(self.interval)
+
+    async def _tail_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.tail_interval)
+            try:
+                while await self.tail():
+                    pass
+            except Exception as err:
+                LOGGER.warning(f"Reading the change log failed: {err}")
@@ -0,0 +1,255 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import json
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from logging import getLogger
+from typing import Awaitable, Callable
+
+try:
+    import fcntl
+except ImportError:  # windows, tokens are then only shared inside the process
+    fcntl = None
+
+LOGGER = getLogger(__name__)
+
+
+class _RecordLock:
+    # exclusive posix record lock on a single byte of the lock file
+
+    def __init__(self, fd: int, slot: int, blocking: bool = True):
+        self.fd, self.slot, self.blocking = fd, slot, blocking
+
+    def acquire(self) -> bool:
+        if not fcntl:
+            return True
+        flags = fcntl.LOCK_EX | (0 if self.blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.lockf(self.fd, flags, 1, self.slot)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+
+    def release(self) -> None:
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.slot)
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class TokenBroker:
+    """
+    Shares access tokens between every worker on the host through a json file.
+
+    Each account gets its own byte range lock in `<cache_path>.lock`, so only one
+    process mints a given account's token while the others wait for (or simply pick up)
+    the result. A background task refreshes tokens `refresh_margin` seconds before
+    they expire, so requests never wait on the oauth endpoint once warmed up.
+    """
+
+    # byte 0 of the lock file guards the json file itself, accounts hash above it
+    _LOCK_SLOTS = 65536
+
+    def __init__(
+        self,
+        mint: Callable[[str], Awaitable[tuple[str, float]]],
+        cache_path: str = ".tokens.json",
+        refresh_margin: int = 600,
+        check_interval: int = 30,
+        concurrency: int = 8,
+    ):
+        self._mint = mint
+        self.cache_path = cache_path
+        self.lock_path = f"{cache_path}.lock"
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self.concurrency = concurrency
+
+        self._tokens: dict[str, tuple[str, float]] = {}
+        self._mtime = None
+        self._accounts: list[str] = []
+        self._account_locks: dict[str, asyncio.Lock] = {}
+        # record locks are held by the process, not the task, these keep the tasks of this
+        # one apart on each slot (accounts can share one) and on the file
+        self._slot_locks: dict[int, asyncio.Lock] = {}
+        self._save_lock = asyncio.Lock()
+        self._refresher: asyncio.Task = None
+        self._fd = None
+        self._fd_pid = None
+
+    async def start(self, accounts: list[str]) -> None:
+        self._accounts = list(accounts)
+        if self._accounts and not self._refresher:
+            self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._refresher:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+        if self._fd is not None and self._fd_pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    async def get(self, account: str) -> str:
+        if token := self._fresh(account, 60):
+            return token
+        self._load()
+        if token := self._fresh(account, 60):
+            return token
+        return await self._refresh(account, 60)
+
+    def invalidate(self, account: str) -> None:
+        self._tokens.pop(account, None)
+
+    def _fresh(self, account: str, margin: float) -> str:
+        if entry := self._tokens.get(account):
+            token, expires_at = entry
+            if expires_at - time.time() > margin:
+                return token
+
+    def _read(self) -> dict:
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _merge(self, data: dict) -> None:
+        for account, (token, expires_at) in data.items():
+            if expires_at > self._tokens.get(account, ("", 0))[1]:
+                self._tokens[account] = (token, expires_at)
+
+    def _load(self) -> None:
+        try:
+            mtime = os.stat(self.cache_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+
+        try:
+            data = self._read()
+        except (OSError, ValueError) as err:
+            LOGGER.warning(f"Unable to read shared tokens: {err}")
+            return
+
+        self._mtime = mtime
+        self._merge(data)
+
+    async def _save(self) -> None:
+        # the file lock can be held by another worker, so it's waited for off the loop
+        tokens = dict(self._tokens)
+        async with self._save_lock:
+            data, mtime = await asyncio.get_running_loop().run_in_executor(
+                None, self._write, tokens
+            )
+        self._merge(data)
+        self._mtime = mtime
+
+    def _write(self, tokens: dict) -> tuple[dict, int]:
+        # read-modify-write under the file lock, replaced atomically so readers never
+        # see a half written file
+        with _RecordLock(self._lock_fd(), 0):
+            try:
+                data = self._read()
+            except FileNotFoundError:
+                data = {}
+            except (OSError, ValueError) as err:
+                LOGGER.warning(f"Unable to read shared tokens, rewriting them: {err}")
+                data = {}
+            now = time.time()
+            for account, entry in tokens.items():
+                if entry[1] > data.get(account, ("", 0))[1]:
+                    data[account] = entry
+            data = {a: e for a, e in data.items() if e[1] > now}
+            tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.cache_path)
+            return data, os.stat(self.cache_path).st_mtime_ns
+
+    def _lock_fd(self) -> int:
+        # posix record locks belong to the process and die with any fd closed on the
+        # file, so every process keeps exactly one fd open for its whole life
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def _slot(self, account: str) -> int:
+        return 1 + zlib.crc32(account.encode()) % self._LOCK_SLOTS
+
+    @asynccontextmanager
+    async def _account_lock(self, account: str, blocking: bool = True):
+        slot = self._slot(account)
+        local = self._slot_locks.setdefault(slot, asyncio.Lock())
+        if not blocking and local.locked():
+            yield False
+            return
+        async with local:
+            # polls instead of blocking in lockf, minting elsewhere takes a few hundred ms at most
+            lock = _RecordLock(self._lock_fd(), slot, blocking=False)
+            while not lock.acquire():
+                if not blocking:
+                    yield False
+                    return
+                await asyncio.sleep(0.05)
+            try:
+                yield True
+            finally:
+                lock.release()
+
+    async def _refresh(self, account: str, margin: float, blocking: bool = True) -> str:
+        local = self._account_locks.setdefault(account, asyncio.Lock())
+        async with local:
+            if token := self._fresh(account, margin):
+                return token
+            async with self._account_lock(account, blocking) as locked:
+                if not locked:
+                    return None
+                # someone else may have refreshed it while we waited for the lock
+                self._load()
+                if token := self._fresh(account, margin):
+                    return token
+                token, expires_at = await self._mint(account)
+                self._tokens[account] = (token, expires_at)
+                await self._save()
+                return token
+
+    async def _refresh_loop(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh(account):
+            async with semaphore:
+                try:
+                    await self._refresh(account, self.refresh_margin, blocking=False)
+                except Exception as err:
+                    LOGGER.warning(f"Failed to refresh token of {account}: {err}")
+
+        while True:
+            self._load()
+            await asyncio.gather(
+                *[
+                    refresh(account)
+                    for account in self._accounts
+                    if not self._fresh(account, self.refresh_margin)
+                ]
+            )
+            await asyncio.sleep(self.check_interval)
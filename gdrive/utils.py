@@ -7,8 +7,19 @@
 
 import asyncio
 import multiprocessing
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial, wraps
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
+
+import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+# shared by every run_async call of the worker, created on first use and
+# shut down from the app lifespan (see shutdown_executors)
+_thread_pool: ThreadPoolExecutor = None
+_process_pool: ProcessPoolExecutor = None
+
+MAX_THREADS = min(32, multiprocessing.cpu_count() * 5)
+MAX_PROCESSES = min(4, multiprocessing.cpu_count())
 
 
 def hbs(size):
@@ -23,13 +34,55 @@ def hbs(size):
     return str(round(size, 2)) + " " + dict_power_n[raised_to_pow] + "B"
 
 
+def get_executor(process: bool = False) -> Executor:
+    global _thread_pool, _process_pool
+
+    if process:
+        if _process_pool is None:
+            # spawn, forking a process that runs an event loop and threads isn't safe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=MAX_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _process_pool
+
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=MAX_THREADS, thread_name_prefix="run_async"
+        )
+    return _thread_pool
+
+
+def shutdown_executors(wait: bool = True) -> None:
+    global _thread_pool, _process_pool
+
+    for pool in (_thread_pool, _process_pool):
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
+    _thread_pool = _process_pool = None
+
+
+async def run_in_executor(function, *args, process: bool = False, **kwargs):
+    # process=True needs a picklable (module level, undecorated) function and arguments
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(process), partial(function, *args, **kwargs)
+    )
+
+
+@lru_cache(maxsize=1024)
+def _load_private_key(private_key: str):
+    # parsing (and validating) the pem costs far more than signing, do it once per key
+    return load_pem_private_key(private_key.encode(), password=None)
+
+
+def sign_jwt(payload: dict, private_key: str) -> str:
+    return jwt.encode(payload, _load_private_key(private_key), algorithm="RS256")
+
+
 # thanks to github.com/TeamUltroid/pyUltroid for the below function under AGPLv3 license
 def run_async(function):
     @wraps(function)
     async def wrapper(*args, **kwargs):
-        return await asyncio.get_event_loop().run_in_executor(
-            ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() * 5),
-            partial(function, *args, **kwargs),
-        )
+        return await run_in_executor(function, *args, **kwargs)
 
     return wrapper
@@ -0,0 +1,32 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# picked up by gunicorn from the working directory, the rest of the settings are
+# passed on the command line (run.sh / Procfile)
+
+import os
+import shutil
+
+from decouple import config
+
+# every worker keeps its metrics in files here so /metrics can add them all up.
+# set before the app is imported (--preload imports it right after this file)
+# and emptied once per start, the samples of a previous run would count again.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = config("METRICS_DIR", default=".metrics")
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def child_exit(server, worker):
+    # drops the dead worker's active stream gauges
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,238 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# archives written front to back as they are sent, nothing is ever seeked back to.
+# both writers only hand out bytes: add_dir / start_file / write / end_file for every
+# entry in order, then whatever finish() yields.
+
+import struct
+import tarfile
+import time
+import zlib
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import Iterator
+
+ARCHIVE_FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+
+
+def parse_time(value: str) -> float:
+    """Drive's rfc 3339 timestamps to epoch seconds, now if missing."""
+    if not value:
+        return time.time()
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def make_writer(archive_format: str):
+    return ZipWriter() if archive_format == "zip" else TarWriter()
+
+
+class ZipWriter:
+    """
+    ZIP64 in store mode. Every entry has a data descriptor, so sizes and crcs come
+    after the data, and zip64 fields throughout, so neither file sizes nor the archive
+    size are limited to 4 GiB. The central directory is spooled to disk past 1 MiB,
+    memory stays the same whatever the number of entries.
+    """
+
+    _UNKNOWN = 0xFFFFFFFF
+    # data descriptor + utf-8 names
+    _FLAGS = 0x0808
+    _VERSION = 45  # zip64
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = 0
+        self._central = SpooledTemporaryFile(max_size=1024 * 1024)
+        self._entry = None  # name, dos time, header offset, crc, size
+
+    @staticmethod
+    def _dos_time(mtime: float) -> tuple[int, int]:
+        t = time.gmtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1  # 1980-01-01
+        return (
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+        )
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def _local_header(self, name: bytes, dos_time: tuple[int, int]) -> bytes:
+        # sizes are in the data descriptor, the zip64 extra only says they are 64 bit
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        return (
+            struct.pack(
+                "<IHHHHHIIIHH",
+                0x04034B50,
+                self._VERSION,
+                self._FLAGS,
+                0,  # stored
+                *dos_time,
+                0,
+                self._UNKNOWN,
+                self._UNKNOWN,
+                len(name),
+                len(extra),
+            )
+            + name
+            + extra
+        )
+
+    def _record(
+        self,
+        name: bytes,
+        dos_time: tuple[int, int],
+        offset: int,
+        crc: int,
+        size: int,
+        mode: int,
+    ) -> None:
+        extra = struct.pack("<HHQQQ", 0x0001, 24, size, size, offset)
+        self._central.write(
+            struct.pack(
+                "<IHHHHHHIIIHHHHHII",
+                0x02014B50,
+                (3 << 8) | self._VERSION,  # made on unix, so the mode is honoured
+                self._VERSION,
+                self._FLAGS,
+                0,
+                *dos_time,
+                crc,
+                self._UNKNOWN,
+                self._UNKNOWN,
+                len(name),
+                len(extra),
+                0,
+                0,
+                0,
+                mode << 16,
+                self._UNKNOWN,
+            )
+            + name
+            + extra
+        )
+        self.entries += 1
+
+    def add_dir(self, path: str, mtime: float) -> bytes:
+        name = (path.rstrip("/") + "/").encode()
+        dos_time = self._dos_time(mtime)
+        offset = self.offset
+        data = self._local_header(name, dos_time) + struct.pack(
+            "<IIQQ", 0x08074B50, 0, 0, 0
+        )
+        self._record(name, dos_time, offset, 0, 0, 0o40755)
+        return self._emit(data)
+
+    def start_file(self, path: str, size: int, mtime: float) -> bytes:
+        name = path.encode()
+        dos_time = self._dos_time(mtime)
+        self._entry = [name, dos_time, self.offset, 0, 0]
+        return self._emit(self._local_header(name, dos_time))
+
+    def write(self, data: bytes) -> bytes:
+        self._entry[3] = zlib.crc32(data, self._entry[3])
+        self._entry[4] += len(data)
+        return self._emit(data)
+
+    def end_file(self) -> bytes:
+        name, dos_time, offset, crc, size = self._entry
+        self._entry = None
+        self._record(name, dos_time, offset, crc, size, 0o100644)
+        return self._emit(struct.pack("<IIQQ", 0x08074B50, crc, size, size))
+
+    def finish(self, block_size: int = 256 * 1024) -> Iterator[bytes]:
+        start, size = self.offset, self._central.tell()
+        self._central.seek(0)
+        try:
+            while data := self._central.read(block_size):
+                yield self._emit(data)
+        finally:
+            self._central.close()
+        end = self.offset
+        yield self._emit(
+            struct.pack(
+                "<IQHHIIQQQQ",
+                0x06064B50,
+                44,  # size of the rest of this record
+                (3 << 8) | self._VERSION,
+                self._VERSION,
+                0,
+                0,
+                self.entries,
+                self.entries,
+                size,
+                start,
+            )
+            + struct.pack("<IIQI", 0x07064B50, 0, end, 1)
+            + struct.pack(
+                "<IHHHHIIH",
+                0x06054B50,
+                0,
+                0,
+                0xFFFF,
+                0xFFFF,
+                self._UNKNOWN,
+                self._UNKNOWN,
+                0,
+            )
+        )
+
+
+class TarWriter:
+    """
+    POSIX (pax) tar, long names and sizes past 8 GiB get extended headers. Sizes have
+    to be known up front here, a file that turns out longer is cut and one that turns
+    out shorter raises in end_file, padding it would hand out a corrupt file.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._remaining = 0
+        self._size = 0
+        self._path = None
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    @staticmethod
+    def _header(path: str, kind: bytes, size: int, mtime: float, mode: int) -> bytes:
+        info = tarfile.TarInfo(path)
+        info.type = kind
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = mode
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def add_dir(self, path: str, mtime: float) -> bytes:
+        return self._emit(self._header(path.rstrip("/"), tarfile.DIRTYPE, 0, mtime, 0o755))
+
+    def start_file(self, path: str, size: int, mtime: float) -> bytes:
+        self._remaining = self._size = size
+        self._path = path
+        return self._emit(self._header(path, tarfile.REGTYPE, size, mtime, 0o644))
+
+    def write(self, data: bytes) -> bytes:
+        if len(data) > self._remaining:
+            data = data[: self._remaining]
+        self._remaining -= len(data)
+        return self._emit(data)
+
+    def end_file(self) -> bytes:
+        if self._remaining:
+            raise ValueError(f"{self._path} is {self._remaining} bytes short of {self._size}")
+        return self._emit(b"\0" * (-self._size % tarfile.BLOCKSIZE))
+
+    def finish(self) -> Iterator[bytes]:
+        end = self.offset + 2 * tarfile.BLOCKSIZE
+        yield self._emit(b"\0" * (2 * tarfile.BLOCKSIZE + (-end % tarfile.RECORDSIZE)))
@@ -0,0 +1,130 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import time
+from typing import AsyncIterator
+
+
+class TokenBucket:
+    """
+    Token bucket where callers reserve what they are about to send and sleep off their
+    debt, so nobody polls and waiters are served in the order they asked (fifo).
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        """Takes `amount` tokens and returns how long to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def refund(self, amount: int) -> None:
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + amount)
+
+    async def consume(self, amount: int) -> None:
+        if wait := self.reserve(amount):
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # never sent, give it back to the others
+                self.refund(amount)
+                raise
+
+
+class BandwidthShaper:
+    """
+    Caps egress at three levels, every stream goes through all of them in this order:
+    its own bucket (`per_stream`), the bucket of its client ip (`per_ip`) and the one
+    shared by the whole process (`total`). Rates are in bytes per second, 0 disables a level.
+
+    Streams reserve one chunk at a time and only ask for the next chunk after the
+    previous one went out, so under a saturated total cap the chunks of concurrent
+    downloads interleave round robin and each gets an equal share.
+    """
+
+    def __init__(
+        self,
+        total: float = 0,
+        per_stream: float = 0,
+        per_ip: float = 0,
+        burst: float = 0.25,
+        quantum: int = 256 * 1024,
+    ):
+        self.total = total
+        self.per_stream = per_stream
+        self.per_ip = per_ip
+        # bucket sizes in seconds worth of traffic
+        self.burst = burst
+        # bigger chunks are sent in pieces of this size, keeps the pacing smooth
+        self.quantum = quantum
+
+        self._global = TokenBucket(total, total * burst)
+        self._ips: dict[str, list] = {}  # ip -> [bucket, active streams]
+        self.active_streams = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.total or self.per_stream or self.per_ip)
+
+    def _ip_bucket(self, ip: str) -> TokenBucket:
+        if ip not in self._ips:
+            self._ips[ip] = [TokenBucket(self.per_ip, self.per_ip * self.burst), 0]
+        self._ips[ip][1] += 1
+        return self._ips[ip][0]
+
+    def _release_ip(self, ip: str) -> None:
+        if entry := self._ips.get(ip):
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._ips[ip]
+
+    async def shape(
+        self, chunks: AsyncIterator[bytes], ip: str = None
+    ) -> AsyncIterator[bytes]:
+        if not self.enabled:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        stream = TokenBucket(self.per_stream, self.per_stream * self.burst)
+        buckets = [stream]
+        if self.per_ip and ip:
+            buckets.append(self._ip_bucket(ip))
+        buckets.append(self._global)
+
+        self.active_streams += 1
+        try:
+            async for chunk in chunks:
+                for i in range(0, len(chunk), self.quantum):
+                    piece = chunk[i : i + self.quantum] if len(chunk) > self.quantum else chunk
+                    # one after the other, so a stream held back by its own cap doesn't
+                    # hold a place in the shared buckets meanwhile
+                    for bucket in buckets:
+                        await bucket.consume(len(piece))
+                    yield piece
+        finally:
+            self.active_streams -= 1
+            if self.per_ip and ip:
+                self._release_ip(ip)
+            # closes the upstream generator right away on client disconnects
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
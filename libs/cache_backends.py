@@ -0,0 +1,320 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# shared storages for libs.time_cache, so every gunicorn worker on a host (or every host
+# with redis) hits the same cached drive payloads. values have to be json serializable.
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from typing import Any, Tuple
+from urllib.parse import unquote, urlparse
+
+from libs.time_cache import CacheBackend
+
+LOGGER = getLogger(__name__)
+
+
+class _SharedBackend(CacheBackend):
+    shared = True
+    # lookups go over the network or to disk, only async functions are cached
+    supports_sync = False
+
+    def make_key(self, namespace: str, key: Tuple, tag: str = None) -> str:
+        # args are plain ids/tokens/ints here, so their repr is stable across processes
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        # tagged keys share a "namespace:tag:" prefix, so a tag is cleared by prefix
+        return f"{namespace}:{digest}" if tag is None else f"{namespace}:{tag}:{digest}"
+
+    @staticmethod
+    def _prefix(namespace: str, tag: str) -> str:
+        return f"{namespace}:" if tag is None else f"{namespace}:{tag}:"
+
+    @staticmethod
+    def _dumps(expires_at: float, value: Any) -> str:
+        return json.dumps([expires_at, value], separators=(",", ":"))
+
+    @staticmethod
+    def _loads(raw, now: float) -> Tuple[bool, Any]:
+        expires_at, value = json.loads(raw)
+        if now < expires_at:
+            return True, value
+        return False, None
+
+    async def aclear(self, namespace: str = None, tag: str = None) -> None:
+        raise NotImplementedError
+
+    def clear(self, namespace: str = None, tag: str = None) -> None:
+        task = asyncio.get_running_loop().create_task(self.aclear(namespace, tag))
+        self._clears.add(task)
+        task.add_done_callback(self._cleared)
+
+    def _cleared(self, task: asyncio.Task) -> None:
+        self._clears.discard(task)
+        if not task.cancelled() and task.exception():
+            LOGGER.warning(f"Cache clear failed: {task.exception()}")
+
+
+class SQLiteBackend(_SharedBackend):
+    """
+    On-disk store shared by every worker on the host. Lookups are single indexed
+    reads on a WAL database, still they run in a thread since a checkpoint or another
+    worker's sweep can hold them up to busy_timeout. Errors (a database that stays
+    busy included) are misses, a write then just doesn't cache the value this time.
+    """
+
+    def __init__(self, db_path: str = "cache.db", sweep_interval: float = 300):
+        self.db_path = db_path
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        # a connection per executor thread, so one waiting on a busy database doesn't
+        # hold up the others
+        self._local = threading.local()
+        self._clears: set = set()  # running clear() calls, kept so they aren't collected
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def _conn(self) -> sqlite3.Connection:
+        local = self._local
+        # connections must not cross a fork (gunicorn --preload imports before forking)
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.db_path, isolation_level=None)
+            db.execute("PRAGMA busy_timeout = 200")
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache (expires_at)"
+            )
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def get(self, key: str, now: float) -> Tuple[bool, Any]:
+        try:
+            row = (
+                self._conn()
+                .execute("SELECT value FROM cache WHERE key = ?", (key,))
+                .fetchone()
+            )
+        except sqlite3.Error as err:
+            LOGGER.warning(f"Cache read failed: {err}")
+            return False, None
+        return self._loads(row[0], now) if row else (False, None)
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        try:
+            db = self._conn()
+            db.execute(
+                "INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, expires_at, self._dumps(expires_at, value)),
+            )
+            now = time.time()
+            if now - self.last_sweep >= self.sweep_interval:
+                self.last_sweep = now
+                db.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        except sqlite3.Error as err:
+            LOGGER.warning(f"Cache write failed: {err}")
+
+    def delete(self, key: str) -> None:
+        try:
+            self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+        except sqlite3.Error as err:
+            LOGGER.warning(f"Cache delete failed: {err}")
+
+    def _clear(self, namespace: str = None, tag: str = None) -> None:
+        try:
+            if namespace is None:
+                self._conn().execute("DELETE FROM cache")
+            else:
+                prefix = self._prefix(namespace, tag)
+                self._conn().execute(
+                    "DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+                )
+        except sqlite3.Error as err:
+            LOGGER.warning(f"Cache clear failed: {err}")
+
+    async def aget(self, key: str, now: float) -> Tuple[bool, Any]:
+        return await self._run(self.get, key, now)
+
+    async def aset(self, key: str, value: Any, expires_at: float) -> None:
+        await self._run(self.set, key, value, expires_at)
+
+    async def adelete(self, key: str) -> None:
+        await self._run(self.delete, key)
+
+    async def aclear(self, namespace: str = None, tag: str = None) -> None:
+        await self._run(self._clear, namespace, tag)
+
+    def info(self, namespace: str = None) -> dict:
+        try:
+            (size,) = (
+                self._conn()
+                .execute(
+                    "SELECT COUNT(*) FROM cache WHERE substr(key, 1, ?) = ?",
+                    (len(namespace) + 1, f"{namespace}:"),
+                )
+                .fetchone()
+                if namespace
+                else self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()
+            )
+        except sqlite3.Error as err:
+            LOGGER.warning(f"Cache info failed: {err}")
+            return {}
+        return {"size": size}
+
+
+class RedisBackend(_SharedBackend):
+    """
+    Minimal RESP client (GET/SET PX/DEL/SCAN) over a single asyncio connection, enough for
+    caching without pulling in a redis dependency. Works with anything speaking the
+    redis protocol (redis, valkey, keydb, dragonfly ...). Errors are treated as misses.
+    """
+
+    def __init__(
+        self,
+        url: str = "redis://127.0.0.1:6379/0",
+        prefix: str = "gdm:",
+        timeout: float = 2.0,
+    ):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._lock: asyncio.Lock = None
+        self._owner = None
+        self._clears: set = set()  # running clear() calls, kept so they aren't collected
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            auth = (self.username, self.password) if self.username else (self.password,)
+            await self._roundtrip("AUTH", *auth)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    def _disconnect(self) -> None:
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _roundtrip(self, *args) -> Any:
+        payload = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            payload.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._writer.write(b"".join(payload))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("redis closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            if int(rest) < 0:
+                return None
+            data = await self._reader.readexactly(int(rest) + 2)
+            return data[:-2]
+        if kind == b"*":
+            if int(rest) < 0:
+                return None
+            return [await self._read_reply() for _ in range(int(rest))]
+        raise RuntimeError(f"unexpected redis reply: {line!r}")
+
+    async def execute(self, *args) -> Any:
+        # one connection per process and event loop, commands are serialized on it
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._owner != owner:
+            self._owner, self._lock = owner, asyncio.Lock()
+            self._reader = self._writer = None
+
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await asyncio.wait_for(self._connect(), self.timeout)
+                return await asyncio.wait_for(self._roundtrip(*args), self.timeout)
+            except (OSError, ConnectionError, asyncio.TimeoutError, EOFError):
+                # the stream is in an unknown state now, start over next time
+                self._disconnect()
+                raise
+
+    async def aget(self, key: str, now: float) -> Tuple[bool, Any]:
+        try:
+            raw = await self.execute("GET", self.prefix + key)
+        except Exception as err:
+            LOGGER.warning(f"Cache read failed: {err}")
+            return False, None
+        return self._loads(raw, now) if raw is not None else (False, None)
+
+    async def aset(self, key: str, value: Any, expires_at: float) -> None:
+        ttl_ms = int((expires_at - time.time()) * 1000)
+        if ttl_ms <= 0:
+            return
+        try:
+            await self.execute(
+                "SET", self.prefix + key, self._dumps(expires_at, value), "PX", ttl_ms
+            )
+        except Exception as err:
+            LOGGER.warning(f"Cache write failed: {err}")
+
+    async def adelete(self, key: str) -> None:
+        try:
+            await self.execute("DEL", self.prefix + key)
+        except Exception as err:
+            LOGGER.warning(f"Cache delete failed: {err}")
+
+    async def aclear(self, namespace: str = None, tag: str = None) -> None:
+        prefix = self._prefix(namespace, tag) if namespace else ""
+        # glob characters in ids/namespaces must match literally
+        prefix = re.sub(r"([*?\[\]\\])", r"\\\1", prefix)
+        pattern = f"{self.prefix}{prefix}*"
+        cursor = "0"
+        while True:
+            cursor, keys = await self.execute("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            if keys:
+                await self.execute("DEL", *keys)
+            cursor = cursor.decode() if isinstance(cursor, bytes) else cursor
+            if cursor == "0":
+                break
+
+
+def make_cache_backend(name: str, db_path: str = None, url: str = None) -> CacheBackend:
+    """Backend for CACHE_BACKEND, None means the default per-process memory store."""
+    name = (name or "memory").strip().lower()
+    if name == "memory":
+        return None
+    if name == "sqlite":
+        return SQLiteBackend(db_path or "cache.db")
+    if name == "redis":
+        return RedisBackend(url or "redis://127.0.0.1:6379/0")
+    raise ValueError(f"Unknown cache backend: {name}")
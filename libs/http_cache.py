@@ -0,0 +1,77 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# validators and freshness headers for conditional requests (rfc 9110 / 9111)
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+
+def body_etag(body: bytes) -> str:
+    """Strong etag of a response body."""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def file_etag(file: dict) -> str:
+    """Strong etag of a file's content, which drive only changes along with these."""
+    key = f"{file.get('id')}:{file.get('modifiedTime')}:{file.get('size')}"
+    return f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+
+def http_date(value: str) -> str:
+    """Drive's rfc 3339 timestamps as an http date, None if missing."""
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return format_datetime(moment.astimezone(timezone.utc), usegmt=True)
+
+
+def cache_control(max_age: int, stale_while_revalidate: int = 0, stale_if_error: int = 0) -> str:
+    directives = ["public", f"max-age={max_age}"]
+    if stale_while_revalidate:
+        directives.append(f"stale-while-revalidate={stale_while_revalidate}")
+    if stale_if_error:
+        directives.append(f"stale-if-error={stale_if_error}")
+    return ", ".join(directives)
+
+
+def none_match(if_none_match: str, etag: str) -> bool:
+    """Whether If-None-Match lists `etag` (weak comparison, as the rfc says for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def not_modified_since(if_modified_since: str, last_modified: str) -> bool:
+    if not (if_modified_since and last_modified):
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(
+            if_modified_since
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def range_applies(if_range: str, etag: str, last_modified: str) -> bool:
+    """
+    Whether a Range is to be honoured given If-Range: only if the client's copy is
+    still current, otherwise it gets the whole representation.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag  # strong comparison
+    return bool(last_modified) and if_range == last_modified
@@ -0,0 +1,582 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import base64
+import json
+import math
+import re
+import unicodedata
+from difflib import get_close_matches
+from logging import getLogger
+
+from libs.sqlite_pool import SQLitePool
+
+LOGGER = getLogger(__name__)
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# drive field name -> column
+FIELDS = {
+    "id": "id",
+    "name": "name",
+    "mimeType": "mime_type",
+    "size": "size",
+    "createdTime": "created_time",
+    "modifiedTime": "modified_time",
+    "thumbnailLink": "thumbnail_link",
+    "fileExtension": "file_extension",
+}
+
+_COLUMNS = ", ".join(FIELDS.values())
+
+_EXTRA_COLUMNS = ("parent", "path", "rank", "sort_name", "crawled_at")
+
+# keeps the rowid of existing rows, the search tables are keyed on it
+_UPSERT = (
+    f"INSERT INTO files ({_COLUMNS}, {', '.join(_EXTRA_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * (len(FIELDS) + len(_EXTRA_COLUMNS)))}) "
+    "ON CONFLICT(id) DO UPDATE SET "
+    + ", ".join(
+        f"{column} = excluded.{column}"
+        for column in (*list(FIELDS.values())[1:], *_EXTRA_COLUMNS)
+    )
+)
+
+# left out of search results, like drive search did
+_UNSEARCHABLE = (
+    "application/vnd.google-apps.shortcut",
+    "application/vnd.google-apps.document",
+    "application/vnd.google-apps.spreadsheet",
+    "application/vnd.google-apps.form",
+    "application/vnd.google-apps.site",
+)
+
+
+
+def _searchable(row: str) -> str:
+    mime_types = ", ".join(f"'{mime_type}'" for mime_type in _UNSEARCHABLE)
+    return (
+        f"{row}.mime_type NOT IN ({mime_types}) AND {row}.name IS NOT '.password'"
+    )
+
+
+# everything below folder ?1 with its path under the path ?2, walked by id since
+# names may contain "/" too. stops at the folder itself, should a batch of changes
+# leave a loop behind for a moment
+_SUBTREE = """
+WITH RECURSIVE subtree (id, path) AS (
+    SELECT id, ?2 || '/' || COALESCE(name, '') FROM files WHERE parent = ?1
+    UNION ALL
+    SELECT files.id, subtree.path || '/' || COALESCE(files.name, '')
+    FROM files JOIN subtree ON files.parent = subtree.id
+    WHERE files.id != ?1
+)
+"""
+
+# store page tokens are told apart from drive ones by this prefix
+TOKEN_PREFIX = "idx:"
+
+
+class MetadataIndex:
+    """
+    Local copy of the drive tree (the same fields get_file_info asks drive for) that
+    the background indexer keeps up to date. Folders are listed in drive's
+    "folder, name" order with keyset pagination, so every page is a single index
+    range scan however deep into a big folder it is.
+
+    A folder is only served from here once it was listed completely (see `folders`),
+    callers fall back to drive for everything else.
+    """
+
+    def __init__(self, db_path: str = "index.db"):
+        self.db_path = db_path
+        self._pool = SQLitePool(db_path)
+
+    async def open(self) -> None:
+        await self._pool.open()
+        async with self._pool.write() as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    parent TEXT,
+                    name TEXT,
+                    mime_type TEXT,
+                    size TEXT,
+                    created_time TEXT,
+                    modified_time TEXT,
+                    thumbnail_link TEXT,
+                    file_extension TEXT,
+                    path TEXT,
+                    rank INTEGER,
+                    sort_name TEXT,
+                    crawled_at REAL
+                )
+                """
+            )
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS folders (
+                    id TEXT PRIMARY KEY,
+                    crawled_at REAL
+                )
+                """
+            )
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            # changes applied by the synchronizer, every worker tails this to drop the
+            # cache entries they affect
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_id TEXT,
+                    parents TEXT,
+                    renamed INTEGER,
+                    applied_at REAL
+                )
+                """
+            )
+            # keyset listing, folders (rank 0) first then by name like drive does
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_files_listing ON files (parent, rank, sort_name, id)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_files_crawled_at ON files (crawled_at)"
+            )
+
+            # full text search over names and paths, follows `files` through triggers
+            # and shares its rowids. only what search may return is indexed, so the
+            # ranking never has to look at `files`
+            cursor = await db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'search_words'"
+            )
+            backfill = await cursor.fetchone() is None
+            await db.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS search_words USING fts5(
+                    name, path, tokenize = 'unicode61 remove_diacritics 2'
+                )
+                """
+            )
+            # words seen in names, typos are corrected against them. only ever grows,
+            # a stale term just corrects to nothing
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS search_terms (term TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            # search ranking boost from download counts, see set_popularity
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS popularity (file_rowid INTEGER PRIMARY KEY, boost REAL)"
+            )
+            await db.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+                    INSERT INTO search_words (rowid, name, path)
+                    SELECT new.rowid, new.name, new.path WHERE {_searchable("new")};
+                END
+                """
+            )
+            await db.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+                    DELETE FROM search_words WHERE rowid = old.rowid;
+                    DELETE FROM popularity WHERE file_rowid = old.rowid;
+                END
+                """
+            )
+            await db.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS files_search_update
+                AFTER UPDATE OF name, path, mime_type ON files
+                WHEN old.name IS NOT new.name OR old.path IS NOT new.path
+                    OR old.mime_type IS NOT new.mime_type BEGIN
+                    DELETE FROM search_words WHERE rowid = old.rowid;
+                    INSERT INTO search_words (rowid, name, path)
+                    SELECT new.rowid, new.name, new.path WHERE {_searchable("new")};
+                END
+                """
+            )
+            if backfill:
+                await db.execute(
+                    f"""
+                    INSERT INTO search_words (rowid, name, path)
+                    SELECT rowid, name, path FROM files WHERE {_searchable("files")}
+                    """
+                )
+                cursor = await db.execute("SELECT name FROM files")
+                await self._add_terms(db, [row[0] for row in await cursor.fetchall()])
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    @staticmethod
+    def _row(file: dict, parent: str, path: str, crawled_at: float) -> tuple:
+        is_folder = file.get("mimeType") == FOLDER_MIME_TYPE
+        return (
+            *(file.get(field) for field in FIELDS),
+            parent,
+            path,
+            0 if is_folder else 1,
+            (file.get("name") or "").lower(),
+            crawled_at,
+        )
+
+    @staticmethod
+    def _file(row: tuple) -> dict:
+        # same shape drive returns, missing fields are left out
+        return {
+            field: value for field, value in zip(FIELDS, row) if value is not None
+        }
+
+    @staticmethod
+    def encode_token(*key) -> str:
+        raw = json.dumps(key, separators=(",", ":")).encode()
+        return TOKEN_PREFIX + base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_token(token: str) -> list:
+        raw = token[len(TOKEN_PREFIX) :]
+        return json.loads(base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)))
+
+    @staticmethod
+    def is_token(token: str) -> bool:
+        return bool(token) and token.startswith(TOKEN_PREFIX)
+
+    async def get(self, file_id: str) -> dict:
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                f"SELECT {_COLUMNS} FROM files WHERE id = ?", (file_id,)
+            )
+            row = await cursor.fetchone()
+        return self._file(row) if row else None
+
+    async def list_folder(
+        self, folder_id: str, page_token: str = None, page_size: int = 50
+    ) -> dict:
+        """A page of a completely listed folder, or None if the store can't answer it."""
+        after = None
+        if page_token:
+            rank, sort_name, file_id = self.decode_token(page_token)
+            after = int(rank), str(sort_name), str(file_id)
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                "SELECT 1 FROM folders WHERE id = ?", (folder_id,)
+            )
+            if await cursor.fetchone() is None:
+                return None
+            if after:
+                cursor = await db.execute(
+                    f"""
+                    SELECT {_COLUMNS}, rank, sort_name FROM files
+                    WHERE parent = ? AND (rank, sort_name, id) > (?, ?, ?)
+                    ORDER BY rank, sort_name, id LIMIT ?
+                    """,
+                    (folder_id, *after, page_size + 1),
+                )
+            else:
+                cursor = await db.execute(
+                    f"""
+                    SELECT {_COLUMNS}, rank, sort_name FROM files
+                    WHERE parent = ? ORDER BY rank, sort_name, id LIMIT ?
+                    """,
+                    (folder_id, page_size + 1),
+                )
+            rows = await cursor.fetchall()
+
+        page = {"files": [self._file(row) for row in rows[:page_size]]}
+        if len(rows) > page_size:
+            last = rows[page_size - 1]
+            page["nextPageToken"] = self.encode_token(last[-2], last[-1], last[0])
+        return page
+
+    async def put_folder(
+        self,
+        folder_id: str,
+        children: list[dict],
+        path: str,
+        crawled_at: float,
+    ) -> None:
+        """Replaces the listing of `folder_id` with `children` in one transaction."""
+        rows = [
+            self._row(child, folder_id, f"{path}/{child.get('name', '')}", crawled_at)
+            for child in children
+        ]
+        async with self._pool.write() as db:
+            await db.executemany(
+                _UPSERT,
+                rows,
+            )
+            await self._add_terms(db, [child.get("name") for child in children])
+            # whatever drive didn't list this time is gone from the folder
+            await db.execute(
+                "DELETE FROM files WHERE parent = ? AND crawled_at < ?",
+                (folder_id, crawled_at),
+            )
+            await db.execute(
+                "INSERT OR REPLACE INTO folders (id, crawled_at) VALUES (?, ?)",
+                (folder_id, crawled_at),
+            )
+
+    async def put_file(
+        self, file: dict, parent: str = None, path: str = "", crawled_at: float = 0
+    ) -> None:
+        async with self._pool.write() as db:
+            await db.execute(
+                _UPSERT,
+                self._row(file, parent, path, crawled_at),
+            )
+            await self._add_terms(db, [file.get("name")])
+
+    async def prune(self, crawled_before: float) -> int:
+        """Drops everything a complete crawl didn't reach, i.e. removed subtrees."""
+        async with self._pool.write() as db:
+            cursor = await db.execute(
+                "DELETE FROM files WHERE crawled_at < ?", (crawled_before,)
+            )
+            await db.execute(
+                "DELETE FROM folders WHERE crawled_at < ?", (crawled_before,)
+            )
+            return cursor.rowcount
+
+    async def get_state(self, key: str) -> str:
+        async with self._pool.read() as db:
+            cursor = await db.execute("SELECT value FROM state WHERE key = ?", (key,))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: str, value: str) -> None:
+        async with self._pool.write() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    @staticmethod
+    async def _remove(db, file_id: str, folder: bool) -> None:
+        if folder:
+            # the whole subtree goes with a folder
+            await db.execute(
+                _SUBTREE + "DELETE FROM folders WHERE id IN (SELECT id FROM subtree)",
+                (file_id, ""),
+            )
+            await db.execute(
+                _SUBTREE + "DELETE FROM files WHERE id IN (SELECT id FROM subtree)",
+                (file_id, ""),
+            )
+        await db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        await db.execute("DELETE FROM folders WHERE id = ?", (file_id,))
+
+    async def apply_changes(self, changes: list[dict], applied_at: float) -> list[tuple]:
+        """
+        Applies entries of drive's changes feed (file needs `parents` and `trashed`)
+        in one transaction and logs them. Items outside the indexed tree are ignored,
+        items moved out of it are dropped. Returns the logged (file_id, parents, renamed).
+        """
+        logged = []
+        async with self._pool.write() as db:
+            for change in changes:
+                file_id = change.get("fileId") or (change.get("file") or {}).get("id")
+                file = change.get("file") or {}
+                if not file_id:
+                    continue
+
+                cursor = await db.execute(
+                    "SELECT parent, path, name, rank FROM files WHERE id = ?", (file_id,)
+                )
+                old = await cursor.fetchone()
+                old_parent, old_path, old_name, old_rank = old or (None, None, None, 1)
+
+                parent = path = None
+                if not change.get("removed") and not file.get("trashed"):
+                    for candidate in file.get("parents") or []:
+                        cursor = await db.execute(
+                            "SELECT path FROM files WHERE id = ? AND rank = 0",
+                            (candidate,),
+                        )
+                        if row := await cursor.fetchone():
+                            parent, path = candidate, f"{row[0]}/{file.get('name', '')}"
+                            break
+
+                if parent is None:
+                    if old is None:
+                        continue  # never was in the tree
+                    await self._remove(db, file_id, old_rank == 0)
+                else:
+                    await db.execute(
+                        _UPSERT,
+                        self._row(file, parent, path, applied_at),
+                    )
+                    await self._add_terms(db, [file.get("name")])
+                    if old and old_rank == 0 and old_path != path:
+                        # moved / renamed folder, rewrite the paths below it
+                        await db.execute(
+                            _SUBTREE
+                            + """
+                            UPDATE files SET path = subtree.path
+                            FROM subtree WHERE files.id = subtree.id
+                            """,
+                            (file_id, path),
+                        )
+
+                parents = sorted({p for p in (old_parent, parent) if p})
+                renamed = int(old is None or parent is None or old_name != file.get("name"))
+                logged.append((file_id, parents, renamed))
+
+            await db.executemany(
+                "INSERT INTO changes (file_id, parents, renamed, applied_at) VALUES (?, ?, ?, ?)",
+                [
+                    (file_id, json.dumps(parents), renamed, applied_at)
+                    for file_id, parents, renamed in logged
+                ],
+            )
+            # the log is only there for the other workers to catch up
+            await db.execute(
+                "DELETE FROM changes WHERE applied_at < ?", (applied_at - 3600,)
+            )
+        return logged
+
+    async def changes_since(self, seq: int, limit: int = 1000) -> list[tuple]:
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                "SELECT seq, file_id, parents, renamed FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                (seq, limit),
+            )
+            rows = await cursor.fetchall()
+        return [
+            (seq, file_id, json.loads(parents), bool(renamed))
+            for seq, file_id, parents, renamed in rows
+        ]
+
+    async def last_change(self) -> int:
+        async with self._pool.read() as db:
+            cursor = await db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes")
+            return (await cursor.fetchone())[0]
+
+    async def set_popularity(self, downloads: dict[str, int], weight: float) -> None:
+        """Search boost of each file, 1 + weight * ln(1 + downloads)."""
+        async with self._pool.write() as db:
+            await db.execute("DELETE FROM popularity")
+            await db.executemany(
+                "INSERT INTO popularity (file_rowid, boost) SELECT rowid, ? FROM files WHERE id = ?",
+                [
+                    (1 + weight * math.log1p(count), file_id)
+                    for file_id, count in downloads.items()
+                    if count > 0
+                ],
+            )
+
+    @staticmethod
+    def _words(text: str) -> list[str]:
+        # close to what fts5's unicode61 tokenizer makes of it
+        text = unicodedata.normalize("NFKD", (text or "").lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return [w for w in re.split(r"[\W_]+", text) if w]
+
+    @classmethod
+    async def _add_terms(cls, db, names: list[str]) -> None:
+        terms = {word for name in names for word in cls._words(name)}
+        await db.executemany(
+            "INSERT OR IGNORE INTO search_terms (term) VALUES (?)",
+            [(term,) for term in terms],
+        )
+
+    @staticmethod
+    def _phrase(term: str, prefix: bool = False) -> str:
+        return '"' + term.replace('"', '""') + ('"*' if prefix else '"')
+
+    async def search(
+        self, query: str, page_token: str = None, page_size: int = 50
+    ) -> dict:
+        """
+        Ranked search over names and paths. Every word has to match as a prefix
+        (bm25, names weigh more than paths, boosted by popularity), if nothing does
+        the words that match no indexed term are swapped for the closest ones (typos).
+        """
+        words = self._words(query)
+        if not words:
+            return {"files": []}
+
+        mode, after = "w", None
+        if page_token:
+            mode, score, rowid = self.decode_token(page_token)
+            after = float(score), int(rowid)
+
+        async with self._pool.read() as db:
+            if mode == "w":
+                match = " ".join(self._phrase(w, prefix=True) for w in words)
+                page = await self._search(db, match, mode, after, page_size)
+                if page["files"] or after:
+                    return page
+            if match := await self._corrected(db, words):
+                return await self._search(db, match, "f", after, page_size)
+        return {"files": []}
+
+    async def _search(
+        self, db, match: str, mode: str, after: tuple, page_size: int
+    ) -> dict:
+        keyset = "WHERE (score, rowid) > (?, ?)" if after else ""
+        # ranked on the search tables alone, `files` is only read for the page
+        cursor = await db.execute(
+            f"""
+            SELECT {", ".join(f"files.{c}" for c in FIELDS.values())}, score, matches.rowid
+            FROM (
+                SELECT * FROM (
+                    SELECT search_words.rowid AS rowid,
+                        bm25(search_words, 10.0, 1.0) * COALESCE(popularity.boost, 1.0) AS score
+                    FROM search_words
+                    LEFT JOIN popularity ON popularity.file_rowid = search_words.rowid
+                    WHERE search_words MATCH ?
+                ) {keyset}
+                ORDER BY score, rowid LIMIT ?
+            ) AS matches
+            JOIN files ON files.rowid = matches.rowid
+            ORDER BY score, matches.rowid
+            """,
+            (match, *(after or ()), page_size + 1),
+        )
+        rows = await cursor.fetchall()
+
+        page = {"files": [self._file(row) for row in rows[:page_size]]}
+        if len(rows) > page_size:
+            last = rows[page_size - 1]
+            page["nextPageToken"] = self.encode_token(mode, last[-2], last[-1])
+        return page
+
+    async def _corrected(self, db, words: list[str], cutoff: float = 0.75) -> str:
+        """The query with every unknown word replaced by the indexed terms closest to it."""
+        groups, corrected = [], False
+        for word in words:
+            # known as a prefix already
+            cursor = await db.execute(
+                "SELECT 1 FROM search_terms WHERE term >= ? AND term < ? LIMIT 1",
+                (word, word + "\U0010ffff"),
+            )
+            if await cursor.fetchone():
+                groups.append(self._phrase(word, prefix=True))
+                continue
+            # typos rarely hit the first letter, keeps the candidates few
+            cursor = await db.execute(
+                """
+                SELECT term FROM search_terms
+                WHERE term >= ? AND term < ? AND length(term) BETWEEN ? AND ?
+                """,
+                (word[0], word[0] + "\U0010ffff", len(word) - 2, len(word) + 2),
+            )
+            terms = [row[0] for row in await cursor.fetchall()]
+            if not (close := get_close_matches(word, terms, n=3, cutoff=cutoff)):
+                return None
+            groups.append("(" + " OR ".join(self._phrase(t) for t in close) + ")")
+            corrected = True
+        return " AND ".join(groups) if corrected else None
+
+    async def count(self) -> int:
+        async with self._pool.read() as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM files")
+            return (await cursor.fetchone())[0]
@@ -0,0 +1,213 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# prometheus metrics. with PROMETHEUS_MULTIPROC_DIR set (gunicorn.conf.py does that)
+# every worker writes its samples to files there and /metrics sums them all up,
+# otherwise they only cover the process serving the scrape.
+
+import os
+import time
+from typing import AsyncIterator, Callable
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# drive answers in 50ms to a few seconds, tokens take a round trip to oauth
+UPSTREAM_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQLITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+REQUEST_LATENCY = Histogram(
+    "gdm_http_request_duration_seconds",
+    "Time until the response head was sent, per route",
+    ["method", "route", "status"],
+)
+DRIVE_LATENCY = Histogram(
+    "gdm_drive_request_duration_seconds",
+    "Drive api round trips (streams until the response head)",
+    ["call"],
+    buckets=UPSTREAM_BUCKETS,
+)
+DRIVE_RESPONSES = Counter(
+    "gdm_drive_responses_total", "Drive api responses by status", ["call", "status"]
+)
+TOKEN_LATENCY = Histogram(
+    "gdm_token_fetch_duration_seconds",
+    "Access tokens fetched from google's oauth endpoint",
+    ["account"],
+    buckets=UPSTREAM_BUCKETS,
+)
+CACHE_EVENTS = Counter(
+    "gdm_cache_events_total",
+    "Cache events: hits, misses, coalesced (joined an in-flight call), stale and "
+    "stale_errors (served past the ttl), evictions",
+    ["cache", "event"],
+)
+STREAMED_BYTES = Counter(
+    "gdm_streamed_bytes_total", "Bytes handed to clients", ["kind"]
+)
+ACTIVE_STREAMS = Gauge(
+    "gdm_active_streams", "Downloads in progress", ["kind"], multiprocess_mode="livesum"
+)
+QUEUE_DEPTH = Gauge(
+    "gdm_tracker_queue_depth",
+    "Tracker events waiting to be written",
+    ["queue"],
+    multiprocess_mode="livesum",
+)
+RATE_LIMITED = Counter("gdm_rate_limited_total", "Requests answered with 429")
+ACCOUNT_REQUESTS = Counter(
+    "gdm_account_requests_total", "Drive calls and streams routed to each account", ["account"]
+)
+ACCOUNT_BYTES = Counter(
+    "gdm_account_bytes_total", "Bytes streamed from drive per account", ["account"]
+)
+ACCOUNT_RATE_LIMITS = Counter(
+    "gdm_account_rate_limits_total", "Rate limit / quota errors per account", ["account"]
+)
+ACCOUNT_INFLIGHT = Gauge(
+    "gdm_account_inflight",
+    "Calls and streams in progress per account",
+    ["account"],
+    multiprocess_mode="livesum",
+)
+ACCOUNT_COOLDOWN = Gauge(
+    "gdm_account_cooldown_until_seconds",
+    "Unix time a rate limited account is scheduled again",
+    ["account"],
+    multiprocess_mode="max",
+)
+PREFETCH_JOBS = Counter(
+    "gdm_prefetch_jobs_total",
+    "Cache warming jobs: scheduled, done, dropped (no room or accounts busy), failed",
+    ["outcome"],
+)
+INDEX_CRAWLS = Counter(
+    "gdm_index_crawls_total", "Crawls of the tree, partial when folders failed", ["result"]
+)
+INDEX_ITEMS = Gauge(
+    "gdm_index_items",
+    "Folders and files seen by the last crawl",
+    ["kind"],
+    multiprocess_mode="livemax",
+)
+INDEX_LAST_CRAWL = Gauge(
+    "gdm_index_last_crawl_timestamp_seconds",
+    "Start of the last crawl",
+    multiprocess_mode="max",
+)
+CHANGES_POLLS = Counter("gdm_changes_polls_total", "Polls of drive's changes feed")
+CHANGES_APPLIED = Counter(
+    "gdm_changes_applied_total", "Changes from the feed applied to the index"
+)
+CHANGES_LAST_POLL = Gauge(
+    "gdm_changes_last_poll_timestamp_seconds",
+    "End of the last poll of the changes feed",
+    multiprocess_mode="max",
+)
+SQLITE_WRITE_LATENCY = Histogram(
+    "gdm_sqlite_write_duration_seconds",
+    "Write transactions, lock wait and commit included",
+    ["db"],
+    buckets=SQLITE_BUCKETS,
+)
+
+
+def render() -> tuple[bytes, str]:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def cache_hook(cache: str) -> Callable[[str], None]:
+    """`on_event` for timed_cache, counting its events under `cache`."""
+    children = {}
+
+    def hook(event: str) -> None:
+        if event not in children:
+            children[event] = CACHE_EVENTS.labels(cache, event)
+        children[event].inc()
+
+    return hook
+
+
+def observe_drive(call: str, started: float, status) -> None:
+    DRIVE_LATENCY.labels(call).observe(time.perf_counter() - started)
+    DRIVE_RESPONSES.labels(call, str(status)).inc()
+
+
+async def metered(
+    chunks: AsyncIterator[bytes], kind: str, on_sent: Callable[[int], None] = None
+) -> AsyncIterator[bytes]:
+    """
+    Passes a response body through, counting the stream and what it sent. A chunk
+    counts once the server took it, so a disconnect leaves the last one out, and
+    `on_sent` gets the size of each.
+    """
+    sent = STREAMED_BYTES.labels(kind)
+    active = ACTIVE_STREAMS.labels(kind)
+    active.inc()
+    try:
+        async for chunk in chunks:
+            yield chunk
+            sent.inc(len(chunk))
+            if on_sent:
+                on_sent(len(chunk))
+    finally:
+        active.dec()
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+class MetricsMiddleware:
+    """
+    Request latency per route template (not per path, /dl/<id> would be a series per
+    file), unmatched requests are all put under "unmatched". Plain asgi rather than
+    BaseHTTPMiddleware, which would buffer every streamed chunk through a task.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status: int) -> None:
+            nonlocal observed
+            observed = True
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"], getattr(route, "path", "unmatched"), str(status)
+            ).observe(time.perf_counter() - started)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not observed:
+                observe(500)
@@ -0,0 +1,367 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+# per client rate limiting with gcra (generic cell rate algorithm): each key only keeps
+# its "theoretical arrival time", the moment it would be back to a full burst, and a
+# request is let through while that is at most `burst` intervals ahead of now.
+
+import hashlib
+import ipaddress
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from logging import getLogger
+from typing import Callable, Iterable
+
+from libs.cache_backends import RedisBackend
+from libs.metrics import RATE_LIMITED
+
+try:
+    import fcntl
+except ImportError:  # windows, the shared table then goes without locking
+    fcntl = None
+
+LOGGER = getLogger(__name__)
+
+
+def _gcra(tat: float, now: float, interval: float, limit: float) -> tuple[float, float]:
+    """New arrival time and seconds to wait (0 when allowed) for one more request."""
+    new = max(tat, now) + interval
+    if new - now > limit:
+        return tat, new - limit - now
+    return new, 0.0
+
+
+class MemoryLimiterStore:
+    """Arrival times in the process, limits then apply per worker."""
+
+    def __init__(self, sweep_interval: float = 60):
+        self.sweep_interval = sweep_interval
+        self._tats: dict[str, float] = {}
+        self._last_sweep = time.time()
+
+    async def acquire(self, key: str, interval: float, limit: float) -> float:
+        now = time.time()
+        if now - self._last_sweep >= self.sweep_interval:
+            # past arrival times mean a full burst, same as not being there
+            self._last_sweep = now
+            self._tats = {k: tat for k, tat in self._tats.items() if tat > now}
+        self._tats[key], wait = _gcra(self._tats.get(key, 0.0), now, interval, limit)
+        return wait
+
+    async def forget(self, key: str) -> None:
+        self._tats.pop(key, None)
+
+
+class SharedLimiterStore:
+    """
+    Arrival times in a memory mapped file, shared by every worker on the host. It's a
+    fixed table of `slots` (key hash, arrival time) pairs, a key takes the first free or
+    expired slot among `probes` from its hash, the one closest to expiring otherwise.
+    Every lookup holds a lock on the file for the few microseconds it takes.
+    """
+
+    _SLOT = struct.Struct("<Qd")
+
+    def __init__(self, path: str = ".ratelimit", slots: int = 65536, probes: int = 8):
+        self.path = path
+        self.slots = slots
+        self.probes = probes
+        self._fd = None
+        self._map: mmap.mmap = None
+        self._pid = None
+
+    def _table(self) -> mmap.mmap:
+        # mappings and record locks must not cross a fork (gunicorn --preload)
+        if self._map is None or self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            size = self.slots * self._SLOT.size
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+        return self._map
+
+    def _find(self, table: mmap.mmap, digest: int, now: float) -> int:
+        start = digest % self.slots
+        candidate, oldest = None, math.inf
+        for i in range(self.probes):
+            offset = (start + i) % self.slots * self._SLOT.size
+            held, tat = self._SLOT.unpack_from(table, offset)
+            if held == digest:
+                return offset
+            if candidate is None and (not held or tat <= now):
+                candidate = offset
+            if tat < oldest:
+                oldest, fallback = tat, offset
+        offset = fallback if candidate is None else candidate
+        self._SLOT.pack_into(table, offset, digest, 0.0)
+        return offset
+
+    @staticmethod
+    def _digest(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    async def acquire(self, key: str, interval: float, limit: float) -> float:
+        digest = self._digest(key)
+        table = self._table()
+        if fcntl:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            offset = self._find(table, digest, now)
+            tat, wait = _gcra(self._SLOT.unpack_from(table, offset)[1], now, interval, limit)
+            self._SLOT.pack_into(table, offset, digest, tat)
+            return wait
+        finally:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    async def forget(self, key: str) -> None:
+        digest = self._digest(key)
+        table = self._table()
+        if fcntl:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            # an expired slot is free to take, same as an empty one
+            self._SLOT.pack_into(table, self._find(table, digest, time.time()), digest, 0.0)
+        finally:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+class RedisLimiterStore:
+    """Arrival times in redis, shared by every host using it. Fails open when it's down."""
+
+    # one atomic step on redis' clock, floats are returned as strings (lua numbers
+    # would be truncated to integers)
+    _SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+local new = math.max(tonumber(redis.call('GET', KEYS[1]) or 0), now) + interval
+if new - now > limit then
+    return tostring(new - limit - now)
+end
+redis.call('SET', KEYS[1], tostring(new), 'PX', math.ceil((new - now) * 1000))
+return '0'
+"""
+
+    def __init__(self, url: str = "redis://127.0.0.1:6379/0", prefix: str = "gdm:rl:"):
+        self._redis = RedisBackend(url)
+        self.prefix = prefix
+        self._sha = hashlib.sha1(self._SCRIPT.encode()).hexdigest()
+
+    async def acquire(self, key: str, interval: float, limit: float) -> float:
+        args = (1, self.prefix + key, interval, limit)
+        try:
+            try:
+                wait = await self._redis.execute("EVALSHA", self._sha, *args)
+            except RuntimeError as err:
+                if not str(err).startswith("NOSCRIPT"):
+                    raise
+                wait = await self._redis.execute("EVAL", self._SCRIPT, *args)
+        except Exception as err:
+            LOGGER.warning(f"Rate limiting failed, letting the request through: {err}")
+            return 0.0
+        return float(wait)
+
+    async def forget(self, key: str) -> None:
+        try:
+            await self._redis.execute("DEL", self.prefix + key)
+        except Exception as err:
+            LOGGER.warning(f"Rate limiting failed to drop {key}: {err}")
+
+
+def make_limiter_store(name: str, path: str = None, url: str = None):
+    """Store for RATE_LIMIT_BACKEND."""
+    name = (name or "shared").strip().lower()
+    if name == "memory":
+        return MemoryLimiterStore()
+    if name == "shared":
+        return SharedLimiterStore(path or ".ratelimit")
+    if name == "redis":
+        return RedisLimiterStore(url or "redis://127.0.0.1:6379/0")
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+class RateLimiter:
+    """
+    Lets `rate` requests per `period` seconds through per key, and up to `burst` of them
+    at once. `on_limited` is called with every key that got turned away.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        period: float = 60,
+        burst: int = None,
+        store=None,
+        on_limited: Callable[[str], None] = None,
+    ):
+        self.rate = rate
+        self.interval = period / rate if rate > 0 else 0
+        self.limit = self.interval * max(1, burst or 1)
+        self.store = store or MemoryLimiterStore()
+        self.on_limited = on_limited
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    async def acquire(self, key: str, client: str = None) -> float:
+        """
+        0 if the request may go ahead, otherwise seconds until it would. `client` is
+        what `on_limited` gets, the key by default.
+        """
+        wait = await self.store.acquire(key, self.interval, self.limit)
+        if wait and self.on_limited:
+            self.on_limited(client or key)
+        return wait
+
+    async def mark(self, key: str, ttl: float) -> bool:
+        """
+        Marks `key` for `ttl` seconds from now unless it already is, returns whether it
+        was. it's a gcra cell of one `ttl` long, so any store keeps it.
+        """
+        return bool(await self.store.acquire(f"mark:{key}", ttl, ttl))
+
+    async def unmark(self, key: str) -> None:
+        await self.store.forget(f"mark:{key}")
+
+
+def parse_proxies(value: str):
+    """
+    TRUSTED_PROXIES: comma separated ips / cidrs, or "*" for a single proxy whatever
+    its address (heroku's router, a load balancer in front).
+    """
+    value = (value or "").strip()
+    if value == "*":
+        return "*"
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in value.split(",") if part.strip()]
+
+
+def client_address(scope, trusted=()) -> str:
+    """
+    The client's ip: the socket peer, or when that is a trusted proxy the last address
+    in X-Forwarded-For that isn't one. every proxy appends the address it got the
+    request from, so anything left of the trusted ones may be made up by the client.
+    """
+    peer = scope["client"][0] if scope.get("client") else None
+    if not trusted:
+        return peer
+
+    forwarded = [
+        hop.strip()
+        for name, value in scope.get("headers", ())
+        if name == b"x-forwarded-for"
+        for hop in value.decode("latin-1").split(",")
+        if hop.strip()
+    ]
+    if trusted == "*":
+        return forwarded[-1] if forwarded else peer
+
+    def is_trusted(address: str) -> bool:
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(address in network for network in trusted)
+
+    if not peer or not is_trusted(peer):
+        return peer
+    for hop in reversed(forwarded):
+        if not is_trusted(hop):
+            return hop
+    return forwarded[0] if forwarded else peer
+
+
+class RateLimitMiddleware:
+    """
+    Answers 429 with Retry-After to clients (by ip, see client_address) over the limit
+    on `paths` and below. On `ranged_paths` the first request for a path always comes
+    out of the client's budget and opens the path for `resume_window` seconds, range
+    requests past the first byte of an open path (players seeking, downloads resuming)
+    are then counted per client and path, so a viewer doesn't use up the client's budget.
+    """
+
+    def __init__(
+        self,
+        app,
+        limiter: RateLimiter,
+        paths: Iterable[str] = (),
+        ranged_paths: Iterable[str] = (),
+        trusted_proxies=(),
+        resume_window: float = 3600,
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.paths = tuple(paths)
+        self.ranged_paths = tuple(ranged_paths)
+        self.trusted_proxies = trusted_proxies
+        self.resume_window = resume_window
+
+    @staticmethod
+    def _under(path: str, paths: tuple) -> bool:
+        return any(path == p or path.startswith(p.rstrip("/") + "/") for p in paths)
+
+    @staticmethod
+    def _resuming(scope) -> bool:
+        for name, value in scope.get("headers", ()):
+            if name == b"range":
+                return not value.replace(b" ", b"").startswith(b"bytes=0-")
+        return False
+
+    async def _acquire(self, scope, client: str) -> float:
+        if not self._under(scope["path"], self.ranged_paths):
+            return await self.limiter.acquire(client)
+
+        opened = f"{client} {scope['path']}"
+        was_open = await self.limiter.mark(opened, self.resume_window)
+        if was_open and self._resuming(scope):
+            return await self.limiter.acquire(opened, client)
+        wait = await self.limiter.acquire(client)
+        if wait and not was_open:
+            # only a request the client paid for opens the path, refused ones don't
+            # (may drop a mark set just before by another request, it's then paid again)
+            await self.limiter.unmark(opened)
+        return wait
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self.limiter.enabled
+            or not self._under(scope["path"], self.paths)
+            or not (client := client_address(scope, self.trusted_proxies))
+        ):
+            return await self.app(scope, receive, send)
+
+        wait = await self._acquire(scope, client)
+        if not wait:
+            return await self.app(scope, receive, send)
+
+        RATE_LIMITED.inc()
+        body = json.dumps(
+            {"success": False, "error": "Too many requests, slow down."}
+        ).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(max(1, math.ceil(wait))).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,123 @@
+# Google-Drive-Mirror - Mirror/Indexer of Gdrive with FastAPI
+# Copyright (C) 2025 kaif-00z
+#
+# This file is a part of < https://github.com/kaif-00z/Google-Drive-Mirror/ >
+# PLease read the GNU Affero General Public License in
+# <https://github.com/kaif-00z/Google-Drive-Mirror/blob/main/LICENSE>.
+
+# if you are using this following code then don't forgot to give proper
+# credit to t.me/kAiF_00z (github.com/kaif-00z)
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+import aiosqlite
+
+from libs.metrics import SQLITE_WRITE_LATENCY
+
+
+class SQLitePool:
+    """
+    Small set of long lived aiosqlite connections for one database file.
+
+    The database runs in WAL mode so readers never block the writer. All writes go
+    through a single connection guarded by a lock (sqlite only allows one writer
+    anyway), which avoids `database is locked` errors inside a worker and lets
+    every write block share one transaction. Statements are cached per connection
+    by sqlite3, so keeping connections open also reuses the prepared statements.
+    `functions` (name -> python function) are registered as sql functions on each.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        readers: int = 4,
+        cache_size_kib: int = 16384,
+        synchronous: str = "NORMAL",
+        busy_timeout_ms: int = 5000,
+        cached_statements: int = 256,
+        functions: dict[str, Callable] = None,
+    ):
+        self.db_path = db_path
+        self.readers = max(1, readers)
+        self.cache_size_kib = cache_size_kib
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.functions = functions or {}
+
+        self._writer: aiosqlite.Connection = None
+        self._write_lock = asyncio.Lock()
+        self._idle: asyncio.Queue = None
+        self._connections: list[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+        self._write_latency = SQLITE_WRITE_LATENCY.labels(os.path.basename(db_path))
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(
+            self.db_path, cached_statements=self.cached_statements
+        )
+        await db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        await db.execute("PRAGMA journal_mode = WAL")
+        await db.execute(f"PRAGMA synchronous = {self.synchronous}")
+        await db.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        await db.execute("PRAGMA temp_store = MEMORY")
+        for name, function in self.functions.items():
+            await db.create_function(
+                name, function.__code__.co_argcount, function, deterministic=True
+            )
+        self._connections.append(db)
+        return db
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self.is_open:
+                return
+            # writer first, so the WAL switch happens before any reader attaches
+            writer = await self._connect()
+            self._idle = asyncio.Queue()
+            for _ in range(self.readers):
+                self._idle.put_nowait(await self._connect())
+            self._writer = writer
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                self._writer = None
+                connections, self._connections = self._connections, []
+                for db in connections:
+                    await db.close()
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self.is_open:
+            await self.open()
+        db = await self._idle.get()
+        try:
+            yield db
+        finally:
+            self._idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Exclusive access to the writer, committed on exit and rolled back on error."""
+        if not self.is_open:
+            await self.open()
+        started = time.perf_counter()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+        self._write_latency.observe(time.perf_counter() - started)
@@ -12,12 +12,157 @@
 import asyncio
 import functools
 import inspect
+import sys
 import time
+from collections import OrderedDict
 from typing import Any, Callable, Dict, Tuple
 
 
+def _sizeof(obj: Any, seen: set = None) -> int:
+    """Rough deep size of `obj` in bytes, good enough for budgeting json-like payloads."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(item, seen) for item in obj)
+    return size
+
+
+class CacheBackend:
+    """
+    Storage used by `timed_cache`. The default `MemoryBackend` keeps results in the
+    process, shared backends (see `libs.cache_backends`) set `shared = True` and get
+    string keys that are stable across processes.
+    """
+
+    shared = False
+    # async only backends (network ones) can't serve sync functions
+    supports_sync = True
+
+    def make_key(self, namespace: str, key: Tuple, tag: str = None) -> Any:
+        return key if tag is None else (tag, key)
+
+    def get(self, key: Any, now: float) -> Tuple[bool, Any]:
+        raise NotImplementedError
+
+    def set(self, key: Any, value: Any, expires_at: float) -> None:
+        raise NotImplementedError
+
+    async def aget(self, key: Any, now: float) -> Tuple[bool, Any]:
+        return self.get(key, now)
+
+    async def aset(self, key: Any, value: Any, expires_at: float) -> None:
+        return self.set(key, value, expires_at)
+
+    async def adelete(self, key: Any) -> None:
+        return self.delete(key)
+
+    def delete(self, key: Any) -> None:
+        raise NotImplementedError
+
+    def clear(self, namespace: str = None, tag: str = None) -> None:
+        """Drops the namespace, or only its entries tagged with `tag` if given."""
+        raise NotImplementedError
+
+    def info(self, namespace: str = None) -> dict:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Ordered (least recently used first) in-process store with TTL, entry count and memory limits.
+    """
+
+    def __init__(
+        self, maxsize: int = None, max_memory: int = None, sweep_interval: float = None
+    ):
+        self.maxsize = maxsize
+        self.max_memory = max_memory
+        self.sweep_interval = sweep_interval
+        self.entries: "OrderedDict[Tuple, Tuple[float, Any, int]]" = OrderedDict()
+        self.memory = 0
+        self.last_sweep = time.time()
+        self.stats = {"evictions": 0, "expirations": 0}
+
+    def get(self, key: Tuple, now: float) -> Tuple[bool, Any]:
+        if entry := self.entries.get(key):
+            expires_at, value, _ = entry
+            if now < expires_at:
+                self.entries.move_to_end(key)
+                return True, value
+        return False, None
+
+    def set(self, key: Tuple, value: Any, expires_at: float) -> None:
+        self._discard(key)
+        size = _sizeof(value) if self.max_memory else 0
+        self.entries[key] = (expires_at, value, size)
+        self.memory += size
+        self._sweep(time.time())
+        self._evict()
+
+    def delete(self, key: Tuple) -> None:
+        self._discard(key)
+
+    def clear(self, namespace: str = None, tag: str = None) -> None:
+        if tag is None:
+            self.entries.clear()
+            self.memory = 0
+            return
+        for key in [k for k in self.entries if k[0] == tag]:
+            self._discard(key)
+
+    def info(self, namespace: str = None) -> dict:
+        return {
+            **self.stats,
+            "size": len(self.entries),
+            "memory": self.memory,
+            "maxsize": self.maxsize,
+            "max_memory": self.max_memory,
+        }
+
+    def _discard(self, key: Tuple) -> bool:
+        if entry := self.entries.pop(key, None):
+            self.memory -= entry[2]
+            return True
+        return False
+
+    def _sweep(self, now: float) -> None:
+        # actively drops expired entries once per interval, so keys that are never
+        # requested again (one off searches, page tokens) don't stay around forever
+        if self.sweep_interval is None or now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for key in [k for k, (expires_at, *_) in self.entries.items() if now >= expires_at]:
+            self._discard(key)
+            self.stats["expirations"] += 1
+
+    def _evict(self) -> None:
+        while self.entries and (
+            (self.maxsize is not None and len(self.entries) > self.maxsize)
+            or (self.max_memory is not None and self.memory > self.max_memory)
+        ):
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.memory -= size
+            self.stats["evictions"] += 1
+
+
 def timed_cache(
-    seconds: int, max_concurrent: int = None, ignore_args: list[str] = None
+    seconds: int,
+    max_concurrent: int = None,
+    ignore_args: list[str] = None,
+    maxsize: int = None,
+    max_memory: int = None,
+    sweep_interval: float = None,
+    backend: CacheBackend = None,
+    tag_arg: str = None,
+    stale_while_revalidate: float = 0,
+    stale_if_error: float = 0,
+    on_event: Callable[[str], None] = None,
 ):
     """
     A decorator that caches the result of a function for a specified duration (`seconds`),
@@ -28,6 +173,20 @@ def timed_cache(
     - Ignores specified arguments (e.g., sessions or connections) in the cache key using `ignore_args`.
     - Deduplicates in-flight async calls: concurrent calls with the same key await the same result.
     - Enforces concurrency limits for async functions using `max_concurrent`.
+    - Optionally bounds the cache by entry count (`maxsize`) and estimated memory (`max_memory`),
+      evicting the least recently used entries first.
+    - Periodically sweeps out expired entries instead of waiting for the same key to be requested again.
+    - Keeps per cache hit/miss/eviction/expiration counters, see `cache_info()`.
+    - Pluggable storage through `backend`, e.g. a store shared by every worker on the host.
+      In-flight deduplication always stays local to the process.
+    - Targeted invalidation: `cache_delete(*args, **kwargs)` drops a single call and
+      `cache_clear(tag=...)` every call whose `tag_arg` argument had that value.
+    - Opt-in stale serving (async only): for `stale_while_revalidate` seconds after expiry
+      the old result is returned right away while a single background call refreshes it,
+      and for `stale_if_error` seconds it is returned when the call raises instead.
+    - Warming: `await cache_set(value, *args, **kwargs)` stores a result obtained some
+      other way (e.g. a listing that already carries it) as if the call had returned it.
+    - Every counted event is also passed to `on_event`, e.g. to export it as a metric.
     Args:
         seconds (int): Duration in seconds to cache the result of each unique call.
         max_concurrent (int, optional): Maximum number of concurrent executions for async functions.
@@ -36,111 +195,222 @@ def timed_cache(
         ignore_args (list[str], optional): List of argument names to exclude from cache key generation.
                                            Useful for excluding non-essential or unhashable types
                                            (e.g., `aiohttp.ClientSession`).
+        maxsize (int, optional): Maximum number of cached results, unbounded if not set.
+        max_memory (int, optional): Approximate memory budget in bytes for cached results,
+                                    unbounded if not set.
+        sweep_interval (float, optional): How often (in seconds) expired entries are swept out.
+                                          Defaults to `seconds` when `maxsize` or `max_memory` is set,
+                                          otherwise expired entries are only replaced on the next call.
+        backend (CacheBackend, optional): Where results are stored, defaults to a private
+                                          `MemoryBackend` built from `maxsize`/`max_memory`/`sweep_interval`.
+                                          Shared backends ignore `self`/`cls` in the key so bound
+                                          methods hit the same entries from every process.
+        tag_arg (str, optional): Argument whose value tags each entry, so all entries for one
+                                 value (e.g. every page of a folder) can be dropped at once.
+        stale_while_revalidate (float, optional): Seconds past `seconds` an entry is still served
+                                                  while it's refreshed in the background.
+        stale_if_error (float, optional): Seconds past `seconds` an entry is still served when
+                                          refreshing it fails.
+        on_event (Callable[[str], None], optional): Called with the name of the `cache_info()`
+                                                    counter every time one is incremented.
     Returns:
         Callable: A decorated function that caches and manages concurrent executions.
+                  It also exposes `cache_info()`, `cache_clear()`, `cache_delete()` and `cache_set()`.
     Raises:
-        TypeError: If `max_concurrent` is provided for a synchronous function.
+        TypeError: If `max_concurrent` or stale serving is asked for a synchronous function,
+                   or `backend` can only be used from async functions.
     Example:
-        >>> @timed_cache(seconds=100, max_concurrent=10, ignore_args=['session'])
+        >>> @timed_cache(seconds=100, max_concurrent=10, ignore_args=['session'], maxsize=1024)
         ... async def fetch_data(session: aiohttp.ClientSession, token):
         ...     async with session.get(url) as response:
         ...         data = await response.json()
         ...         return data
+        >>> fetch_data.cache_info()
+        {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'expirations': 0, 'size': 0, ...}
     Notes:
         - Cache keys are created from function arguments excluding those in `ignore_args`.
         - For async functions, if a call is already running with the same key, other calls will wait.
         - For sync functions, concurrent deduplication is not safe and uses a basic in-flight check.
     """
 
-    result_cache: Dict[Tuple, Tuple[float, Any]] = {}
+    if sweep_interval is None and (maxsize is not None or max_memory is not None):
+        sweep_interval = seconds
+
+    result_cache = backend or MemoryBackend(maxsize, max_memory, sweep_interval)
+    stats = {"hits": 0, "misses": 0, "coalesced": 0, "stale": 0, "stale_errors": 0}
     in_flight_tasks: Dict[Tuple, asyncio.Future] = {}
+    # entries are kept this much longer than `seconds`, stored as [fresh_until, value]
+    grace = max(stale_while_revalidate, stale_if_error)
+    refreshes: set = set()
     semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
     ignore_args = set(ignore_args or [])
 
     def decorator(func: Callable):
         is_coroutine = inspect.iscoroutinefunction(func)
         sig = inspect.signature(func)
+        namespace = f"{func.__module__}.{func.__qualname__}"
+        skipped_args = ignore_args | ({"self", "cls"} if result_cache.shared else set())
+
+        def make_key(args, kwargs) -> Tuple:
+            bound_args = sig.bind(*args, **kwargs)
+            bound_args.apply_defaults()
+            key_items = tuple(
+                (k, v)
+                for k, v in bound_args.arguments.items()
+                if k not in skipped_args
+            )
+            tag = str(bound_args.arguments.get(tag_arg)) if tag_arg else None
+            return result_cache.make_key(namespace, tuple(sorted(key_items)), tag)
+
+        def cache_delete(*args, **kwargs) -> None:
+            key = make_key(args, kwargs)
+            if result_cache.supports_sync:
+                result_cache.delete(key)
+            else:
+                asyncio.get_running_loop().create_task(result_cache.adelete(key))
+
+        async def store(key, value: Any) -> None:
+            now = time.time()
+            if grace:
+                value = [now + seconds, value]
+            await result_cache.aset(key, value, now + seconds + grace)
+
+        async def cache_set(value: Any, *args, **kwargs) -> None:
+            await store(make_key(args, kwargs), value)
+
+        def record(event: str) -> None:
+            stats[event] += 1
+            if on_event:
+                on_event(event)
+
+        def count(hit: bool) -> None:
+            record("hits" if hit else "misses")
 
         if is_coroutine:
 
+            async def call(key, args, kwargs):
+                result = await func(*args, **kwargs)
+                await store(key, result)
+                return result
+
+            async def run(key, args, kwargs, future):
+                try:
+                    # Wait for slot if concurrency limit is set
+                    if semaphore:
+                        async with semaphore:
+                            result = await call(key, args, kwargs)
+                    else:
+                        result = await call(key, args, kwargs)
+                except BaseException as e:
+                    # whatever ends the call has to reach the waiters too, even a
+                    # cancellation, or they wait forever
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(result)
+                    return result
+                finally:
+                    if in_flight_tasks.get(key) is future:
+                        del in_flight_tasks[key]
+
+            async def join(key, args, kwargs):
+                record("coalesced")
+                try:
+                    # shielded, a waiter going away must not cancel the call for the rest
+                    return await asyncio.shield(in_flight_tasks[key])
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise
+                # the call was cancelled along with whoever started it, not this waiter,
+                # so it's made again (once, the other waiters join that one)
+                if key in in_flight_tasks:
+                    return await join(key, args, kwargs)
+                return await run(key, args, kwargs, in_flight(key))
+
+            def in_flight(key) -> asyncio.Future:
+                future = asyncio.Future()
+                # nobody has to be waiting on it, the caller gets the exception anyway
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                in_flight_tasks[key] = future
+                return future
+
+            def refresh(key, args, kwargs) -> None:
+                # a failure just leaves the stale entry in place
+                task = asyncio.create_task(run(key, args, kwargs, in_flight(key)))
+                refreshes.add(task)
+                task.add_done_callback(refreshes.discard)
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
             @functools.wraps(func)
             async def async_wrapper(*args, **kwargs):
-                bound_args = sig.bind(*args, **kwargs)
-                bound_args.apply_defaults()
-                key_items = tuple(
-                    (k, v)
-                    for k, v in bound_args.arguments.items()
-                    if k not in ignore_args
-                )
-                key = tuple(sorted(key_items))
+                key = make_key(args, kwargs)
 
-                now = time.time()
+                # Return in-flight result if already running (a stale entry beats waiting)
+                if key in in_flight_tasks and not grace:
+                    return await join(key, args, kwargs)
 
                 # Return from cache if valid
-                if key in result_cache:
-                    expires_at, value = result_cache[key]
-                    if now < expires_at:
-                        return value
+                now = time.time()
+                hit, value = await result_cache.aget(key, now)
+                stale = None  # (expired at, value) of an entry past its ttl
+                if hit and grace:
+                    fresh_until, value = value
+                    if now >= fresh_until:
+                        hit, stale = False, (fresh_until, value)
+                if hit:
+                    count(True)
+                    return value
 
-                # Return in-flight result if already running
-                if key in in_flight_tasks:
-                    return await in_flight_tasks[key]
+                if stale and now < stale[0] + stale_while_revalidate:
+                    record("stale")
+                    if key not in in_flight_tasks:
+                        refresh(key, args, kwargs)
+                    return stale[1]
+                count(False)
+                if stale and now >= stale[0] + stale_if_error:
+                    stale = None
 
-                # Create a new future for this key
-                future = asyncio.Future()
-                in_flight_tasks[key] = future
+                try:
+                    # a shared backend lookup may have yielded, so check again
+                    if key in in_flight_tasks:
+                        return await join(key, args, kwargs)
 
-                # Wait for slot if concurrency limit is set
-                if semaphore:
-                    async with semaphore:
-                        try:
-                            result = await func(*args, **kwargs)
-                            result_cache[key] = (time.time() + seconds, result)
-                            future.set_result(result)
-                            return result
-                        except Exception as e:
-                            future.set_exception(e)
-                            raise
-                        finally:
-                            in_flight_tasks.pop(key, None)
-                else:
-                    try:
-                        result = await func(*args, **kwargs)
-                        result_cache[key] = (time.time() + seconds, result)
-                        future.set_result(result)
-                        return result
-                    except Exception as e:
-                        future.set_exception(e)
+                    # Create a new future for this key
+                    return await run(key, args, kwargs, in_flight(key))
+                except Exception:
+                    if stale is None:
                         raise
-                    finally:
-                        in_flight_tasks.pop(key, None)
+                    record("stale_errors")
+                    return stale[1]
 
-            return async_wrapper
+            wrapper = async_wrapper
 
         elif max_concurrent:
             raise TypeError(
                 "max_concurrent support only available for async functions."
             )
 
+        elif grace:
+            raise TypeError("Stale serving is only available for async functions.")
+
+        elif not result_cache.supports_sync:
+            raise TypeError(
+                f"{type(result_cache).__name__} can only cache async functions."
+            )
+
         else:
 
             @functools.wraps(func)
             def sync_wrapper(*args, **kwargs):
-                bound_args = sig.bind(*args, **kwargs)
-                bound_args.apply_defaults()
-                key_items = tuple(
-                    (k, v)
-                    for k, v in bound_args.arguments.items()
-                    if k not in ignore_args
-                )
-                key = tuple(sorted(key_items))
-
-                now = time.time()
+                key = make_key(args, kwargs)
 
-                if key in result_cache:
-                    expires_at, value = result_cache[key]
-                    if now < expires_at:
-                        return value
+                hit, value = result_cache.get(key, time.time())
+                count(hit)
+                if hit:
+                    return value
 
                 # If another call is running, wait for it (not supported in sync safely)
                 if key in in_flight_tasks:
@@ -148,11 +418,19 @@ def timed_cache(
 
                 try:
                     in_flight_tasks[key] = result = func(*args, **kwargs)
-                    result_cache[key] = (time.time() + seconds, result)
+                    result_cache.set(key, result, time.time() + seconds)
                     return result
                 finally:
                     in_flight_tasks.pop(key, None)
 
-            return sync_wrapper
+            wrapper = sync_wrapper
+
+        wrapper.cache_info = lambda: {**stats, **result_cache.info(namespace)}
+        wrapper.cache_clear = lambda tag=None: result_cache.clear(
+            namespace, None if tag is None else str(tag)
+        )
+        wrapper.cache_delete = cache_delete
+        wrapper.cache_set = cache_set
+        return wrapper
 
     return decorator
@@ -1,20 +1,63 @@
+import asyncio
+from datetime import datetime, timedelta
+from logging import getLogger
+
 from libs.tracker.downloads import DownloadTracker, Algorithms
 from libs.tracker.users import UserTracker, Activities
 
+LOGGER = getLogger(__name__)
+
 class Tracker:
-    def __init__(self):
+    def __init__(self, raw_retention: float = 7, hourly_retention: float = 90, compact_interval: float = 3600):
         self._dl_t = DownloadTracker()
         self._u_t = UserTracker()
+        # days of raw events / hourly totals kept before they are rolled up, 0 keeps everything.
+        # hourly download counts back the last 24h stats, so at least a day of them stays
+        self.raw_retention = raw_retention
+        self.hourly_retention = max(hourly_retention, raw_retention, 1)
+        self.compact_interval = compact_interval
+        self._compactor: asyncio.Task = None
 
     async def wake(self):
         await self._dl_t.init_db()
         await self._u_t.init_db()
+        if self.raw_retention > 0 and not self._compactor:
+            self._compactor = asyncio.create_task(self._compact_loop())
+
+    async def sleep(self):
+        if self._compactor:
+            self._compactor.cancel()
+            try:
+                await self._compactor
+            except asyncio.CancelledError:
+                pass
+            self._compactor = None
+        await self._dl_t.close()
+        await self._u_t.close()
 
-    # this "user" property gives access to user tracking functionalities but its not implemented in api interfaces yet but the backend is ready for future use.
+    async def compact(self) -> None:
+        # every worker runs this, each batch is one transaction so they never roll up the same rows twice
+        now = datetime.now()
+        raw_before = now - timedelta(days=self.raw_retention)
+        hourly_before = now - timedelta(days=self.hourly_retention)
+        downloads = await self._dl_t.compact(raw_before, hourly_before)
+        activities = await self._u_t.compact(raw_before, hourly_before)
+        if downloads or activities:
+            LOGGER.info(f"Rolled up {downloads} downloads and {activities} activities")
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as err:
+                LOGGER.error(f"Compacting the trackers failed: {err}")
+            await asyncio.sleep(self.compact_interval)
+
+    # activities are queued from the api (queue_activity), downloads count the bytes they send
     @property
     def user(self) -> UserTracker:
         return self._u_t
-    
+
     @property
     def dl(self) -> DownloadTracker:
-        return self._dl_t
\ No newline at end of file
+        return self._dl_t
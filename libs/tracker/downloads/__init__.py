@@ -8,13 +8,34 @@
 # if you are using this following code then don't forgot to give proper
 # credit to t.me/kAiF_00z (github.com/kaif-00z)
 
+import asyncio
 import math
-from datetime import datetime, timedelta
+import sqlite3
+import time
+from collections import defaultdict
+from datetime import datetime
+from logging import getLogger
 
-import aiosqlite
+from libs.metrics import QUEUE_DEPTH
+from libs.sqlite_pool import SQLitePool
 
-from gdrive.utils import asyncio
-from libs.time_cache import timed_cache
+LOGGER = getLogger(__name__)
+
+# scores are kept as ln(sum of e^(rate * (t - EPOCH))) over every download at t,
+# growing with time at the same pace for every file, so ordering by them never
+# changes until a download arrives and the leaderboard is just an index on them
+_EPOCH = 1735689600  # 2025-01-01
+
+
+def _epoch(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def _logaddexp(a: float, b: float) -> float:
+    if a is None or b is None:
+        return b if a is None else a
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
 
 
 class Algorithms:
@@ -23,11 +44,45 @@ class Algorithms:
 
 
 class DownloadTracker:
-    def __init__(self, db_path="downloads.db"):
+    """
+    Downloads are counted per file, per file and hour, and summed with exponential
+    decay into two scores: trending (`trending_half_life`, what is picked up right
+    now) and hotness (`hotness_half_life`, what has been popular for a while).
+    Everything is updated as downloads are written, reading the top files is an
+    index scan of `limit` rows.
+    """
+
+    # score name -> column
+    _SCORES = {Algorithms.TRENDING: "trending_log", Algorithms.HOTNESS: "hotness_log"}
+
+    def __init__(
+        self,
+        db_path="downloads.db",
+        flush_size: int = 500,
+        flush_interval: float = 2.0,
+        max_pending: int = 100000,
+        trending_half_life: float = 6 * 3600,
+        hotness_half_life: float = 48 * 3600,
+    ):
         self.db_path = db_path
+        self._pool = SQLitePool(db_path, functions={"logaddexp": _logaddexp})
+        # decay rates per second
+        self._rates = {
+            Algorithms.TRENDING: math.log(2) / trending_half_life,
+            Algorithms.HOTNESS: math.log(2) / hotness_half_life,
+        }
+
+        # downloads queued from the /dl hot path, written by _flush_loop in batches
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._depth = QUEUE_DEPTH.labels("downloads")
+        self._flush_now = asyncio.Event()
+        self._flusher: asyncio.Task = None
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        await self._pool.open()
+        async with self._pool.write() as db:
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS downloads (
@@ -45,161 +100,319 @@ class DownloadTracker:
                     file_id TEXT PRIMARY KEY,
                     download_count INTEGER DEFAULT 0,
                     first_download TEXT,
-                    last_download TEXT
+                    last_download TEXT,
+                    trending_log REAL,
+                    hotness_log REAL
                 )
             """
             )
 
-            await db.commit()
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads_hourly (
+                    file_id TEXT,
+                    hour INTEGER,
+                    downloads INTEGER,
+                    PRIMARY KEY (file_id, hour)
+                ) WITHOUT ROWID
+            """
+            )
 
-    async def track_download(self, file_id: str, user_ip: str = None):
-        timestamp = datetime.now().isoformat()
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads_daily (
+                    file_id TEXT,
+                    day INTEGER,
+                    downloads INTEGER,
+                    PRIMARY KEY (file_id, day)
+                ) WITHOUT ROWID
+            """
+            )
 
-        async with aiosqlite.connect(self.db_path) as db:
             await db.execute(
-                "INSERT INTO downloads (file_id, user_ip, timestamp) VALUES (?, ?, ?)",
-                (file_id, user_ip, timestamp),
+                "CREATE INDEX IF NOT EXISTS idx_downloads_timestamp ON downloads (timestamp, file_id)"
             )
-            cursor = await db.execute(
-                "SELECT download_count FROM files WHERE file_id = ?", (file_id,)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_downloads_hourly_hour ON downloads_hourly (hour)"
             )
-            row = await cursor.fetchone()
 
-            if row:
+            if await self._unscored(db):
+                await self._migrate(db)
+
+            # the leaderboards
+            for column in self._SCORES.values():
                 await db.execute(
-                    """
-                    UPDATE files
-                    SET download_count = download_count + 1,
-                        last_download = ?
-                    WHERE file_id = ?
-                """,
-                    (timestamp, file_id),
+                    f"CREATE INDEX IF NOT EXISTS idx_files_{column} ON files ({column})"
                 )
 
-            else:
+        if not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            # None tells the flusher to write whatever is left and exit
+            await self._queue.put(None)
+            self._flush_now.set()
+            await self._flusher
+            self._flusher = None
+        await self._pool.close()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def queue_download(self, file_id: str, user_ip: str = None) -> None:
+        try:
+            self._queue.put_nowait((file_id, user_ip, datetime.now().isoformat()))
+        except asyncio.QueueFull:
+            LOGGER.warning(f"Download queue is full, dropping download of {file_id}")
+            return
+
+        self._depth.set(self._queue.qsize())
+        if self._queue.qsize() >= self.flush_size:
+            self._flush_now.set()
+
+    async def _flush_loop(self):
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+
+            # wait for a full batch or the interval, whichever comes first
+            if batch[0] is not None and self._queue.qsize() + 1 < self.flush_size:
+                self._flush_now.clear()
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while len(batch) < self.flush_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            if None in batch:
+                # shutting down, so flush everything that is still queued in one go
+                stopping = True
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                batch = [event for event in batch if event is not None]
+            self._depth.set(self._queue.qsize())
+
+            if batch:
+                try:
+                    await self._write_downloads(batch)
+                except Exception as err:
+                    LOGGER.error(f"Failed to write {len(batch)} downloads: {err}")
+
+    @staticmethod
+    async def _unscored(db) -> list[str]:
+        cursor = await db.execute("PRAGMA table_info(files)")
+        columns = {row[1] for row in await cursor.fetchall()}
+        return [column for column in ("trending_log", "hotness_log") if column not in columns]
+
+    async def _migrate(self, db):
+        # databases from before the scores, they are built once from the raw rows.
+        # every worker gets here on the first start: columns, backfill and all go in
+        # one transaction, the first to take the lock migrates and the rest find it done
+        await db.commit()
+        while True:
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as err:
+                # busy_timeout ran out while another worker is still migrating
+                if "locked" not in str(err):
+                    raise
+        missing = await self._unscored(db)
+        if not missing:
+            return
+
+        LOGGER.info("Building download scores and hourly counts from past downloads")
+        for column in missing:
+            try:
+                await db.execute(f"ALTER TABLE files ADD COLUMN {column} REAL")
+            except sqlite3.OperationalError as err:
+                if "duplicate column" not in str(err):
+                    raise
+        cursor = await db.execute("SELECT file_id, NULL, timestamp FROM downloads")
+        while rows := await cursor.fetchmany(10000):
+            scores, hours = self._aggregate(rows)
+            await db.executemany(
+                """
+                UPDATE files SET
+                    trending_log = logaddexp(trending_log, ?),
+                    hotness_log = logaddexp(hotness_log, ?)
+                WHERE file_id = ?
+            """,
+                [(trending, hotness, file_id) for file_id, (trending, hotness) in scores.items()],
+            )
+            await self._add_hours(db, hours)
+
+    def _aggregate(self, events) -> tuple[dict, dict]:
+        """Score increments per file and download counts per (file, hour) of `events`."""
+        scores, hours = {}, defaultdict(int)
+        trending_rate = self._rates[Algorithms.TRENDING]
+        hotness_rate = self._rates[Algorithms.HOTNESS]
+        for file_id, _, timestamp in events:
+            at = _epoch(timestamp)
+            trending, hotness = scores.get(file_id, (None, None))
+            scores[file_id] = (
+                _logaddexp(trending, trending_rate * (at - _EPOCH)),
+                _logaddexp(hotness, hotness_rate * (at - _EPOCH)),
+            )
+            hours[file_id, int(at // 3600)] += 1
+        return scores, hours
+
+    @staticmethod
+    async def _add_hours(db, hours: dict) -> None:
+        await db.executemany(
+            """
+            INSERT INTO downloads_hourly (file_id, hour, downloads) VALUES (?, ?, ?)
+            ON CONFLICT(file_id, hour) DO UPDATE SET
+                downloads = downloads + excluded.downloads
+        """,
+            [(file_id, hour, count) for (file_id, hour), count in hours.items()],
+        )
+
+    async def compact(self, raw_before: datetime, hourly_before: datetime, batch: int = 10000) -> int:
+        """
+        Deletes raw downloads from before `raw_before`, they are already counted by the
+        hourly counters and the scores, and rolls hourly counts from before `hourly_before`
+        into daily ones. A batch per transaction. Returns the raw rows removed.
+        """
+        removed = 0
+        while True:
+            async with self._pool.write() as db:
+                cursor = await db.execute(
+                    "DELETE FROM downloads WHERE id IN (SELECT id FROM downloads WHERE timestamp < ? ORDER BY timestamp LIMIT ?)",
+                    (raw_before.isoformat(), batch),
+                )
+            if not cursor.rowcount:
+                break
+            removed += cursor.rowcount
+
+        before = int(hourly_before.timestamp() // 3600)
+        while True:
+            async with self._pool.write() as db:
+                cursor = await db.execute(
+                    "SELECT MAX(hour) FROM (SELECT hour FROM downloads_hourly WHERE hour < ? ORDER BY hour LIMIT ?)",
+                    (before, batch),
+                )
+                if (last := (await cursor.fetchone())[0]) is None:
+                    break
                 await db.execute(
                     """
-                    INSERT INTO files (file_id, download_count, first_download, last_download)
-                    VALUES (?, 1, ?, ?)
+                    INSERT INTO downloads_daily (file_id, day, downloads)
+                    SELECT file_id, hour / 24, SUM(downloads) FROM downloads_hourly
+                    WHERE hour <= ? GROUP BY 1, 2
+                    ON CONFLICT(file_id, day) DO UPDATE SET
+                        downloads = downloads + excluded.downloads
                 """,
-                    (file_id, timestamp, timestamp),
+                    (last,),
                 )
-
-            await db.commit()
-
-    async def _calculate_velocity(self, file_id: str, hours: int) -> float:
-        cutoff = datetime.now() - timedelta(hours=hours)
-
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM downloads WHERE file_id = ? AND timestamp >= ?",
-                (file_id, cutoff.isoformat()),
+                await db.execute("DELETE FROM downloads_hourly WHERE hour <= ?", (last,))
+        return removed
+
+    async def _write_downloads(self, events: list[tuple[str, str, str]]):
+        files = {}
+        for file_id, _, timestamp in events:
+            count, first, last = files.get(file_id, (0, timestamp, timestamp))
+            files[file_id] = (count + 1, min(first, timestamp), max(last, timestamp))
+        scores, hours = self._aggregate(events)
+
+        async with self._pool.write() as db:
+            await db.executemany(
+                "INSERT INTO downloads (file_id, user_ip, timestamp) VALUES (?, ?, ?)",
+                events,
             )
-            row = await cursor.fetchone()
-
-        recent = row[0] if row else 0
-        return recent / hours if hours > 0 else 0.0
-
-    async def calculate_trending_score(self, file_id: str) -> float:
-
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT download_count, first_download, last_download FROM files WHERE file_id = ?",
-                (file_id,),
+            await db.executemany(
+                """
+                INSERT INTO files (file_id, download_count, first_download, last_download, trending_log, hotness_log)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(file_id) DO UPDATE SET
+                    download_count = download_count + excluded.download_count,
+                    last_download = MAX(COALESCE(last_download, ''), excluded.last_download),
+                    trending_log = logaddexp(trending_log, excluded.trending_log),
+                    hotness_log = logaddexp(hotness_log, excluded.hotness_log)
+            """,
+                [(file_id, *stats, *scores[file_id]) for file_id, stats in files.items()],
             )
-            row = await cursor.fetchone()
+            await self._add_hours(db, hours)
 
-        if not row:
-            return 0.0
-
-        total_downloads, first_dl, last_dl = row
-
-        # Velocity calculations
-        velocity_24 = await self._calculate_velocity(file_id, 24)
-        velocity_1 = await self._calculate_velocity(file_id, 1)
-        velocity_score = (velocity_24 * 1.0) + (velocity_1 * 5.0)
-
-        popularity_score = math.sqrt(total_downloads)
+    async def track_download(self, file_id: str, user_ip: str = None):
+        await self._write_downloads([(file_id, user_ip, datetime.now().isoformat())])
 
-        # Recency decay
-        recency_weight = 0.0
-        if last_dl:
-            last = datetime.fromisoformat(last_dl)
-            hours = (datetime.now() - last).total_seconds() / 3600
-            recency_weight = math.exp(-0.693 * hours / 48)
+    def _score(self, method: str, score_log: float, now: float) -> float:
+        if score_log is None:
+            return 0.0
+        return round(math.exp(score_log - self._rates[method] * (now - _EPOCH)), 2)
 
-        # Freshness boost
-        freshness_boost = 1.0
-        if first_dl:
-            first = datetime.fromisoformat(first_dl)
-            hours = (datetime.now() - first).total_seconds() / 3600
-            if hours < 72:
-                freshness_boost = 2.0 - (hours / 72)
+    def _stats(self, row, now: float, recent: dict) -> dict:
+        file_id, count, first, last, trending, hotness = row
+        return {
+            "fileId": file_id,
+            "downloadCount": count,
+            "downloadsLast24h": recent.get(file_id, 0),
+            "trendingScore": self._score(Algorithms.TRENDING, trending, now),
+            "hotnessScore": self._score(Algorithms.HOTNESS, hotness, now),
+            "firstDownload": first,
+            "lastDownload": last,
+        }
 
-        return (
-            (velocity_score * 3.0 + popularity_score) * recency_weight * freshness_boost
+    async def _recent_downloads(self, db, file_ids: list[str], now: float) -> dict:
+        # the current hour and the 23 before it
+        cursor = await db.execute(
+            f"""
+            SELECT file_id, SUM(downloads) FROM downloads_hourly
+            WHERE file_id IN ({", ".join("?" * len(file_ids))}) AND hour > ?
+            GROUP BY file_id
+            """,
+            (*file_ids, int(now // 3600) - 24),
         )
+        return dict(await cursor.fetchall())
 
-    async def calculate_hotness_score(
-        self, file_id: str, gravity: float = 1.5
-    ) -> float:
-
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT download_count, first_download FROM files WHERE file_id = ?",
-                (file_id,),
-            )
-            row = await cursor.fetchone()
-
-        if not row:
-            return 0.0
-
-        downloads, first_dl = row
-        first = datetime.fromisoformat(first_dl)
-        hours_old = (datetime.now() - first).total_seconds() / 3600
+    async def calculate_trending_score(self, file_id: str) -> float:
+        return (await self.get_file_stats(file_id))[Algorithms.TRENDING]
 
-        return (downloads / math.pow(hours_old + 2, gravity)) * 1000
+    async def calculate_hotness_score(self, file_id: str) -> float:
+        return (await self.get_file_stats(file_id))[Algorithms.HOTNESS]
 
-    @timed_cache(seconds=300)
     async def get_files_stats(self, limit: int = 10, method: str = Algorithms.TRENDING):
-        results = []
+        if method not in self._SCORES:
+            raise ValueError(f"Unknown method {method}, use one of {', '.join(self._SCORES)}")
+        now = time.time()
 
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT file_id FROM files")
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                f"""
+                SELECT file_id, download_count, first_download, last_download, trending_log, hotness_log
+                FROM files ORDER BY {self._SCORES[method]} DESC LIMIT ?
+                """,
+                (limit,),
+            )
             rows = await cursor.fetchall()
+            recent = await self._recent_downloads(db, [row[0] for row in rows], now)
 
-        file_ids = [row[0] for row in rows]
-
-        async def process(file_id):
-            stats = await self.get_file_stats(file_id)
-            if stats:
-                results.append(stats)
-
-        await asyncio.gather(*[process(fid) for fid in file_ids])
+        return [self._stats(row, now, recent) for row in rows]
 
-        return sorted(results, key=lambda x: x[method], reverse=True)[:limit]
+    async def get_download_counts(self, limit: int = 10000) -> dict[str, int]:
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                "SELECT file_id, download_count FROM files ORDER BY download_count DESC LIMIT ?",
+                (limit,),
+            )
+            return dict(await cursor.fetchall())
 
     async def get_file_stats(self, file_id: str):
-        trending = await self.calculate_trending_score(file_id)
-        hotness = await self.calculate_hotness_score(file_id)
+        now = time.time()
 
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
-                "SELECT download_count, first_download, last_download FROM files WHERE file_id = ?",
+                """
+                SELECT file_id, download_count, first_download, last_download, trending_log, hotness_log
+                FROM files WHERE file_id = ?
+                """,
                 (file_id,),
             )
             row = await cursor.fetchone()
+            recent = await self._recent_downloads(db, [file_id], now)
 
-        if not row:
-            row = 0, None, None
-
-        count, first, last = row
-
-        return {
-            "fileId": file_id,
-            "downloadCount": count,
-            "trendingScore": round(trending, 2),
-            "hotnessScore": round(hotness, 2),
-            "firstDownload": first,
-            "lastDownload": last,
-        }
+        return self._stats(row or (file_id, 0, None, None, None, None), now, recent)
@@ -8,22 +8,74 @@
 # if you are using this following code then don't forgot to give proper
 # credit to t.me/kAiF_00z (github.com/kaif-00z)
 
-# this is implemented in api interfaces yet but the backend aka this is ready for future use.
-
+import asyncio
 from datetime import datetime, timedelta
-import aiosqlite
+from logging import getLogger
+
+from libs.metrics import QUEUE_DEPTH
+from libs.sqlite_pool import SQLitePool
+
+LOGGER = getLogger(__name__)
 
 class Activities:
     BROWSE = "browsing"
     DL = "download"
     SRCH = "search"
 
+class Activity:
+    """
+    A queued activity, `add` (the `on_sent` of a stream) counts the bytes it sent in
+    memory until the next flush writes them.
+    """
+
+    __slots__ = ("_tracker", "id", "user_ip", "activity_type", "file_name", "details", "timestamp", "requests", "unflushed")
+
+    def __init__(self, tracker: "UserTracker", user_ip: str, activity_type: str, file_name: str, details: str):
+        self._tracker = tracker
+        self.id: int = None
+        self.user_ip = user_ip
+        self.activity_type = activity_type
+        self.file_name = file_name
+        self.details = details
+        self.timestamp = datetime.now().isoformat()
+        self.requests = 1  # more when requests were folded into it, see queue_activity
+        self.unflushed = 0
+
+    def add(self, nbytes: int) -> None:
+        if not nbytes:
+            return
+        if not self.unflushed:
+            self._tracker._dirty.append(self)
+        self.unflushed += nbytes
+        usage = self._tracker._unflushed
+        usage[self.user_ip] = usage.get(self.user_ip, 0) + nbytes
+
+
 class UserTracker:
-    def __init__(self, db_path="users.db"):
+    def __init__(self, db_path="users.db", flush_size: int = 500, flush_interval: float = 2.0, max_pending: int = 100000):
         self.db_path = db_path
+        self._pool = SQLitePool(db_path)
+
+        # set from the request path (flags from the rate limiter, activities and the bytes
+        # streams sent), written by _flush_loop in one transaction every flush_interval or
+        # once flush_size activities are queued. past max_pending (the database is failing)
+        # activities are folded into one per ip and type, their bytes still count
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._flagged: set[str] = set()
+        self._queued: list[Activity] = []
+        self._folded: dict[tuple[str, str], Activity] = {}
+        self._depth = QUEUE_DEPTH.labels("activities")
+        self._dirty: list[Activity] = []
+        self._unflushed: dict[str, int] = {}  # bytes per ip, for quotas
+        self._flush_now = asyncio.Event()
+        self._stopping = False
+        self._flusher: asyncio.Task = None
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        await self._pool.open()
+        async with self._pool.write() as db:
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
@@ -50,23 +102,204 @@ class UserTracker:
                 )
                 """
             )
-            await db.commit()
 
-    async def is_suspicious(self, user_ip: str) -> bool:
-        min = (datetime.now() - timedelta(minutes=1)).isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM activity_logs WHERE user_ip = ? AND timestamp > ?",
-                (user_ip, min)
+            # activity past the raw retention, hour is the timestamp's "YYYY-MM-DDTHH" and day
+            # its "YYYY-MM-DD" so they compare with the same iso cutoffs as the raw rows
+            for table, period in (("activity_hourly", "hour"), ("activity_daily", "day")):
+                await db.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        user_ip TEXT,
+                        {period} TEXT,
+                        activity_type TEXT,
+                        requests INTEGER,
+                        bandwidth INTEGER,
+                        PRIMARY KEY (user_ip, {period}, activity_type)
+                    ) WITHOUT ROWID
+                    """
+                )
+                await db.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{table}_{period} ON {table} ({period}, bandwidth)"
+                )
+            # and all time totals past the longest period (a year)
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS activity_totals (
+                    user_ip TEXT,
+                    activity_type TEXT,
+                    requests INTEGER,
+                    bandwidth INTEGER,
+                    PRIMARY KEY (user_ip, activity_type)
+                ) WITHOUT ROWID
+                """
+            )
+
+            # covering the bandwidth sums and the latest activity lists
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_activity_user_time ON activity_logs (user_ip, timestamp, bandwidth)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_activity_time ON activity_logs (timestamp, bandwidth)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_activity_type_time ON activity_logs (activity_type, timestamp)"
+            )
+            # the user counts filter on these
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_last_access ON users (last_access)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_first_access ON users (first_access)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_flagged ON users (is_flagged, last_access)"
             )
-            return (await cursor.fetchone())[0] > 60
+
+        if not self._flusher:
+            self._stopping = False
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            # lets a running flush finish, the flusher then writes what is left and exits
+            self._stopping = True
+            self._flush_now.set()
+            await self._flusher
+            self._flusher = None
+        await self._pool.close()
+
+    def flag(self, user_ip: str) -> None:
+        self._flagged.add(user_ip)
+
+    async def _flush_loop(self):
+        stopping = False
+        while not stopping:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            stopping = self._stopping
+            try:
+                await self._flush()
+            except Exception as err:
+                LOGGER.error(f"Failed to write user activity, retrying with the next flush: {err}")
+
+    def queue_activity(self, user_ip: str, activity_type: str = Activities.BROWSE, file_name: str = None, details: str = None) -> Activity:
+        """track_user without waiting on the database, the activity is written by the next flush."""
+        if len(self._queued) >= self.max_pending:
+            if activity := self._folded.get((user_ip, activity_type)):
+                activity.requests += 1
+                return activity
+            LOGGER.warning(f"Activity queue is full, folding the {activity_type} activity of {user_ip}")
+            activity = Activity(self, user_ip, activity_type, None, None)
+            self._folded[(user_ip, activity_type)] = activity
+        else:
+            activity = Activity(self, user_ip, activity_type, file_name, details)
+        self._queued.append(activity)
+        self._depth.set(len(self._queued))
+        if len(self._queued) >= self.flush_size:
+            self._flush_now.set()
+        return activity
+
+    async def _flush(self):
+        # everything is taken at once, what arrives while writing waits for the next flush
+        flagged, self._flagged = self._flagged, set()
+        queued, self._queued = self._queued, []
+        self._folded = {}
+        self._depth.set(0)
+        dirty, self._dirty = self._dirty, []
+        self._unflushed = {}
+        usage = [(activity, activity.unflushed) for activity in dirty]
+        for activity in dirty:
+            activity.unflushed = 0
+        if not (flagged or queued or usage):
+            return
+
+        try:
+            ids = await self._write(flagged, queued, usage)
+        except BaseException:
+            # handed back for the next flush to retry, in front of what came in meanwhile
+            self._flagged |= flagged
+            self._queued[:0] = queued
+            self._depth.set(len(self._queued))
+            for activity, nbytes in usage:
+                activity.add(nbytes)
+            raise
+        # only once committed, a rolled back rowid is given to the next insert
+        for activity, activity_id in zip(queued, ids):
+            activity.id = activity_id
+
+    async def _write(self, flagged: set[str], queued: list[Activity], usage: list[tuple[Activity, int]]) -> list[int]:
+        """Writes one flush in a transaction, returning the rowids of `queued`."""
+        users = {}
+        for activity in queued:
+            requests, downloads, _ = users.get(activity.user_ip, (0, 0, None))
+            users[activity.user_ip] = (
+                requests + activity.requests,
+                downloads + activity.requests * (activity.activity_type == Activities.DL),
+                activity.timestamp,
+            )
+
+        async with self._pool.write() as db:
+            # activities sent their first bytes before they were written get them inserted
+            # along, the later ones add up per activity
+            first = {activity: nbytes for activity, nbytes in usage if activity.id is None}
+            ids = []
+            for activity in queued:
+                cursor = await db.execute(
+                    """
+                    INSERT INTO activity_logs (user_ip, activity_type, file_name, details, bandwidth, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        activity.user_ip,
+                        activity.activity_type,
+                        activity.file_name,
+                        activity.details,
+                        first.get(activity, 0),
+                        activity.timestamp,
+                    ),
+                )
+                ids.append(cursor.lastrowid)
+            await db.executemany(
+                "UPDATE activity_logs SET bandwidth = bandwidth + ? WHERE id = ?",
+                [
+                    (nbytes, activity.id)
+                    for activity, nbytes in usage
+                    if activity.id is not None and activity not in first
+                ],
+            )
+            await db.executemany(
+                """
+                INSERT INTO users (user_ip, requests_count, downloads_count, first_access, last_access)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_ip) DO UPDATE SET
+                    requests_count = requests_count + excluded.requests_count,
+                    downloads_count = downloads_count + excluded.downloads_count,
+                    last_access = excluded.last_access
+                """,
+                [
+                    (user_ip, requests, downloads, timestamp, timestamp)
+                    for user_ip, (requests, downloads, timestamp) in users.items()
+                ],
+            )
+            timestamp = datetime.now().isoformat()
+            await db.executemany(
+                """
+                INSERT INTO users (user_ip, requests_count, downloads_count, first_access, last_access, is_flagged)
+                VALUES (?, 0, 0, ?, ?, 1)
+                ON CONFLICT(user_ip) DO UPDATE SET is_flagged = 1
+                """,
+                [(user_ip, timestamp, timestamp) for user_ip in flagged],
+            )
+        return ids
 
     async def track_user(self, user_ip: str, activity_type: str = Activities.BROWSE, file_name: str = None, details: str = None) -> int:
         timestamp = datetime.now().isoformat()
         is_download = int(activity_type == Activities.DL)
-        is_suspicious = int(await self.is_suspicious(user_ip))
 
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.write() as db:
             cursor = await db.execute(
                 """
                 INSERT INTO activity_logs (user_ip, activity_type, file_name, details, bandwidth, timestamp)
@@ -78,22 +311,20 @@ class UserTracker:
 
             await db.execute(
                 """
-                INSERT INTO users (user_ip, requests_count, downloads_count, first_access, last_access, is_flagged)
-                VALUES (?, 1, ?, ?, ?, ?)
+                INSERT INTO users (user_ip, requests_count, downloads_count, first_access, last_access)
+                VALUES (?, 1, ?, ?, ?)
                 ON CONFLICT(user_ip) DO UPDATE SET
                     requests_count = requests_count + 1,
                     downloads_count = downloads_count + excluded.downloads_count,
-                    last_access = excluded.last_access,
-                    is_flagged = MAX(users.is_flagged, excluded.is_flagged)
+                    last_access = excluded.last_access
                 """,
-                (user_ip, is_download, timestamp, timestamp, is_suspicious),
+                (user_ip, is_download, timestamp, timestamp),
             )
 
-            await db.commit()
             return activity_id
 
     async def add_bandwidth_usage(self, activity_id: int, bytes_used: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.write() as db:
             await db.execute(
                 """
                 UPDATE activity_logs
@@ -102,66 +333,149 @@ class UserTracker:
                 """,
                 (bytes_used, activity_id),
             )
-            await db.commit()
+
+    async def bandwidth_used(self, user_ip: str, since: datetime) -> int:
+        """
+        Bytes sent to `user_ip` since `since` (from the start of its hour once rolled
+        up), the ones not written yet included.
+        """
+        since = since.isoformat()
+        async with self._pool.read() as db:
+            cursor = await db.execute(
+                """
+                SELECT (SELECT SUM(bandwidth) FROM activity_logs WHERE user_ip = ? AND timestamp > ?),
+                       (SELECT SUM(bandwidth) FROM activity_hourly WHERE user_ip = ? AND hour >= ?)
+                """,
+                (user_ip, since, user_ip, since[:13]),
+            )
+            raw, hourly = await cursor.fetchone()
+        return int(raw or 0) + int(hourly or 0) + self._unflushed.get(user_ip, 0)
+
+    # rollup tiers, table -> its time column and how much of an iso timestamp that keeps
+    _TIERS = {
+        "activity_logs": ("timestamp", None),
+        "activity_hourly": ("hour", 13),
+        "activity_daily": ("day", 10),
+        "activity_totals": (None, 0),
+    }
+
+    async def compact(self, raw_before: datetime, hourly_before: datetime, batch: int = 10000) -> int:
+        """
+        Rolls activity from before `raw_before` into hourly totals, hourly totals from
+        before `hourly_before` into daily ones and days older than a year into all time
+        totals, deleting what was rolled up. A batch per transaction, so the writer is
+        never held for long. Returns the raw rows removed.
+        """
+        removed = 0
+        while moved := await self._roll_up("activity_logs", "activity_hourly", raw_before, batch):
+            removed += moved
+        while await self._roll_up("activity_hourly", "activity_daily", hourly_before, batch):
+            pass
+        year_ago = datetime.now() - timedelta(days=366)
+        while await self._roll_up("activity_daily", "activity_totals", year_ago, batch):
+            pass
+        return removed
+
+    async def _roll_up(self, source: str, target: str, before: datetime, batch: int) -> int:
+        column, width = self._TIERS[source]
+        period, target_width = self._TIERS[target]
+        before = before.isoformat()[:width]
+        # raw rows are batched by id, the rollups have none
+        key, counted = ("id", "COUNT(*)") if source == "activity_logs" else (column, "SUM(requests)")
+        keys = ["user_ip", "activity_type"]
+        values = ["IFNULL(user_ip, '')", "IFNULL(activity_type, '')"]
+        if period:
+            keys.insert(1, period)
+            values.insert(1, f"substr({column}, 1, {target_width})")
+
+        async with self._pool.write() as db:
+            cursor = await db.execute(
+                f"SELECT MAX({key}) FROM (SELECT {key} FROM {source} WHERE {column} < ? ORDER BY {column} LIMIT ?)",
+                (before, batch),
+            )
+            last = (await cursor.fetchone())[0]
+            if last is None:
+                return 0
+            await db.execute(
+                f"""
+                INSERT INTO {target} ({", ".join(keys)}, requests, bandwidth)
+                SELECT {", ".join(values)}, {counted}, SUM(bandwidth)
+                FROM {source} WHERE {column} < ? AND {key} <= ?
+                GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))}
+                ON CONFLICT ({", ".join(keys)}) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    bandwidth = bandwidth + excluded.bandwidth
+                """,
+                (before, last),
+            )
+            cursor = await db.execute(
+                f"DELETE FROM {source} WHERE {column} < ? AND {key} <= ?", (before, last)
+            )
+            return cursor.rowcount
 
     async def calculate_bandwidth(self, user_ip: str = None) -> int:
-        bandwidth_stats = {}
+        # every period summed in one pass over each of the raw rows and the rollups, the
+        # rollups count whole hours / days, so older periods start up to one early
         now = datetime.now()
-        async with aiosqlite.connect(self.db_path) as db:
-            periods = {
-                "hour": timedelta(hours=1),
-                "day": timedelta(days=1),
-                "week": timedelta(weeks=1),
-                "month": timedelta(days=30),
-                "year": timedelta(days=365)
-            }
-            
-            for name, delta in periods.items():
-                cutoff = (now - delta).isoformat()
-                if user_ip is None:
-                    bw_cursor = await db.execute(
-                        "SELECT SUM(bandwidth) FROM activity_logs WHERE timestamp > ?",
-                        (cutoff,)
-                    )
-                else:
-                    bw_cursor = await db.execute(
-                        "SELECT SUM(bandwidth) FROM activity_logs WHERE user_ip = ? AND timestamp > ?",
-                        (user_ip, cutoff)
-                    )
-                bandwidth_stats[name] = int((await bw_cursor.fetchone())[0] or 0)
-            
-            if user_ip is None:
-                total_cursor = await db.execute(
-                    "SELECT SUM(bandwidth) FROM activity_logs"
-                )
-            else:
-                total_cursor = await db.execute(
-                    "SELECT SUM(bandwidth) FROM activity_logs WHERE user_ip = ?",
-                    (user_ip,)
+        periods = {
+            "hour": timedelta(hours=1),
+            "day": timedelta(days=1),
+            "week": timedelta(weeks=1),
+            "month": timedelta(days=30),
+            "year": timedelta(days=365)
+        }
+        cutoffs = [(now - delta).isoformat() for delta in periods.values()]
+        bandwidth_stats = dict.fromkeys([*periods, "total"], 0)
+
+        async with self._pool.read() as db:
+            for table, column, width in (
+                ("activity_logs", "timestamp", None),
+                ("activity_hourly", "hour", 13),
+                ("activity_daily", "day", 10),
+            ):
+                sums = ", ".join(
+                    f"SUM(CASE WHEN {column} {'>' if width is None else '>='} ? THEN bandwidth END)"
+                    for _ in periods
                 )
-            bandwidth_stats["total"] = int((await total_cursor.fetchone())[0] or 0)
-            return bandwidth_stats
+                params = [cutoff[:width] for cutoff in cutoffs]
+                where = ""
+                if user_ip is not None:
+                    where = "WHERE user_ip = ?"
+                    params.append(user_ip)
+                cursor = await db.execute(f"SELECT {sums}, SUM(bandwidth) FROM {table} {where}", params)
+                for name, value in zip(bandwidth_stats, await cursor.fetchone()):
+                    bandwidth_stats[name] += int(value or 0)
+
+            cursor = await db.execute(
+                f"SELECT SUM(bandwidth) FROM activity_totals {where}", params[len(periods):]
+            )
+            bandwidth_stats["total"] += int((await cursor.fetchone())[0] or 0)
+        return bandwidth_stats
 
     async def get_user_info(self, user_ip: str) -> dict:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
                 "SELECT user_ip, requests_count, downloads_count, first_access, last_access, is_flagged FROM users WHERE user_ip = ?",
                 (user_ip,),
             )
-            if row := await cursor.fetchone():
-                return {
-                    "user_ip": row[0],
-                    "requests_count": row[1],
-                    "downloads_count": row[2],
-                    "bandwidth_usage": await self.calculate_bandwidth(user_ip),
-                    "first_access": row[4],
-                    "last_access": row[5],
-                    "is_flagged": bool(row[6]),
-                }
-            return {}
+            row = await cursor.fetchone()
+
+        # bandwidth is read after the connection went back to the pool, nesting
+        # acquisitions could deadlock once every reader is busy.
+        if row:
+            return {
+                "user_ip": row[0],
+                "requests_count": row[1],
+                "downloads_count": row[2],
+                "bandwidth_usage": await self.calculate_bandwidth(user_ip),
+                "first_access": row[3],
+                "last_access": row[4],
+                "is_flagged": bool(row[5]),
+            }
+        return {}
         
     async def is_flagged_user(self, user_ip: str) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
                 "SELECT is_flagged FROM users WHERE user_ip = ?",
                 (user_ip,),
@@ -170,7 +484,7 @@ class UserTracker:
             return bool(row[0]) if row else False
         
     async def get_latest_activities(self, limit: int = 100) -> list:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
                 "SELECT user_ip, activity_type, file_name, details, bandwidth, timestamp FROM activity_logs ORDER BY timestamp DESC LIMIT ?",
                 (limit,),
@@ -190,7 +504,7 @@ class UserTracker:
             return []
         
     async def get_latest_activities_by_user(self, user_ip: str, limit: int = 100) -> list:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
                 "SELECT user_ip, activity_type, file_name, details, bandwidth, timestamp FROM activity_logs WHERE user_ip = ? ORDER BY timestamp DESC LIMIT ?",
                 (user_ip, limit),
@@ -210,7 +524,7 @@ class UserTracker:
             return []
 
     async def get_latest_activities_by_type(self, activity_type: str, limit: int = 100) -> list:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             cursor = await db.execute(
                 "SELECT user_ip, activity_type, file_name, details, bandwidth, timestamp FROM activity_logs WHERE activity_type = ? ORDER BY timestamp DESC LIMIT ?",
                 (activity_type, limit),
@@ -230,7 +544,7 @@ class UserTracker:
             return []
         
     async def total_downloads_recorded(self, days: int = None, hours: int = None) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             if days is not None:
                 cutoff = (datetime.now() - timedelta(days=days)).isoformat()
                 cursor = await db.execute(
@@ -251,7 +565,7 @@ class UserTracker:
             return row[0] if row and row[0] is not None else 0
         
     async def total_requests_recorded(self, days: int = None, hours: int = None) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             if days is not None:
                 cutoff = (datetime.now() - timedelta(days=days)).isoformat()
                 cursor = await db.execute(
@@ -272,7 +586,7 @@ class UserTracker:
             return row[0] if row and row[0] is not None else 0
         
     async def unique_users_count(self, days: int = None, hours: int = None) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             if days is not None:
                 cutoff = (datetime.now() - timedelta(days=days)).isoformat()
                 cursor = await db.execute(
@@ -293,7 +607,7 @@ class UserTracker:
             return row[0] if row else 0
         
     async def flagged_users_count(self, days: int = None, hours: int = None) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             if days is not None:
                 cutoff = (datetime.now() - timedelta(days=days)).isoformat()
                 cursor = await db.execute(
@@ -314,7 +628,7 @@ class UserTracker:
             return row[0] if row else 0
         
     async def flagged_users_list(self, days: int = None, hours: int = None, limit: int = 100) -> list:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._pool.read() as db:
             if days is not None:
                 cutoff = (datetime.now() - timedelta(days=days)).isoformat()
                 cursor = await db.execute(
@@ -10,15 +10,38 @@
 
 import logging
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from traceback import format_exc
 
 from fastapi import FastAPI, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from gdrive import AsyncGoogleDriver
+from gdrive import INFO_TTL, LIST_TTL, SEARCH_TTL, AsyncGoogleDriver
+from gdrive.config import Var
+from gdrive.utils import shutdown_executors
+from libs.archive import ARCHIVE_FORMATS
+from libs.http_cache import (
+    body_etag,
+    cache_control,
+    file_etag,
+    http_date,
+    none_match,
+    not_modified_since,
+    range_applies,
+)
+from libs.metrics import MetricsMiddleware, render
+from libs.rate_limit import (
+    RateLimiter,
+    RateLimitMiddleware,
+    client_address,
+    make_limiter_store,
+    parse_proxies,
+)
 from libs.tracker import Tracker
+from libs.tracker.downloads import Algorithms
+from libs.tracker.users import Activities
 from libs.version import get_version_info
 from models import (
     FileFolderResponse,
@@ -42,7 +65,11 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 global driver
-trk = Tracker()
+trk = Tracker(
+    raw_retention=Var.TRACKER_RAW_RETENTION,
+    hourly_retention=Var.TRACKER_HOURLY_RETENTION,
+)
+trusted_proxies = parse_proxies(Var.TRUSTED_PROXIES)
 
 
 @asynccontextmanager
@@ -51,8 +78,18 @@ async def lifespan(app):
     driver = AsyncGoogleDriver()  # Initialized here to ensure compatibility with ASGI servers (ex- Gunicorn + Uvicorn) and proper async context handling.
     await driver._load_accounts()
     await trk.wake()
+
+    async def hot_files(limit: int) -> list[str]:
+        stats = await trk.dl.get_files_stats(limit=limit, method=Algorithms.HOTNESS)
+        return [stat["fileId"] for stat in stats]
+
+    await driver.chunk_cache.start(hot_files)
+    driver.prefetcher.start()
+    await driver.start_indexer(popularity=trk.dl.get_download_counts)
     yield
-    await driver._requests_sessions.close()
+    await driver.close()
+    await trk.sleep()
+    shutdown_executors()
 
 
 app = FastAPI(
@@ -64,6 +101,21 @@ app = FastAPI(
     redoc_url=None,
 )
 
+# clients over the limit get a 429 and are flagged, inside cors so browsers can read it
+app.add_middleware(
+    RateLimitMiddleware,
+    limiter=RateLimiter(
+        Var.RATE_LIMIT,
+        burst=Var.RATE_LIMIT_BURST,
+        store=make_limiter_store(
+            Var.RATE_LIMIT_BACKEND, path=Var.RATE_LIMIT_PATH, url=Var.CACHE_REDIS_URL
+        ),
+        on_limited=trk.user.flag,
+    ),
+    paths=("/dl", "/search", "/folders/list"),
+    ranged_paths=("/dl",),
+    trusted_proxies=trusted_proxies,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -71,6 +123,33 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+
+def remote_ip(request: Request) -> str:
+    return client_address(request.scope, trusted_proxies)
+
+
+def cached_json(request: Request, data, max_age: int) -> Response:
+    # rendering is cheaper than any walk over the payload, so the etag is the body's
+    # and a revalidation only saves sending it
+    response = JSONResponse({"success": True, "data": data})
+    headers = {
+        "ETag": body_etag(response.body),
+        "Cache-Control": cache_control(
+            max_age, Var.CACHE_STALE_WHILE_REVALIDATE, Var.CACHE_STALE_IF_ERROR
+        ),
+    }
+    if none_match(request.headers.get("If-None-Match"), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    data, content_type = render()
+    return Response(data, media_type=content_type)
 
 
 @app.get("/", include_in_schema=False)
@@ -89,16 +168,36 @@ async def stream_handler(request: Request, file_id: str) -> StreamingResponse:
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file ID format"
         )
 
-    client_ip = request.client.host
-    await trk.dl.track_download(file_id, user_ip=client_ip)
+    client_ip = remote_ip(request)
     log.info(f"Stream request for file {file_id} from IP {client_ip}")
 
+    if Var.USER_DAILY_QUOTA and await trk.user.bandwidth_used(
+        client_ip, datetime.now() - timedelta(days=1)
+    ) >= Var.USER_DAILY_QUOTA * 1048576:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Daily download quota exceeded",
+        )
+
     try:
         file_info = await driver.get_file_info(file_id)
         if file_info.get("mimeType") == "application/vnd.google-apps.folder":
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="No Feature to download a folder!",
+            archive_format = request.query_params.get("format", "zip").lower()
+            if archive_format not in ARCHIVE_FORMATS:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Folders can be downloaded as {', '.join(ARCHIVE_FORMATS)}",
+                )
+            trk.dl.queue_download(file_id, user_ip=client_ip)
+            activity = trk.user.queue_activity(
+                client_ip, Activities.DL, file_info.get("name"), file_id
+            )
+            return await driver.stream_folder(
+                file_id.strip(),
+                file_info,
+                archive_format,
+                client_ip=client_ip,
+                on_sent=activity.add,
             )
     except HTTPException as err:
         raise err
@@ -112,23 +211,48 @@ async def stream_handler(request: Request, file_id: str) -> StreamingResponse:
             detail=getattr(e, "details", str(e)),
         )
 
-    return await driver.stream_file(
-        file_id.strip(), file_info, request.headers.get("Range", 0)
+    # validators, so cdn edges can revalidate and resume what they already hold
+    etag = file_etag(file_info)
+    last_modified = http_date(file_info.get("modifiedTime"))
+    validators = {"ETag": etag}
+    if last_modified:
+        validators["Last-Modified"] = last_modified
+    if none_match(request.headers.get("If-None-Match"), etag) or (
+        "If-None-Match" not in request.headers
+        and not_modified_since(request.headers.get("If-Modified-Since"), last_modified)
+    ):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
+
+    range_header = request.headers.get("Range", 0)
+    if range_header and not range_applies(
+        request.headers.get("If-Range"), etag, last_modified
+    ):
+        range_header = 0  # their copy is outdated, the whole file it is
+
+    trk.dl.queue_download(file_id, user_ip=client_ip)
+    # counts what actually reached the client, partial and resumed transfers included
+    activity = trk.user.queue_activity(
+        client_ip, Activities.DL, file_info.get("name"), file_id
     )
+    response = await driver.stream_file(
+        file_id.strip(),
+        file_info,
+        range_header,
+        client_ip=client_ip,
+        on_sent=activity.add,
+    )
+    response.headers.update(validators)
+    return response
 
 
 @app.get("/info", response_model=FileFolderResponse)
 async def file_info(
+    request: Request,
     file_id: str = Query(..., description="Google Drive file or folder ID"),
 ):
     try:
         data = await driver.get_file_info(file_id)
-        return JSONResponse(
-            {
-                "success": True,
-                "data": data,
-            }
-        )
+        return cached_json(request, data, INFO_TTL)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -141,6 +265,7 @@ async def file_info(
 
 @app.get("/folders/list", response_model=FilesFoldersListResponse)
 async def folders_in_root(
+    request: Request,
     folder_id: Optional[str] = Query(
         None, description="Google Drive folder ID (optional, defaults to root)"
     ),
@@ -149,6 +274,9 @@ async def folders_in_root(
         None, description="Pagination token for next page"
     ),
 ):
+    trk.user.queue_activity(
+        remote_ip(request), Activities.BROWSE, details=folder_id or "root"
+    )
     try:
         data = (
             await driver.list_all(page_token=page_token, page_size=page_size)
@@ -157,12 +285,7 @@ async def folders_in_root(
                 folder_id=folder_id, page_token=page_token, page_size=page_size
             )
         )
-        return JSONResponse(
-            {
-                "success": True,
-                "data": data,
-            }
-        )
+        return cached_json(request, data, LIST_TTL)
     except BaseException as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -175,22 +298,19 @@ async def folders_in_root(
 
 @app.get("/search", response_model=SearchResponse)
 async def search(
+    request: Request,
     query: str = Query(..., min_length=3, description="Search query"),
     page_size: int = Query(50, ge=1, le=50, description="Number of results per page"),
     page_token: Optional[str] = Query(
         None, description="Pagination token for next page"
     ),
 ):
+    trk.user.queue_activity(remote_ip(request), Activities.SRCH, details=query)
     try:
         data = await driver.search_files_in_drive(
             query, page_token=page_token, page_size=page_size
         )
-        return JSONResponse(
-            {
-                "success": True,
-                "data": data,
-            }
-        )
+        return cached_json(request, data, SEARCH_TTL)
     except BaseException as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -48,14 +48,21 @@ class SearchData(BaseModem):
 class FileStats(BaseModel):
     fileId: str = Field(..., description="Unique identifier of the file")
     downloadCount: Optional[int] = Field(0, description="Total number of downloads")
+    downloadsLast24h: Optional[int] = Field(
+        0, description="Downloads in the current hour and the 23 before it"
+    )
     firstDownload: Optional[str] = Field(
         None, description="Timestamp of the first download"
     )
     lastDownload: Optional[str] = Field(
         None, description="Timestamp of the last download"
     )
-    trendingScore: float = Field(..., description="Calculated trending score")
-    hotnessScore: float = Field(..., description="Calculated hotness score")
+    trendingScore: float = Field(
+        ..., description="Downloads decayed with a 6 hour half life"
+    )
+    hotnessScore: float = Field(
+        ..., description="Downloads decayed with a 48 hour half life"
+    )
 
 
 # Response models